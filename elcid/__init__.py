@@ -11,6 +11,8 @@ from elcid.menus import ServicesMenuItem
 from plugins.ipc import constants as ipc_constants
 from plugins.tb import constants as tb_constants
 
+default_app_config = 'elcid.apps.ElcidConfig'
+
 
 class StandardAddPatientMenuItem(MenuItem):
     def for_user(self, user):
@@ -10,6 +10,7 @@ from opal.core.api import item_from_pk, router as opal_router
 from opal.core.api import (
     OPALRouter, patient_from_pk, LoginRequiredViewset, SubrecordViewSet
 )
+from opal.core.patient_lists import PatientList
 from opal.core.views import json_response
 from opal.core import serialization
 from opal.models import Tagging
@@ -19,252 +20,40 @@ from intrahospital_api import loader, epr
 from plugins.covid import lab as covid_lab
 from plugins.labtests import models as lab_test_models
 from plugins.labtests import constants as lab_constants
+from plugins.labtests import summaries as lab_summaries
+from plugins.labtests import recent_results
 
 from elcid import models as emodels
 from plugins.tb import models as tb_models
 
 
-_ALWAYS_SHOW_AS_TABULAR = [
-    "UREA AND ELECTROLYTES",
-    "LIVER PROFILE",
-    "IMMUNOGLOBULINS",
-    "C REACTIVE PROTEIN",
-    "RENAL",
-    "RENAL PROFILE",
-    "BONE PROFILE",
-    "FULL BLOOD COUNT",
-    "HAEMATINICS",
-    "HBA1C",
-    "THYROID FUNCTION TESTS",
-    "ARTERIAL BLOOD GASES",
-    "B12 AND FOLATE SCREEN",
-    "CLOTTING SCREEN",
-    "BICARBONATE",
-    "CARDIAC PROFILE",
-    "CHLORIDE",
-    "CHOLESTEROL/TRIGLYCERIDES",
-    "AFP",
-    "25-OH VITAMIN D",
-    "AMMONIA",
-    "FLUID CA-125",
-    "CARDIAC TROPONIN T",
-    "BODYFLUID CALCIUM",
-    "BODYFLUID GLUCOSE",
-    "BODYFLUID POTASSIUM",
-    "PDF PROTEIN",
-    "TACROLIMUS",
-    "FULL BLOOD COUNT"
-]
-
-
 AEROBIC   = "aerobic"
 ANAEROBIC = "anaerobic"
 
 
-class LabTestResultsView(LoginRequiredViewset):
+class LabTestResultsView(
+    lab_summaries.LabTestResultsSerialiser, LoginRequiredViewset
+):
     """
     The API endpoint that returns data for the test results view on the
     patient detail page.
     """
     basename = 'lab_test_results_view'
 
-    def get_non_comments_for_patient(self, patient):
-        """
-        Returns all non comments for a patient, ensuring they are
-        ordered by date and prefetching observations.
-        """
-        to_ignore = ['UNPROCESSED SAMPLE COMT', 'COMMENT', 'SAMPLE COMMENT']
-
-        lab_tests = patient.lab_tests.all().order_by('-datetime_ordered')
-
-        lab_tests = lab_tests.exclude(
-            test_name__in=to_ignore
-        )
-
-        # we have some lab tests with no datetime ordered
-        # they also have no lab test name or observation
-        # value so skipping them
-        lab_tests = lab_tests.exclude(
-            datetime_ordered=None
-        )
-        return lab_tests.prefetch_related('observation_set')
-
-    def group_tests(self, lab_tests):
-        """
-        Return dictionary that groups a queryset of lab tests by test name.
-        """
-        by_test = defaultdict(list)
-
-        for lab_test in lab_tests:
-            by_test[lab_test.test_name].append(lab_test)
-        return by_test
-
-    def is_long_form(self, test_type, instances):
-        """
-        Predicate function that indicates whether results should
-        be displayed in a table form or long form
-        """
-        if test_type in _ALWAYS_SHOW_AS_TABULAR:
-            return False
-
-        for instance in instances:
-            for observation in instance.observation_set.all():
-                if not observation.value_numeric:
-                    if not observation.is_pending:
-                        return True
-        return False
-
-    def is_empty_value(self, observation_value):
-        """
-        Predocate function that indicates whether there is a meaningful value
-        in this string.
-
-        For these purposes don't care about empty strings, ' - ', or ' # '
-        """
-        if isinstance(observation_value, str):
-            return not observation_value.strip().strip("-").strip("#").strip()
-        else:
-            return observation_value is None
-
-    def display_class_for_observation(self, observation):
-        """
-        Returns too-high too-low or '' for a numeric observation
-        """
-        display_class = ''
-        numeric       = observation.value_numeric
-        refrange      = observation.cleaned_reference_range
-
-        if refrange is None or numeric is None:
-            return display_class
-
-        if numeric < refrange['min']:
-            display_class = 'too-low'
-
-        if numeric > refrange['max']:
-            display_class = 'too-high'
-
-        return display_class
-
-    def serialise_tabular_instances(self, instances):
-        """
-        Serialise all instances of a tabular test type (e.g. Full Blood Count)
-        """
-        test_datetimes     = set()
-        observation_names  = set()
-        observation_ranges = {}
-        observation_units  = {}
-        lab_numbers        = {}
-        data               = defaultdict(lambda: defaultdict(lambda: None))
-        departments         = set()
-
-        for instance in instances:
-            test_datetimes.add(instance.datetime_ordered)
-            lab_numbers[serialization.serialize_datetime(instance.datetime_ordered)] = instance.lab_number
-            departments.add(instance.department)
-
-            for observation in instance.observation_set.all():
-                name = observation.observation_name.rstrip('.')
-                if not self.is_empty_value(observation.observation_value):
-
-                    if name not in observation_ranges:
-                        if observation.reference_range != " -":
-                            observation_ranges[name] = observation.reference_range
-
-                    if name not in observation_units:
-                        observation_units[name] = observation.units
-
-                    observation_names.add(name)
-                    data[name][serialization.serialize_datetime(instance.datetime_ordered)] = {
-                        'value'        : observation.observation_value,
-                        'range'        : observation.reference_range,
-                        'display_class': self.display_class_for_observation(observation)
-                    }
-
-
-        date_series = list(sorted(test_datetimes))
-        date_series = [serialization.serialize_datetime(d) for d in date_series]
-
-        return {
-            'test_datetimes'    : date_series[-8:],
-            'observation_names' : list(sorted(observation_names)),
-            'lab_numbers'       : lab_numbers,
-            'observation_ranges': observation_ranges,
-            'observation_units' : observation_units,
-            'observation_series': data,
-            'departments'       : list(departments),
-        }
-
-    def serialise_long_form_instance(self, instance):
-        """
-        Serialise a single long form test instance.
-        """
-        serialised_observations = []
-        for o in instance.observation_set.all():
-            if not self.is_empty_value(o.observation_value):
-                serialised_observations.append(
-                    {
-                        'name' : o.observation_name.rstrip('.'),
-                        'value': o.observation_value,
-                        'units': o.units
-                    }
-                )
-        return {
-            'lab_number'        : instance.lab_number,
-            'date'              : instance.datetime_ordered,
-            'observations'      : serialised_observations,
-            'site'              : instance.cleaned_site,
-            'department'        : instance.department
-        }
-
     @patient_from_pk
     def retrieve(self, request, patient):
         """
         Main entrypoint for test results via the API.
-        """
-        lab_tests  = self.get_non_comments_for_patient(patient)
-        test_dates = {}
-
-        for test in lab_tests:
-            if test.test_name in test_dates:
-                if test_dates[test.test_name] > test.datetime_ordered:
-                    continue
-            test_dates[test.test_name] = test.datetime_ordered
-
-        test_order = [
-            d[0] for d in
-            sorted(test_dates.items(),
-                   key=lambda x: -x[1].timestamp())
-        ]
-
-        by_test          = self.group_tests(lab_tests)
-        serialised_tests = {}
-        test_dates       = {}
-
-        for test_type, instances in by_test.items():
-            long_form = self.is_long_form(test_type, instances)
-
-            if long_form:
-                serialised = {
-                    'long_form'    : True,
-                    'lab_test_type': test_type,
-                    'count'        : len(instances),
-                    'instances'    : [
-                        self.serialise_long_form_instance(i) for i in instances
-                    ]
-                }
-            else:
-                serialised = {
-                    'long_form'    : False,
-                    'lab_test_type': test_type,
-                    'count'        : len(instances),
-                    'instances'    : self.serialise_tabular_instances(instances)
-                }
-
-            serialised_tests[test_type] = serialised
 
+        Test types are served from the patient's LabTestSummary
+        rows where we have them.
+        """
+        serialised_tests, test_dates = lab_summaries.get_serialised_tests(
+            patient
+        )
         return json_response(
             {
-                'test_order': test_order,
+                'test_order': lab_summaries.get_test_order(test_dates),
                 'tests'     : serialised_tests,
                 'departments': list(lab_constants.WITHPATH_DEPATMENT_MAPPING.values())
             }
@@ -356,13 +145,15 @@ class InfectionServiceTestSummaryApi(LoginRequiredViewset):
 
             ticker_test_counts = defaultdict(int)
 
-            for test_name in self.ANTIFUNGAL_TESTS:
-                data = []
-                tests = lab_test_models.LabTest.objects.filter(
-                    test_name=test_name, patient=patient
-                ).order_by('-datetime_ordered')
+            tests = lab_test_models.LabTest.objects.filter(
+                test_name__in=self.ANTIFUNGAL_TESTS.keys(), patient=patient
+            ).order_by('-datetime_ordered').prefetch_related('observation_set')
+            by_test_name = defaultdict(list)
+            for test in tests:
+                by_test_name[test.test_name].append(test)
 
-                for test in tests:
+            for test_name in self.ANTIFUNGAL_TESTS:
+                for test in by_test_name[test_name]:
                     test_tuple = (test.test_name, test.site.replace('&', ' ').split(' ')[0])
 
                     if ticker_test_counts[test_tuple] < 3:
@@ -383,47 +174,6 @@ class InfectionServiceTestSummaryApi(LoginRequiredViewset):
 
         return ticker
 
-    def get_recent_dates_to_observations(self, qs):
-        """
-        We are looking for the last 5 dates
-        where we have any observation that
-        can be cast to a number.
-
-        If a patient has multiple observations
-        on the same date take the most recent
-        that can be cast into a number
-        """
-        date_to_observation = {}
-
-        for i in qs:
-            if i.value_numeric is not None:
-                dt = i.observation_datetime
-                obs_date = dt.date()
-                if obs_date in date_to_observation:
-                    if date_to_observation[obs_date].observation_datetime < dt:
-                        date_to_observation[obs_date] = i
-                else:
-                    date_to_observation[obs_date] = i
-            if len(date_to_observation.keys()) == self.NUM_RESULTS:
-                break
-
-        return date_to_observation
-
-    def get_obs_queryset(self, patient, lab_test_name, observation_name):
-        return lab_test_models.Observation.objects.filter(
-            test__patient=patient
-        ).filter(
-            test__test_name=lab_test_name
-        ).filter(
-            observation_name=observation_name
-        ).exclude(
-            observation_datetime=None
-        ).order_by(
-            "-observation_datetime"
-        ).select_related(
-            'test'
-        )
-
     def get_PROCALCITONIN_Procalcitonin(self, observation):
         return observation.observation_value.split('~')[0]
 
@@ -458,14 +208,18 @@ class InfectionServiceTestSummaryApi(LoginRequiredViewset):
         obs = []
         date_set = set()
 
+        recent_observations = recent_results.get_recent_numeric_observations(
+            patient, self.RELEVANT_TESTS, self.NUM_RESULTS
+        )
+
         for test_name, observation_names in self.RELEVANT_TESTS.items():
             for obs_name in observation_names:
-                qs = self.get_obs_queryset(patient, test_name, obs_name)
-                if qs:
-                    date_to_obs = self.get_recent_dates_to_observations(qs)
-                    if date_to_obs:
-                        date_set.update(date_to_obs.keys())
-                        obs.append(list(date_to_obs.values()))
+                observations = recent_observations.get((test_name, obs_name))
+                if observations:
+                    date_set.update(
+                        i.observation_datetime.date() for i in observations
+                    )
+                    obs.append(observations)
 
         all_dates = list(date_set)
         all_dates.sort()
@@ -569,25 +323,12 @@ class DemographicsSearch(LoginRequiredViewset):
         hospital_number = hospital_number.lstrip('0')
         if not hospital_number:
             return HttpResponseBadRequest("Please pass in a hospital number")
-        demographics = emodels.Demographics.objects.filter(
-            hospital_number=hospital_number
-        ).last()
-
-        # If we can't find a patient in demographics
-        # check to see if it is an inactive MRN that
-        # has been merged with a different MRN on elcid
-        if not demographics:
-            merged_mrn = emodels.MergedMRN.objects.filter(
-                mrn=hospital_number
-            ).first()
-            if merged_mrn:
-                demographics = merged_mrn.patient.demographics()
-
-
-        # the patient is in elcid
-        if demographics:
+        # The patient is in elcid, either with this hospital
+        # number or with an inactive MRN that has been merged
+        patient = loader.get_patient_for_mrn(hospital_number)
+        if patient:
             return json_response(dict(
-                patient=demographics.patient.to_dict(request.user),
+                patient=patient.to_dict(request.user),
                 status=self.PATIENT_FOUND_IN_ELCID
             ))
         # ignore these hospital numbers as they always belong to a different hospital
@@ -647,6 +388,37 @@ class AddToServiceViewSet(LoginRequiredViewset):
         })
 
 
+class PatientListChangesViewSet(LoginRequiredViewset):
+    """
+    Returns the episodes on a patient list that have changed since
+    the client last loaded it.
+
+    Takes the token returned by the previous request as a GET
+    parameter, without one (or when the list does not support
+    changes) the whole list is returned with reset set to True.
+    """
+    basename = 'patient_list_changes'
+
+    def retrieve(self, request, pk=None):
+        try:
+            patientlist = PatientList.get(pk)()
+        except ValueError:
+            return json_response(
+                {'error': 'List does not exist'},
+                status_code=status.HTTP_404_NOT_FOUND
+            )
+        if not hasattr(patientlist, "to_dict_changes"):
+            return json_response({
+                'token': None,
+                'reset': True,
+                'episodes': patientlist.to_dict(request.user),
+                'removed': [],
+            })
+        return json_response(patientlist.to_dict_changes(
+            request.user, request.query_params.get('token')
+        ))
+
+
 class AbstractSendUpstreamViewSet(LoginRequiredViewset):
 
     @item_from_pk
@@ -675,6 +447,9 @@ elcid_router.register(
 )
 elcid_router.register(DemographicsSearch.basename, DemographicsSearch)
 elcid_router.register(BloodCultureIsolateApi.basename, BloodCultureIsolateApi)
+elcid_router.register(
+    PatientListChangesViewSet.basename, PatientListChangesViewSet
+)
 
 lab_test_router = OPALRouter()
 lab_test_router.register(
@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class ElcidConfig(AppConfig):
+    name = 'elcid'
+
+    def ready(self):
+        from elcid import patient_list_cache
+        patient_list_cache.connect_signals()
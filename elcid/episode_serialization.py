@@ -1,7 +1,10 @@
 from collections import defaultdict
+from functools import lru_cache
 
+from django.db.models import Q
 from opal import managers
 from opal import models as omodels
+from opal.core.fields import ForeignKeyOrFreeText
 from opal.core.subrecords import patient_subrecords, episode_subrecords
 
 from elcid.utils import timing, timing_with_args
@@ -16,6 +19,72 @@ def timed_serialize_subrecord(model, qs_args, user):
     return [sub.to_dict(user) for sub in subrecords]
 
 
+@lru_cache()
+def get_serialized_columns(model):
+    """
+    Returns [(field name, columns)] where columns are what we fetch
+    with values_list to serialize the field.
+
+    ForeignKeyOrFreeText fields fetch the name of the lookup list
+    entry in the same query rather than loading the lookup list
+    instance.
+
+    Returns None if the model has to be serialized with to_dict,
+    i.e. it overrides to_dict or has a get_{field name} method
+    or a many to many field.
+    """
+    if model.to_dict is not omodels.ToDictMixin.to_dict:
+        return None
+    many_to_manys = set(
+        i.name for i in model._meta.get_fields(include_hidden=True)
+        if i.many_to_many
+    )
+    result = []
+    for name in model._get_fieldnames_to_serialize():
+        if hasattr(model, 'get_' + name) or name in many_to_manys:
+            return None
+        field = getattr(model, name, None)
+        if isinstance(field, ForeignKeyOrFreeText):
+            result.append((name, (
+                "{}__name".format(field.fk_field_name), field.ft_field_name,
+            )))
+        else:
+            result.append((name, (name,)))
+    return result
+
+
+@timing_with_args
+def serialize_subrecord_values(model, qs_args, user):
+    """
+    The equivalent of [i.to_dict(user) for i in subrecords] that
+    reads the serialized columns with values_list rather than
+    creating model instances and walking their fields.
+    """
+    fields = get_serialized_columns(model)
+    if fields is None:
+        return timed_serialize_subrecord(model, qs_args, user)
+
+    columns = []
+    for _, field_columns in fields:
+        columns.extend(field_columns)
+    rows = model.objects.filter(**qs_args).values_list(*columns)
+
+    result = []
+    for row in rows:
+        serialized = {}
+        idx = 0
+        for name, field_columns in fields:
+            if len(field_columns) == 2:
+                # a ForeignKeyOrFreeText, the lookup list name or the free text
+                fk_name, ft_value = row[idx], row[idx + 1]
+                serialized[name] = ft_value if fk_name is None else fk_name
+            else:
+                serialized[name] = row[idx]
+            idx += len(field_columns)
+        result.append(serialized)
+    return result
+
+
 
 def serialize_subrecords(ids, user, subrecords_to_serialise):
     """
@@ -41,7 +110,7 @@ def serialize_subrecords(ids, user, subrecords_to_serialise):
 
     for model in subrecords_to_serialise:
         name = model.get_api_name()
-        as_dicts = timed_serialize_subrecord(model, qs_args, user)
+        as_dicts = serialize_subrecord_values(model, qs_args, user)
         for subrecord in as_dicts:
             result[subrecord.get(key)][name].append(subrecord)
 
@@ -97,25 +166,54 @@ def serialize_tagging(episodes, user, subrecords=None):
     """
         Checks if we want to serialise the tagging model and if so
         returns the serialize tagging model, (with history if requested)
+
+        Only the user's own "mine" tags are fetched, other
+        users' "mine" tags are filtered out by the query.
     """
     if subrecords is None or omodels.Tagging in subrecords:
         taggings = {e.id: dict(id=e.id) for e in episodes}
         qs = omodels.Tagging.objects.filter(
-            episode__in=episodes, archived=False
-        )
+            episode_id__in=list(taggings.keys()), archived=False
+        ).filter(
+            ~Q(value='mine') | Q(user=user)
+        ).values_list('episode_id', 'value')
 
-        for tag in qs:
-            if tag.value == 'mine' and tag.user != user:
-                continue
-            taggings[tag.episode_id][tag.value] = True
+        for episode_id, value in qs:
+            taggings[episode_id][value] = True
 
         return taggings
 
 
 @timing
-def serialize(episodes, user, subrecords=None):
+def serialize_patient_related(episodes, patient_related):
+    """
+        serialises models with a patient foreign key that are not
+        subrecords, e.g. BedStatus.
+
+        takes in patient_related, a dict of {key: model} and returns
+        {patient_id: {key: [instance.to_dict()]}} using one query
+        per model rather than one per episode.
+    """
+    if not patient_related:
+        return {}
+    patient_ids = set(i.patient_id for i in episodes)
+    result = {
+        patient_id: {key: [] for key in patient_related}
+        for patient_id in patient_ids
+    }
+    for key, model in patient_related.items():
+        for instance in model.objects.filter(patient_id__in=patient_ids):
+            result[instance.patient_id][key].append(instance.to_dict())
+    return result
+
+
+@timing
+def serialize(episodes, user, subrecords=None, patient_related=None):
     """
     Return a set of serialize EPISODES.
+
+    PATIENT_RELATED is an optional dict of {key: model} of non subrecord
+    models to add to each episode, see serialize_patient_related.
     """
     patient_subs = serialize_patient_subrecords(
         episodes, user, subrecords=subrecords
@@ -126,6 +224,7 @@ def serialize(episodes, user, subrecords=None):
     taggings = serialize_tagging(
         episodes, user, subrecords=subrecords
     )
+    related = serialize_patient_related(episodes, patient_related)
 
     serialize = []
 
@@ -144,5 +243,8 @@ def serialize(episodes, user, subrecords=None):
             tagging_dict = taggings[e.id]
             d[omodels.Tagging.get_api_name()] = [tagging_dict]
 
+        if e.patient_id in related:
+            d.update(related[e.patient_id])
+
         serialize.append(d)
     return serialize
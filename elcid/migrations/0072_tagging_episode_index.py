@@ -0,0 +1,21 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    Tagging is an Opal model so we add the index that patient
+    list tagging serialisation uses with SQL.
+    """
+
+    dependencies = [
+        ('elcid', '0071_merge_20230911_1116'),
+        ('opal', '0040_auto_20201007_1346'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "CREATE INDEX IF NOT EXISTS elcid_tagging_episode_archived_value_user "
+            "ON opal_tagging (episode_id, archived, value, user_id);",
+            reverse_sql="DROP INDEX IF EXISTS elcid_tagging_episode_archived_value_user;"
+        ),
+    ]
@@ -0,0 +1,82 @@
+import logging
+
+from django.db import DatabaseError, migrations, transaction
+
+logger = logging.getLogger('elcid.migrations')
+
+# (index name, table, column) of the fields searched by
+# plugins.elcid_search.elcid_query.ElcidSearchQuery.fuzzy_query
+SEARCH_INDEXES = [
+    ("elcid_demographics_hospital_number_trgm", "elcid_demographics", "hospital_number"),
+    ("elcid_demographics_first_name_trgm", "elcid_demographics", "first_name"),
+    ("elcid_demographics_surname_trgm", "elcid_demographics", "surname"),
+    ("elcid_mergedmrn_mrn_trgm", "elcid_mergedmrn", "mrn"),
+]
+
+
+def create_trgm_extension(schema_editor):
+    """
+    Returns True if the pg_trgm extension is installed, creating it if
+    our database role is allowed to, which usually needs a superuser
+    or the owner of the database.
+    """
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+        )
+        if cursor.fetchone():
+            return True
+    try:
+        # a savepoint so that the rest of the migration can
+        # continue if we are not allowed to create it
+        with transaction.atomic(using=connection.alias):
+            schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except DatabaseError as e:
+        logger.warning(
+            "Unable to create the pg_trgm extension, skipping the search "
+            "indexes. Run CREATE EXTENSION pg_trgm as a superuser and "
+            "re-run this migration to add them. {}".format(e)
+        )
+        return False
+    return True
+
+
+def create_indexes(apps, schema_editor):
+    """
+    Trigram indexes on the upper cased column so that the
+    UPPER(column::text) LIKE UPPER('%query%') that Django uses
+    for icontains on Postgres does not scan the table.
+
+    If pg_trgm cannot be created the indexes are skipped
+    with a warning, search still works but scans the tables.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    if not create_trgm_extension(schema_editor):
+        return
+    for index_name, table, column in SEARCH_INDEXES:
+        schema_editor.execute(
+            "CREATE INDEX IF NOT EXISTS {} ON {} USING gin "
+            "(UPPER({}::text) gin_trgm_ops)".format(index_name, table, column)
+        )
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for index_name, _, _ in SEARCH_INDEXES:
+        schema_editor.execute("DROP INDEX IF EXISTS {}".format(index_name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('elcid', '0072_tagging_episode_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            create_indexes, reverse_code=drop_indexes
+        ),
+    ]
@@ -0,0 +1,280 @@
+"""
+A cache of the serialised episodes shown on patient lists.
+
+Most of the episodes on a list have not changed since the last time
+someone loaded it, so rather than serialising every episode each time
+we cache each episode's serialisation in the "patient_lists" cache
+(see settings.CACHES).
+
+Cache keys include a version for the episode and a version for its
+patient. When a model that is serialised on the list is saved or
+deleted, invalidate_instance (connected to the post_save and post_delete
+signals of those models only, in elcid.apps) gives the episode or patient
+a new version, so the old entries are no longer
+read and expire by themselves. Bed statuses are reloaded from upstream
+in bulk, so plugins.admissions.loader.load_bed_status gives a new
+version to the patients whose bed statuses have changed instead.
+
+A new version is given both when the change is made and again when
+its transaction commits. Until then other requests still read the old
+rows, so anything they cache under the first new version is
+superseded by the second.
+
+Taggings are not cached, the "mine" tag depends on the user and they
+are serialised for the whole list in a single query.
+
+The versions also let clients poll for what has changed on a list,
+serialize_changes stores the state of each episode a client has been
+sent against a token and on the next request with that token only
+returns the episodes that have been added, changed or removed.
+The token is then replaced by a new one.
+"""
+from functools import lru_cache
+import uuid
+
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from opal import models as omodels
+
+from elcid import episode_serialization
+
+CACHE_NAME = "patient_lists"
+CACHE_TIMEOUT = 60 * 60 * 24
+# how long a client can wait between polls before
+# they are sent the whole list again
+SNAPSHOT_TIMEOUT = 60 * 60
+
+
+def get_cache():
+    return caches[CACHE_NAME]
+
+
+def get_patient_version_key(patient_id):
+    return "patient_list:patient:{}".format(patient_id)
+
+
+def get_episode_version_key(episode_id):
+    return "patient_list:episode:{}".format(episode_id)
+
+
+def get_versions(version_keys):
+    """
+    Returns {version key: version}, creating versions
+    for keys that do not have one
+    """
+    cache = get_cache()
+    versions = cache.get_many(version_keys)
+    new_versions = {
+        key: uuid.uuid4().hex for key in version_keys if key not in versions
+    }
+    if new_versions:
+        cache.set_many(new_versions, None)
+        versions.update(new_versions)
+    return versions
+
+
+def new_version(version_key):
+    get_cache().set(version_key, uuid.uuid4().hex, None)
+
+
+def invalidate(version_key):
+    """
+    Gives VERSION_KEY a new version now and again when the
+    current transaction commits, see the module docstring
+    """
+    new_version(version_key)
+    transaction.on_commit(lambda: new_version(version_key))
+
+
+def invalidate_patient(patient_id):
+    invalidate(get_patient_version_key(patient_id))
+
+
+def invalidate_episode(episode_id):
+    invalidate(get_episode_version_key(episode_id))
+
+
+@lru_cache()
+def get_cached_models():
+    """
+    The models serialised on the patient lists that use the cache
+    """
+    # patient_lists imports this module
+    from elcid import patient_lists
+    return set(
+        list(patient_lists.PATIENT_LIST_SUBRECORDS) +
+        list(patient_lists.PATIENT_LIST_RELATED.values()) +
+        [omodels.Episode]
+    ) - {omodels.Tagging}
+
+
+def invalidate_instance(instance):
+    """
+    Invalidates the cached episodes that INSTANCE is serialised with
+    """
+    if instance.__class__ not in get_cached_models():
+        return
+    if isinstance(instance, omodels.Episode):
+        invalidate_episode(instance.id)
+    elif isinstance(instance, omodels.EpisodeSubrecord):
+        invalidate_episode(instance.episode_id)
+    elif instance.patient_id:
+        invalidate_patient(instance.patient_id)
+
+
+def invalidate_patient_list_cache(sender, instance, **kwargs):
+    invalidate_instance(instance)
+
+
+def connect_signals():
+    """
+    Connects invalidation to the models that are cached.
+
+    Receivers are connected per model rather than for every
+    sender so that other models can still be fast deleted.
+
+    The patient related models (e.g. BedStatus) are reloaded from
+    upstream in bulk, so rather than receiving a signal for every
+    row their loaders invalidate the patients whose rows changed.
+    """
+    from elcid import patient_lists
+    related = set(patient_lists.PATIENT_LIST_RELATED.values())
+    for model in get_cached_models() - related:
+        post_save.connect(invalidate_patient_list_cache, sender=model)
+        post_delete.connect(invalidate_patient_list_cache, sender=model)
+
+
+def get_episode_keys(episodes, key_prefix):
+    """
+    Returns {episode id: the cache key of the episode's serialisation}
+    """
+    version_keys = set()
+    for episode in episodes:
+        version_keys.add(get_patient_version_key(episode.patient_id))
+        version_keys.add(get_episode_version_key(episode.id))
+    versions = get_versions(list(version_keys))
+    return {
+        episode.id: "{}:{}:{}:{}".format(
+            key_prefix,
+            episode.id,
+            versions[get_episode_version_key(episode.id)],
+            versions[get_patient_version_key(episode.patient_id)],
+        ) for episode in episodes
+    }
+
+
+def serialize(
+    episodes, user, key_prefix, subrecords, patient_related=None,
+    episode_keys=None, taggings=None
+):
+    """
+    The cached equivalent of episode_serialization.serialize.
+
+    KEY_PREFIX should be unique to the subrecords and patient related
+    models that are serialised.
+
+    TAGGINGS is the result of episode_serialization.serialize_tagging
+    if the caller has already serialised the taggings of the episodes.
+    """
+    cache = get_cache()
+    episodes = list(episodes)
+    if episode_keys is None:
+        episode_keys = get_episode_keys(episodes, key_prefix)
+    cached = cache.get_many([episode_keys[i.id] for i in episodes])
+
+    to_serialize = [i for i in episodes if episode_keys[i.id] not in cached]
+    if to_serialize:
+        serialized = episode_serialization.serialize(
+            to_serialize,
+            user,
+            subrecords=[i for i in subrecords if i is not omodels.Tagging],
+            patient_related=patient_related
+        )
+        serialized = {episode_keys[i["id"]]: i for i in serialized}
+        cache.set_many(serialized, CACHE_TIMEOUT)
+        cached.update(serialized)
+
+    if taggings is None:
+        taggings = episode_serialization.serialize_tagging(
+            episodes, user, subrecords=subrecords
+        )
+
+    result = []
+    for episode in episodes:
+        episode_dict = dict(cached[episode_keys[episode.id]])
+        if taggings:
+            episode_dict[omodels.Tagging.get_api_name()] = [
+                taggings[episode.id]
+            ]
+        result.append(episode_dict)
+    return result
+
+
+def get_snapshot_key(name, token):
+    return "patient_list:snapshot:{}:{}".format(name, token)
+
+
+def serialize_changes(
+    episodes, user, key_prefix, name, token, subrecords, patient_related=None
+):
+    """
+    Returns the changes to the serialised EPISODES since the
+    client was sent TOKEN for the list NAME.
+
+    {
+        "token": the token to send with the next request,
+        "reset": True if the token is unknown or has expired,
+        "episodes": the serialised episodes that are new or have changed,
+        "removed": the ids of the episodes that are no longer on the list
+    }
+
+    If reset is True episodes is the whole list.
+
+    Each token can only be used once, its snapshot is deleted
+    when the next token is issued so that a client polling a list
+    only ever has one snapshot in the cache.
+    """
+    cache = get_cache()
+    episodes = list(episodes)
+    episode_keys = get_episode_keys(episodes, key_prefix)
+    taggings = episode_serialization.serialize_tagging(
+        episodes, user, subrecords=subrecords
+    )
+
+    # The state of an episode as sent to the client
+    state = {}
+    for episode in episodes:
+        tagging = sorted((taggings or {}).get(episode.id, {}).items())
+        state[episode.id] = "{}:{}".format(episode_keys[episode.id], tagging)
+
+    previous = None
+    if token:
+        previous = cache.get(get_snapshot_key(name, token))
+
+    if previous is None:
+        changed = episodes
+        removed = []
+    else:
+        changed = [i for i in episodes if previous.get(i.id) != state[i.id]]
+        removed = [i for i in previous if i not in state]
+
+    if previous is not None:
+        cache.delete(get_snapshot_key(name, token))
+    new_token = uuid.uuid4().hex
+    cache.set(get_snapshot_key(name, new_token), state, SNAPSHOT_TIMEOUT)
+
+    return {
+        "token": new_token,
+        "reset": previous is None,
+        "episodes": serialize(
+            changed,
+            user,
+            key_prefix,
+            subrecords,
+            patient_related=patient_related,
+            episode_keys=episode_keys,
+            taggings=taggings
+        ),
+        "removed": removed,
+    }
@@ -10,9 +10,9 @@ from opal.utils import AbstractBase
 from opal.core.patient_lists import TaggedPatientList, PatientList
 
 from elcid import models
-from elcid.episode_serialization import serialize
+from elcid import patient_list_cache
 from intrahospital_api.models import InitialPatientLoad
-from plugins.labtests.models import Observation
+from plugins.labtests.models import PositiveOrganism
 from plugins.admissions.models import BedStatus
 
 
@@ -27,18 +27,44 @@ PATIENT_LIST_SUBRECORDS = [
     InitialPatientLoad,
 ]
 
+# Models that are not subrecords that we add to each episode
+# in the patient list, {key: model}
+PATIENT_LIST_RELATED = {
+    'bed_statuses': BedStatus,
+}
+
 
 class RfhPatientList(AbstractBase):
     comparator_service = "EpisodeAddedComparator"
     order = 50
 
+    cache_key_prefix = "rfh_patient_list"
+
     def to_dict(self, user):
         qs = super(RfhPatientList, self).get_queryset()
-        episodes = serialize(qs, user, subrecords=PATIENT_LIST_SUBRECORDS)
-        for episode in episodes:
-            statuses = BedStatus.objects.filter(patient_id=episode['demographics'][0]['patient_id'])
-            episode['bed_statuses'] = [s.to_dict() for s in statuses]
-        return episodes
+        return patient_list_cache.serialize(
+            qs,
+            user,
+            self.cache_key_prefix,
+            subrecords=PATIENT_LIST_SUBRECORDS,
+            patient_related=PATIENT_LIST_RELATED
+        )
+
+    def to_dict_changes(self, user, token):
+        """
+        Returns the episodes that have changed since the
+        user was sent TOKEN, see patient_list_cache.serialize_changes
+        """
+        qs = super(RfhPatientList, self).get_queryset()
+        return patient_list_cache.serialize_changes(
+            qs,
+            user,
+            self.cache_key_prefix,
+            self.get_slug(),
+            token,
+            subrecords=PATIENT_LIST_SUBRECORDS,
+            patient_related=PATIENT_LIST_RELATED
+        )
 
 
 class Hepatology(RfhPatientList, TaggedPatientList):
@@ -281,68 +307,34 @@ class OrganismPatientlist(AbstractBase):
     schema = []
     template_name = 'episode_list.html'
     organism_list = True
+    # One of the PositiveOrganism organisms
+    organism = None
 
     def four_months_ago(self):
         return timezone.now() - datetime.timedelta(120)
 
-    def get_observations(self):
-        return Observation.objects.filter(
-            test__test_name__iexact='BLOOD CULTURE'
-        ).filter(
-            observation_name__iexact='Blood Culture'
-        ).filter(
-            test__datetime_ordered__gte=self.four_months_ago()
-        )
-
     @property
     def queryset(self):
-        obs = self.get_observations()
-        qs = omodels.Episode.objects.all()
-        return qs.filter(
-            patient__lab_tests__observation__in=obs
-        ).distinct()
+        patient_ids = PositiveOrganism.objects.filter(
+            organism=self.organism,
+            datetime_ordered__gte=self.four_months_ago()
+        ).values('patient_id')
+        return omodels.Episode.objects.filter(patient_id__in=patient_ids)
 
 
 class CandidaList(OrganismPatientlist, RfhPatientList, PatientList):
     display_name = 'Candida'
-
-    def get_observations(self):
-        qs = super().get_observations()
-        qs = qs.filter(
-            observation_value__icontains='candida'
-        )
-        to_ignore_strings = [
-            "Candida auris NOT isolated",
-            "Candida NOT isolated",
-        ]
-
-        for to_ignore in to_ignore_strings:
-            qs = qs.exclude(observation_value__icontains=to_ignore)
-        return qs
+    organism = PositiveOrganism.CANDIDA
 
 
 class StaphAureusList(OrganismPatientlist, RfhPatientList, PatientList):
     display_name = 'Staphylococcus aureus'
-
-    def get_observations(self):
-        qs = super().get_observations()
-        qs = qs.filter(
-            observation_value__icontains='aureus'
-        )
-        return qs
+    organism = PositiveOrganism.STAPH_AUREUS
 
 
 class EcoliList(OrganismPatientlist, RfhPatientList, PatientList):
     display_name = 'E coli'
-
-    def get_observations(self):
-        qs = super().get_observations()
-        # regex to match the word as there are a bunch of false positives
-        # e.g. Colistin
-        qs = qs.filter(
-            observation_value__iregex='\y{}\y'.format("coli")
-        )
-        return qs
+    organism = PositiveOrganism.E_COLI
 
 
 class BCFBloodstreamInfectionBSI(RfhPatientList, TaggedPatientList):
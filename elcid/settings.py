@@ -210,9 +210,28 @@ API_USER = "needs to be set"
 # this needs to be set to true on prod
 ASYNC_API = False
 
+# when a patient is added, query the upstream databases
+# for their results, demographics, imaging etc in parallel
+INITIAL_LOAD_CONCURRENTLY = True
+
 CELERY_RESULT_BACKEND = 'django-db'
 CELERY_CACHE_BACKEND = 'django-cache'
 
+# "patient_lists" caches the serialised episodes on patient lists, see
+# elcid.patient_list_cache. It is invalidated when records are saved so
+# it must be shared by every process that serves or saves them
+# e.g. redis or memcached. By default nothing is cached and every poll
+# of a patient list for changes is sent the whole list. Configure a
+# shared backend in local_settings to enable it.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'patient_lists': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    },
+}
+
 # if the intrahospital api is prod
 # there 2 databases
 # the hopstial DB does demographics, appointments and ITU
@@ -242,6 +261,23 @@ EPMA_DB = dict(
     view=None
 )
 
+# the prod api keeps a pool of open connections to each upstream db
+# any of these can be overridden for a single db by adding
+# a "pool" dict to its settings e.g. HOSPITAL_DB["pool"]
+UPSTREAM_DB_POOL = dict(
+    min_size=1,
+    max_size=5,
+    max_idle=300,
+    health_check_after=60,
+    timeout=60,
+)
+
+# when querying upstream for rows changed since the last sync, send the
+# MRNs of our patients with the query so that upstream only returns
+# rows for patients in elCID. This requires permission to create
+# temporary tables upstream.
+UPSTREAM_COHORT_FILTER = False
+
 
 # search with external demographics when adding a patient
 ADD_PATIENT_DEMOGRAPHICS = True
@@ -0,0 +1,148 @@
+"""
+Streaming downloads.
+
+Rather than building a whole CSV (or zip) in memory before we
+send it, rows are written to the response as they are generated,
+so a large download does not hold a worker's memory for its length.
+"""
+import csv
+import zipfile
+
+from django.db.models import prefetch_related_objects
+from django.http import FileResponse, StreamingHttpResponse
+
+# The number of rows read from the database at a time
+CHUNK_SIZE = 2000
+
+
+class Echo(object):
+    """
+    A file like object whose write returns what was written
+    so that csv writers can be used to generate lines
+    """
+    def write(self, value):
+        return value
+
+
+class ZipBuffer(object):
+    """
+    An unseekable file like object that zipfile writes to,
+    which is emptied each time the archive is read from it
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def read(self):
+        result = b"".join(self.chunks)
+        self.chunks = []
+        return result
+
+
+def iterator(queryset, *lookups, chunk_size=CHUNK_SIZE):
+    """
+    Iterates over QUERYSET without loading it all into memory,
+    prefetching LOOKUPS for CHUNK_SIZE instances at a time.
+
+    Django does not prefetch for QuerySet.iterator().
+    """
+    chunk = []
+    for instance in queryset.iterator(chunk_size=chunk_size):
+        chunk.append(instance)
+        if len(chunk) == chunk_size:
+            prefetch_related_objects(chunk, *lookups)
+            yield from chunk
+            chunk = []
+    if chunk:
+        prefetch_related_objects(chunk, *lookups)
+        yield from chunk
+
+
+def iter_csv(rows, headers=None):
+    """
+    Yields each of the lists in ROWS as a line of CSV,
+    after HEADERS if they are passed in
+    """
+    writer = csv.writer(Echo())
+    if headers:
+        yield writer.writerow(headers)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def iter_dict_csv(rows):
+    """
+    Yields each of the dicts in ROWS as a line of CSV,
+    using the keys of the first row as the headers
+    """
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return
+    writer = csv.DictWriter(Echo(), fieldnames=first.keys())
+    # DictWriter.writeheader does not return the line before python 3.8
+    yield writer.writerow({i: i for i in first.keys()})
+    yield writer.writerow(first)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def iter_zip(file_name, lines):
+    """
+    Yields the bytes of a zip archive containing a single
+    file FILE_NAME made up of the strings LINES
+    """
+    buffer = ZipBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open(file_name, 'w') as fh:
+            for line in lines:
+                fh.write(line.encode('utf8'))
+                data = buffer.read()
+                if data:
+                    yield data
+    yield buffer.read()
+
+
+def csv_response(file_name, rows, headers=None):
+    """
+    Returns a response that streams ROWS, a list of lists,
+    as a CSV attachment called FILE_NAME
+    """
+    response = StreamingHttpResponse(
+        iter_csv(rows, headers=headers), content_type='text/csv'
+    )
+    response['Content-Disposition'] = f'attachment; filename="{file_name}"'
+    return response
+
+
+def zip_csv_response(file_stem, rows):
+    """
+    Takes in a file_stem and a list of dicts
+    returns a response that streams a file called
+    {file_stem}.zip, which unzips to {file_stem}.csv
+    """
+    response = StreamingHttpResponse(
+        iter_zip(f'{file_stem}.csv', iter_dict_csv(rows)),
+        content_type='application/zip'
+    )
+    response['Content-Disposition'] = f'attachment; filename="{file_stem}.zip"'
+    return response
+
+
+def file_response(file_path, file_name, content_type='text/csv'):
+    """
+    Returns a response that streams the file at FILE_PATH
+    from disk as an attachment called FILE_NAME
+    """
+    return FileResponse(
+        open(file_path, 'rb'),
+        as_attachment=True,
+        filename=file_name,
+        content_type=content_type
+    )
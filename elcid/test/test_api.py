@@ -14,6 +14,7 @@ from django.conf import settings
 
 from elcid import models as emodels
 from elcid import patient_lists
+from plugins.labtests import summaries as lab_summaries
 from elcid.api import (
     UpstreamBloodCultureApi, LabTestResultsView,
     InfectionServiceTestSummaryApi
@@ -370,6 +371,30 @@ class LabTestResultsViewTestCase(OpalTestCase):
             data['tests']['BLOOD CULTURE']['instances'][0]['observations']
         )
 
+    def test_retrieve_from_summaries(self):
+        patient, _ = self.new_patient_and_episode_please()
+        test = patient.lab_tests.create(**{
+            'datetime_ordered': timezone.make_aware(datetime.datetime(2017, 6, 10, 4, 15, 10)),
+            'test_name'       : 'BLOOD CULTURE',
+            'lab_number'      : '121'
+        })
+        test.observation_set.create(**{
+            'observation_name' : 'ORGANISM',
+            'observation_value': 'Staph. Aureus',
+        })
+        api = LabTestResultsView()
+        live = json.loads(
+            api.retrieve(None, pk=patient.id).content.decode('UTF-8')
+        )
+        lab_summaries.rebuild_patient_summaries(patient)
+        with mock.patch.object(
+            lab_summaries.LabTestResultsSerialiser, "serialise_test_type"
+        ) as serialise_test_type:
+            result = api.retrieve(None, pk=patient.id)
+        self.assertFalse(serialise_test_type.called)
+        data = json.loads(result.content.decode('UTF-8'))
+        self.assertEqual(data, live)
+
 
 class UpstreamBloodCultureApiTestCase(OpalTestCase):
     def setUp(self):
@@ -1236,6 +1261,23 @@ class LabTestSummaryTestCase(OpalTestCase):
         }
         self.assertEqual(result.data, expected)
 
+    def test_serialise_lab_tests_query_count(self):
+        some_dts = [
+            timezone.make_aware(datetime.datetime(2019, 6, day, 10, 10))
+            for day in range(1, 11)
+        ]
+        self.create_blood_count(*some_dts)
+        self.create_clotting_screen({i: "1.2" for i in some_dts})
+        self.create_c_reactive_protein({i: "1.0" for i in some_dts})
+        with self.assertNumQueries(6):
+            result = InfectionServiceTestSummaryApi().serialise_lab_tests(
+                self.patient
+            )
+        self.assertEqual(
+            result["recent_dates"], [i.date() for i in some_dts[-5:]]
+        )
+        self.assertEqual(len(result["obs_values"]), 5)
+
     def test_get_procalcitonin(self):
         api = InfectionServiceTestSummaryApi()
 
@@ -1,7 +1,13 @@
+import datetime
+from unittest import mock
+
+from django.contrib.auth.models import User
 from opal.core.test import OpalTestCase
+from opal import models as omodels
 from opal.models import Tagging, Episode
 from elcid import models
 from elcid import episode_serialization
+from plugins.admissions.models import BedStatus
 
 
 class SerialisedTestCase(OpalTestCase):
@@ -182,3 +188,128 @@ class SerialisedTestCase(OpalTestCase):
             result[0]["tagging"][0],
             dict(id=1, something=True)
         )
+
+    def test_serialize_tagging_only_includes_the_users_mine_tags(self):
+        episode = self.create_episode()
+        other_user = User.objects.create(username="other")
+        episode.set_tag_names(['mine', 'something'], other_user)
+        _, other_episode = self.new_patient_and_episode_please()
+        other_episode.set_tag_names(['mine'], self.user)
+        with self.assertNumQueries(1):
+            taggings = episode_serialization.serialize_tagging(
+                [episode, other_episode], self.user
+            )
+        self.assertEqual(taggings, {
+            episode.id: {"id": episode.id, "something": True},
+            other_episode.id: {"id": other_episode.id, "mine": True},
+        })
+
+    def test_serialize_tagging_excludes_archived_tags(self):
+        episode = self.create_episode()
+        episode.set_tag_names(['mine', 'something'], self.user)
+        episode.set_tag_names([], self.user)
+        taggings = episode_serialization.serialize_tagging(
+            [episode], self.user
+        )
+        self.assertEqual(taggings, {episode.id: {"id": episode.id}})
+
+    def test_serialize_patient_related(self):
+        episode = self.create_episode()
+        episode.patient.bedstatus.create(
+            hospital_site_description="ROYAL FREE HOSPITAL", ward_name="8 West"
+        )
+        _, other_episode = self.new_patient_and_episode_please()
+        serialized = episode_serialization.serialize(
+            Episode.objects.all(),
+            self.user,
+            subrecords=[models.Demographics],
+            patient_related={"bed_statuses": BedStatus}
+        )
+        by_id = {i["id"]: i for i in serialized}
+        self.assertEqual(
+            by_id[episode.id]["bed_statuses"][0]["ward"], "8 West"
+        )
+        self.assertEqual(by_id[other_episode.id]["bed_statuses"], [])
+
+    def test_serialize_without_patient_related(self):
+        self.create_episode()
+        serialized = episode_serialization.serialize(
+            Episode.objects.all(), self.user, subrecords=[models.Demographics]
+        )
+        self.assertNotIn("bed_statuses", serialized[0])
+
+
+class SerializeSubrecordValuesTestCase(OpalTestCase):
+    def setUp(self):
+        self.patient, self.episode = self.new_patient_and_episode_please()
+
+    def test_matches_to_dict(self):
+        omodels.Antimicrobial.objects.create(name="Aspirin")
+        antimicrobial = self.episode.antimicrobial_set.create(
+            dose="10mg", start_date=datetime.date(2020, 1, 2)
+        )
+        antimicrobial.drug = "Aspirin"
+        antimicrobial.route = "Some free text"
+        antimicrobial.save()
+        demographics = self.patient.demographics_set.get()
+        demographics.first_name = "Wilma"
+        demographics.date_of_birth = datetime.date(1980, 3, 4)
+        demographics.sex = "Female"
+        demographics.save()
+        for model, qs_args in [
+            (models.Antimicrobial, dict(episode_id__in=[self.episode.id])),
+            (models.Demographics, dict(patient_id__in=[self.patient.id])),
+            (models.Location, dict(episode_id__in=[self.episode.id])),
+        ]:
+            self.assertEqual(
+                episode_serialization.serialize_subrecord_values(
+                    model, qs_args, self.user
+                ),
+                [i.to_dict(self.user) for i in model.objects.filter(**qs_args)]
+            )
+        serialized = episode_serialization.serialize_subrecord_values(
+            models.Antimicrobial,
+            dict(episode_id__in=[self.episode.id]),
+            self.user
+        )[0]
+        self.assertEqual(serialized["drug"], "Aspirin")
+        self.assertEqual(serialized["route"], "Some free text")
+
+    def test_get_serialized_columns(self):
+        columns = dict(
+            episode_serialization.get_serialized_columns(models.Antimicrobial)
+        )
+        self.assertEqual(columns["drug"], ("drug_fk__name", "drug_ft",))
+        self.assertEqual(columns["dose"], ("dose",))
+
+    def test_falls_back_to_to_dict_when_overridden(self):
+        self.assertIsNone(
+            episode_serialization.get_serialized_columns(
+                models.MicrobiologyInput
+            )
+        )
+        with mock.patch.object(
+            models.MicrobiologyInput, "to_dict", return_value={"id": 1}
+        ):
+            self.episode.microbiologyinput_set.create()
+            serialized = episode_serialization.serialize_subrecord_values(
+                models.MicrobiologyInput,
+                dict(episode_id__in=[self.episode.id]),
+                self.user
+            )
+        self.assertEqual(serialized, [{"id": 1}])
+
+    def test_falls_back_to_to_dict_for_getters(self):
+        self.assertIsNone(
+            episode_serialization.get_serialized_columns(
+                models.BloodCultureSet
+            )
+        )
+        self.patient.bloodcultureset_set.create(lab_number="123")
+        serialized = episode_serialization.serialize_subrecord_values(
+            models.BloodCultureSet,
+            dict(patient_id__in=[self.patient.id]),
+            self.user
+        )
+        self.assertEqual(serialized[0]["lab_number"], "123")
+        self.assertEqual(serialized[0]["isolates"], [])
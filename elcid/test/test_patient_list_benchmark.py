@@ -0,0 +1,73 @@
+"""
+Checks that serialising a 500 episode patient list uses
+the same number of queries as a short list
+"""
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from opal.core.test import OpalTestCase
+from opal.models import Episode, Patient
+
+from elcid import episode_serialization
+from elcid import models
+from elcid.patient_lists import PATIENT_LIST_SUBRECORDS, PATIENT_LIST_RELATED
+from plugins.admissions.models import BedStatus
+
+EPISODES = 500
+
+
+class PatientListBenchmarkTestCase(OpalTestCase):
+    def setUp(self):
+        # the test user is created on first access
+        self.user
+        Patient.objects.bulk_create([Patient() for _ in range(EPISODES)])
+        patients = list(Patient.objects.all())
+        Episode.objects.bulk_create([Episode(patient=i) for i in patients])
+        episodes = list(Episode.objects.all())
+        models.Demographics.objects.bulk_create([
+            models.Demographics(
+                patient=i, first_name="Wilma", surname="Flintstone"
+            ) for i in patients
+        ])
+        models.Antimicrobial.objects.bulk_create([
+            models.Antimicrobial(episode=i, drug_ft="Aspirin", dose="10mg")
+            for i in episodes
+        ])
+        models.Location.objects.bulk_create([
+            models.Location(episode=i, ward="8 West", bed="1")
+            for i in episodes
+        ])
+        BedStatus.objects.bulk_create([
+            BedStatus(
+                patient=i,
+                hospital_site_description="ROYAL FREE HOSPITAL",
+                ward_name="8 West"
+            ) for i in patients
+        ])
+
+    def serialize(self, episodes):
+        return episode_serialization.serialize(
+            episodes,
+            self.user,
+            subrecords=PATIENT_LIST_SUBRECORDS,
+            patient_related=PATIENT_LIST_RELATED
+        )
+
+    def test_query_count(self):
+        episodes = list(Episode.objects.all())
+        with CaptureQueriesContext(connection) as small_list:
+            self.serialize(episodes[:5])
+        with CaptureQueriesContext(connection) as large_list:
+            serialized = self.serialize(episodes)
+        self.assertEqual(len(serialized), EPISODES)
+        self.assertEqual(
+            serialized[0]["antimicrobial"][0]["drug"], "Aspirin"
+        )
+        # PATIENT_LIST_SUBRECORDS has 8 models, one query for each of
+        # the 6 subrecords (ChronicAntifungal is not a subrecord so is
+        # not serialised and Tagging is read separately), one for
+        # taggings and one for bed statuses
+        self.assertEqual(len(large_list.captured_queries), 8)
+        self.assertEqual(
+            len(large_list.captured_queries),
+            len(small_list.captured_queries)
+        )
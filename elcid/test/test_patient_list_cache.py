@@ -0,0 +1,374 @@
+from unittest import mock
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models.deletion import Collector
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from opal.core.test import OpalTestCase
+from opal.models import Patient, Tagging
+
+from elcid import models
+from elcid import patient_list_cache
+from elcid.patient_lists import PATIENT_LIST_SUBRECORDS, PATIENT_LIST_RELATED
+from plugins.admissions.models import BedStatus
+from plugins.labtests.models import Observation
+
+
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'patient_lists': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'test_patient_lists',
+    },
+})
+class PatientListCacheTestCase(OpalTestCase):
+    def setUp(self):
+        patient_list_cache.get_cache().clear()
+        self.patient, self.episode = self.new_patient_and_episode_please()
+        self.patient.demographics_set.update(first_name="Wilma")
+        self.other_patient, self.other_episode = self.new_patient_and_episode_please()
+
+    def serialize(self, user=None):
+        return patient_list_cache.serialize(
+            [self.episode, self.other_episode],
+            user or self.user,
+            "test",
+            subrecords=PATIENT_LIST_SUBRECORDS,
+            patient_related=PATIENT_LIST_RELATED
+        )
+
+    def serialized_episode_ids(self):
+        """
+        Returns the ids of the episodes that are serialized
+        by serialize() rather than read from the cache
+        """
+        with mock.patch.object(
+            patient_list_cache.episode_serialization,
+            "serialize",
+            wraps=patient_list_cache.episode_serialization.serialize
+        ) as serialize:
+            self.serialize()
+        if not serialize.called:
+            return []
+        return [i.id for i in serialize.call_args[0][0]]
+
+    def test_serialize(self):
+        result = self.serialize()
+        self.assertEqual(
+            [i["id"] for i in result], [self.episode.id, self.other_episode.id]
+        )
+        self.assertEqual(result[0]["demographics"][0]["first_name"], "Wilma")
+        self.assertEqual(result[0]["bed_statuses"], [])
+        self.assertEqual(result[0]["tagging"], [{"id": self.episode.id}])
+
+    def test_reads_from_the_cache(self):
+        self.serialize()
+        self.assertEqual(self.serialized_episode_ids(), [])
+        self.assertEqual(
+            self.serialize()[0]["demographics"][0]["first_name"], "Wilma"
+        )
+
+    def test_patient_subrecord_invalidates_the_patient(self):
+        self.serialize()
+        demographics = self.patient.demographics()
+        demographics.first_name = "Betty"
+        demographics.save()
+        self.assertEqual(self.serialized_episode_ids(), [self.episode.id])
+        self.assertEqual(
+            self.serialize()[0]["demographics"][0]["first_name"], "Betty"
+        )
+
+    def test_episode_subrecord_invalidates_the_episode(self):
+        self.serialize()
+        self.other_episode.antimicrobial_set.create(drug="Aspirin")
+        self.assertEqual(
+            self.serialized_episode_ids(), [self.other_episode.id]
+        )
+
+    def test_delete_invalidates(self):
+        antimicrobial = self.episode.antimicrobial_set.create(drug="Aspirin")
+        self.serialize()
+        antimicrobial.delete()
+        self.assertEqual(self.serialized_episode_ids(), [self.episode.id])
+        self.assertEqual(self.serialize()[0]["antimicrobial"], [])
+
+    def test_bed_status_does_not_invalidate(self):
+        self.serialize()
+        self.patient.bedstatus.create(
+            hospital_site_description="ROYAL FREE HOSPITAL", ward_name="8 West"
+        )
+        self.assertEqual(self.serialized_episode_ids(), [])
+
+    def test_invalidate_patient(self):
+        self.serialize()
+        self.patient.bedstatus.create(
+            hospital_site_description="ROYAL FREE HOSPITAL", ward_name="8 West"
+        )
+        patient_list_cache.invalidate_patient(self.patient.id)
+        self.assertEqual(self.serialized_episode_ids(), [self.episode.id])
+        self.assertEqual(
+            self.serialize()[0]["bed_statuses"][0]["ward"], "8 West"
+        )
+
+    def test_other_models_do_not_invalidate(self):
+        self.serialize()
+        self.patient.lab_tests.create(test_name="BLOOD CULTURE")
+        self.assertEqual(self.serialized_episode_ids(), [])
+
+    def test_other_models_can_be_fast_deleted(self):
+        self.assertTrue(
+            Collector(using='default').can_fast_delete(
+                Observation.objects.all()
+            )
+        )
+
+    def test_bed_statuses_can_be_fast_deleted(self):
+        self.assertTrue(
+            Collector(using='default').can_fast_delete(
+                BedStatus.objects.all()
+            )
+        )
+
+    def test_taggings_are_not_cached(self):
+        self.serialize()
+        self.episode.set_tag_names(["mine"], self.user)
+        self.assertEqual(self.serialized_episode_ids(), [])
+        self.assertEqual(
+            self.serialize()[0]["tagging"],
+            [{"id": self.episode.id, "mine": True}]
+        )
+        other_user = User.objects.create(username="other")
+        self.assertEqual(
+            self.serialize(other_user)[0]["tagging"],
+            [{"id": self.episode.id}]
+        )
+
+    def test_cached_episodes_do_not_include_taggings(self):
+        self.serialize()
+        cached = patient_list_cache.get_cache().get_many(
+            patient_list_cache.get_episode_keys(
+                [self.episode], "test"
+            ).values()
+        )
+        self.assertNotIn(
+            Tagging.get_api_name(), list(cached.values())[0]
+        )
+
+    def test_versions_are_kept(self):
+        versions = patient_list_cache.get_versions(["a", "b"])
+        self.assertEqual(patient_list_cache.get_versions(["a", "b"]), versions)
+        patient_list_cache.invalidate("a")
+        new_versions = patient_list_cache.get_versions(["a", "b"])
+        self.assertNotEqual(new_versions["a"], versions["a"])
+        self.assertEqual(new_versions["b"], versions["b"])
+
+
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'patient_lists': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'test_patient_lists',
+    },
+})
+class InvalidateOnCommitTestCase(TransactionTestCase):
+    def setUp(self):
+        patient_list_cache.get_cache().clear()
+        self.user = User.objects.create(username="test")
+        self.patient = Patient.objects.create()
+        self.episode = self.patient.create_episode()
+        self.patient.demographics_set.update(first_name="Wilma")
+
+    def serialize(self):
+        return patient_list_cache.serialize(
+            [self.episode],
+            self.user,
+            "test",
+            subrecords=PATIENT_LIST_SUBRECORDS,
+            patient_related=PATIENT_LIST_RELATED
+        )
+
+    def test_read_during_the_transaction_is_not_cached(self):
+        stale = self.serialize()
+        with transaction.atomic():
+            demographics = self.patient.demographics()
+            demographics.first_name = "Betty"
+            demographics.save()
+            # another request that reads the rows before the
+            # transaction commits still sees the old demographics
+            with mock.patch.object(
+                patient_list_cache.episode_serialization,
+                "serialize",
+                return_value=stale
+            ):
+                self.assertEqual(
+                    self.serialize()[0]["demographics"][0]["first_name"],
+                    "Wilma"
+                )
+        self.assertEqual(
+            self.serialize()[0]["demographics"][0]["first_name"], "Betty"
+        )
+
+    def test_rollback(self):
+        self.serialize()
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                demographics = self.patient.demographics()
+                demographics.first_name = "Betty"
+                demographics.save()
+                raise ValueError("rollback")
+        self.assertEqual(
+            self.serialize()[0]["demographics"][0]["first_name"], "Wilma"
+        )
+
+
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'patient_lists': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'test_patient_lists',
+    },
+})
+class SerializeChangesTestCase(OpalTestCase):
+    def setUp(self):
+        patient_list_cache.get_cache().clear()
+        self.patient, self.episode = self.new_patient_and_episode_please()
+        self.other_patient, self.other_episode = self.new_patient_and_episode_please()
+
+    def serialize_changes(self, token, episodes=None, name="test"):
+        if episodes is None:
+            episodes = [self.episode, self.other_episode]
+        return patient_list_cache.serialize_changes(
+            episodes,
+            self.user,
+            "test",
+            name,
+            token,
+            subrecords=PATIENT_LIST_SUBRECORDS,
+            patient_related=PATIENT_LIST_RELATED
+        )
+
+    def test_without_a_token(self):
+        result = self.serialize_changes(None)
+        self.assertTrue(result["reset"])
+        self.assertTrue(result["token"])
+        self.assertEqual(
+            [i["id"] for i in result["episodes"]],
+            [self.episode.id, self.other_episode.id]
+        )
+        self.assertEqual(result["removed"], [])
+
+    def test_unknown_token(self):
+        result = self.serialize_changes("unknown")
+        self.assertTrue(result["reset"])
+        self.assertEqual(len(result["episodes"]), 2)
+
+    def test_token_from_another_list(self):
+        token = self.serialize_changes(None, name="other")["token"]
+        self.assertTrue(self.serialize_changes(token)["reset"])
+
+    def test_nothing_changed(self):
+        token = self.serialize_changes(None)["token"]
+        result = self.serialize_changes(token)
+        self.assertFalse(result["reset"])
+        self.assertNotEqual(result["token"], token)
+        self.assertEqual(result["episodes"], [])
+        self.assertEqual(result["removed"], [])
+
+    def test_changed(self):
+        token = self.serialize_changes(None)["token"]
+        self.other_episode.antimicrobial_set.create(drug="Aspirin")
+        result = self.serialize_changes(token)
+        self.assertEqual(
+            [i["id"] for i in result["episodes"]], [self.other_episode.id]
+        )
+        self.assertEqual(
+            result["episodes"][0]["antimicrobial"][0]["drug"], "Aspirin"
+        )
+
+    def test_bed_status_changed(self):
+        token = self.serialize_changes(None)["token"]
+        self.patient.bedstatus.create(
+            hospital_site_description="ROYAL FREE HOSPITAL", ward_name="8 West"
+        )
+        patient_list_cache.invalidate_patient(self.patient.id)
+        result = self.serialize_changes(token)
+        self.assertEqual(
+            [i["id"] for i in result["episodes"]], [self.episode.id]
+        )
+
+    def test_tagging_changed(self):
+        token = self.serialize_changes(None)["token"]
+        self.episode.set_tag_names(["mine"], self.user)
+        result = self.serialize_changes(token)
+        self.assertEqual(
+            [i["id"] for i in result["episodes"]], [self.episode.id]
+        )
+        self.assertEqual(
+            result["episodes"][0]["tagging"],
+            [{"id": self.episode.id, "mine": True}]
+        )
+
+    def test_taggings_are_serialized_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            result = self.serialize_changes(None)
+        tagging_queries = [
+            i for i in queries.captured_queries if "opal_tagging" in i["sql"]
+        ]
+        self.assertEqual(len(tagging_queries), 1)
+        self.assertEqual(
+            result["episodes"][0]["tagging"], [{"id": self.episode.id}]
+        )
+
+    def test_added_and_removed(self):
+        token = self.serialize_changes(None, episodes=[self.episode])["token"]
+        result = self.serialize_changes(token, episodes=[self.other_episode])
+        self.assertEqual(
+            [i["id"] for i in result["episodes"]], [self.other_episode.id]
+        )
+        self.assertEqual(result["removed"], [self.episode.id])
+
+    def test_tokens_are_used_once(self):
+        token = self.serialize_changes(None)["token"]
+        new_token = self.serialize_changes(token)["token"]
+        self.assertIsNone(patient_list_cache.get_cache().get(
+            patient_list_cache.get_snapshot_key("test", token)
+        ))
+        self.assertIsNotNone(patient_list_cache.get_cache().get(
+            patient_list_cache.get_snapshot_key("test", new_token)
+        ))
+        self.assertTrue(self.serialize_changes(token)["reset"])
+
+
+class DefaultCacheTestCase(OpalTestCase):
+    def test_nothing_is_cached_by_default(self):
+        _, episode = self.new_patient_and_episode_please()
+        patient_list_cache.serialize(
+            [episode], self.user, "test", subrecords=[models.Demographics]
+        )
+        with mock.patch.object(
+            patient_list_cache.episode_serialization, "serialize"
+        ) as serialize:
+            serialize.return_value = [{"id": episode.id}]
+            patient_list_cache.serialize(
+                [episode], self.user, "test", subrecords=[models.Demographics]
+            )
+        self.assertTrue(serialize.called)
+
+    def test_changes_reset_by_default(self):
+        _, episode = self.new_patient_and_episode_please()
+        token = patient_list_cache.serialize_changes(
+            [episode], self.user, "test", "test", None,
+            subrecords=[models.Demographics]
+        )["token"]
+        result = patient_list_cache.serialize_changes(
+            [episode], self.user, "test", "test", token,
+            subrecords=[models.Demographics]
+        )
+        self.assertTrue(result["reset"])
+        self.assertEqual(len(result["episodes"]), 1)
@@ -2,7 +2,9 @@ import datetime
 import json
 from unittest import mock
 
+from django.db import connection
 from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from rest_framework.reverse import reverse as drf_reverse
@@ -18,6 +20,7 @@ from opal.models import (
 from elcid import models
 from elcid import episode_categories
 from elcid import patient_lists
+from plugins.labtests.models import PositiveOrganism
 from plugins.tb import models as tb_models
 
 
@@ -187,6 +190,41 @@ class TestPatientList(AbstractPatientListTestCase):
         )
 
 
+class RfhPatientListTestCase(AbstractPatientListTestCase):
+    def tag_episode(self):
+        episode = self.create_episode()
+        episode.set_tag_names([patient_lists.Hepatology.tag], self.user)
+        return episode
+
+    def test_to_dict_bed_statuses(self):
+        episode = self.tag_episode()
+        episode.patient.bedstatus.create(
+            hospital_site_description="ROYAL FREE HOSPITAL", ward_name="8 West"
+        )
+        other_episode = self.tag_episode()
+        result = patient_lists.Hepatology().to_dict(self.user)
+        by_id = {i["id"]: i for i in result}
+        self.assertEqual(
+            by_id[episode.id]["bed_statuses"][0]["ward"], "8 West"
+        )
+        self.assertEqual(by_id[other_episode.id]["bed_statuses"], [])
+
+    def test_to_dict_queries_do_not_grow_with_the_list(self):
+        self.tag_episode().patient.bedstatus.create(
+            hospital_site_description="ROYAL FREE HOSPITAL", ward_name="8 West"
+        )
+        patient_list = patient_lists.Hepatology()
+        with CaptureQueriesContext(connection) as one_episode:
+            patient_list.to_dict(self.user)
+        for _ in range(3):
+            self.tag_episode().patient.bedstatus.create(
+                hospital_site_description="ROYAL FREE HOSPITAL",
+                ward_name="8 West"
+            )
+        with self.assertNumQueries(len(one_episode)):
+            patient_list.to_dict(self.user)
+
+
 class ChronicAntifungalTestCase(OpalTestCase):
     def setUp(self):
         self.patient, self.episode = self.new_patient_and_episode_please()
@@ -237,65 +275,81 @@ class OrganismPatientlistTestCase(OpalTestCase):
                 )
             )
 
-    def test_get_observations_only_includes_blood_cultures(self):
+    def test_queryset_only_includes_blood_cultures(self):
+        self.patient_list.organism = PositiveOrganism.STAPH_AUREUS
         lab_test_1 = self.patient.lab_tests.create(
             test_name="BLOOD CULTURE",
             datetime_ordered=timezone.now(),
-            patient=self.patient
         )
-        observation = lab_test_1.observation_set.create(
+        lab_test_1.observation_set.create(
             observation_name="Blood Culture",
+            observation_value="Staphylococcus aureus"
         )
+        PositiveOrganism.update_for_lab_tests([lab_test_1])
         patient2, _ = self.new_patient_and_episode_please()
         lab_test_2 = patient2.lab_tests.create(
             test_name="NOT BLOOD CULTURE",
             datetime_ordered=timezone.now(),
-            patient=self.patient
         )
         lab_test_2.observation_set.create(
             observation_name="Blood Culture",
+            observation_value="Staphylococcus aureus"
         )
+        PositiveOrganism.update_for_lab_tests([lab_test_2])
 
         patient3, _ = self.new_patient_and_episode_please()
-        lab_test_3 = patient2.lab_tests.create(
+        lab_test_3 = patient3.lab_tests.create(
             test_name="BLOOD CULTURE",
             datetime_ordered=timezone.now(),
-            patient=self.patient
         )
         lab_test_3.observation_set.create(
             observation_name="Not Blood Culture",
+            observation_value="Staphylococcus aureus"
         )
+        PositiveOrganism.update_for_lab_tests([lab_test_3])
         self.assertEqual(
-            self.patient_list.get_observations().get().id,
-            observation.id
+            self.patient_list.queryset.get().id,
+            self.episode.id
         )
 
-    def test_queryset(self):
+    def test_queryset_excludes_old_tests(self):
+        self.patient_list.organism = PositiveOrganism.STAPH_AUREUS
         lab_test = self.patient.lab_tests.create(
             test_name="BLOOD CULTURE",
-            datetime_ordered=timezone.now(),
-            patient=self.patient
+            datetime_ordered=timezone.now() - datetime.timedelta(121),
         )
         lab_test.observation_set.create(
             observation_name="Blood Culture",
+            observation_value="Staphylococcus aureus"
         )
-        self.assertEqual(
-            self.patient_list.queryset.get().id,
-            self.episode.id
-        )
+        PositiveOrganism.update_for_lab_tests([lab_test])
+        self.assertFalse(self.patient_list.queryset.exists())
 
-    def test_queryset_distinct(self):
+    def test_queryset_only_includes_the_organism(self):
+        self.patient_list.organism = PositiveOrganism.CANDIDA
         lab_test = self.patient.lab_tests.create(
             test_name="BLOOD CULTURE",
             datetime_ordered=timezone.now(),
-            patient=self.patient
-        )
-        lab_test.observation_set.create(
-            observation_name="Blood Culture",
         )
         lab_test.observation_set.create(
             observation_name="Blood Culture",
+            observation_value="Staphylococcus aureus"
         )
+        PositiveOrganism.update_for_lab_tests([lab_test])
+        self.assertFalse(self.patient_list.queryset.exists())
+
+    def test_queryset_distinct(self):
+        self.patient_list.organism = PositiveOrganism.STAPH_AUREUS
+        for _ in range(2):
+            lab_test = self.patient.lab_tests.create(
+                test_name="BLOOD CULTURE",
+                datetime_ordered=timezone.now(),
+            )
+            lab_test.observation_set.create(
+                observation_name="Blood Culture",
+                observation_value="Staphylococcus aureus"
+            )
+            PositiveOrganism.update_for_lab_tests([lab_test])
         self.assertEqual(
             self.patient_list.queryset.get().id,
             self.episode.id
@@ -317,6 +371,7 @@ class CandidaTestCase(OpalTestCase):
             observation_name="Blood Culture",
             observation_value="candida"
         )
+        PositiveOrganism.update_for_lab_tests([lab_test])
         self.assertEqual(
             self.patient_list.queryset.get().id,
             self.episode.id
@@ -332,6 +387,7 @@ class CandidaTestCase(OpalTestCase):
             observation_name="Blood Culture",
             observation_value="something else"
         )
+        PositiveOrganism.update_for_lab_tests([lab_test])
         self.assertFalse(self.patient_list.queryset.exists())
 
     def test_get_queryset_ignores_strings(self):
@@ -344,6 +400,7 @@ class CandidaTestCase(OpalTestCase):
             observation_name="Blood Culture",
             observation_value="Candida NOT isolatede"
         )
+        PositiveOrganism.update_for_lab_tests([lab_test])
         self.assertFalse(self.patient_list.queryset.exists())
 
 
@@ -362,6 +419,7 @@ class StaphAureusListListTestCase(OpalTestCase):
             observation_name="Blood Culture",
             observation_value="1) Staphylococcus aureus"
         )
+        PositiveOrganism.update_for_lab_tests([lab_test])
         self.assertEqual(
             self.patient_list.queryset.get().id,
             self.episode.id
@@ -377,4 +435,38 @@ class StaphAureusListListTestCase(OpalTestCase):
             observation_name="Blood Culture",
             observation_value="Staphylococcus hominis"
         )
+        PositiveOrganism.update_for_lab_tests([lab_test])
+        self.assertFalse(self.patient_list.queryset.exists())
+
+
+class EcoliListTestCase(OpalTestCase):
+    def setUp(self):
+        self.patient, self.episode = self.new_patient_and_episode_please()
+        self.patient_list = patient_lists.EcoliList()
+
+    def test_get_queryset_includes_e_coli(self):
+        lab_test = self.patient.lab_tests.create(
+            test_name="BLOOD CULTURE",
+            datetime_ordered=timezone.now(),
+        )
+        lab_test.observation_set.create(
+            observation_name="Blood Culture",
+            observation_value="1) Escherichia coli"
+        )
+        PositiveOrganism.update_for_lab_tests([lab_test])
+        self.assertEqual(
+            self.patient_list.queryset.get().id,
+            self.episode.id
+        )
+
+    def test_get_queryset_excludes_colistin(self):
+        lab_test = self.patient.lab_tests.create(
+            test_name="BLOOD CULTURE",
+            datetime_ordered=timezone.now(),
+        )
+        lab_test.observation_set.create(
+            observation_name="Blood Culture",
+            observation_value="Colistin sensitive"
+        )
+        PositiveOrganism.update_for_lab_tests([lab_test])
         self.assertFalse(self.patient_list.queryset.exists())
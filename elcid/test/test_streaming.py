@@ -0,0 +1,104 @@
+import io
+import os
+import tempfile
+import zipfile
+
+from opal.core.test import OpalTestCase
+from opal.models import Patient
+
+from elcid import streaming
+
+
+class IteratorTestCase(OpalTestCase):
+    def test_iterator(self):
+        for hospital_number in ["1", "2", "3"]:
+            patient, _ = self.new_patient_and_episode_please()
+            patient.demographics_set.update(hospital_number=hospital_number)
+        patients = Patient.objects.order_by("id")
+        # the patients, then the demographics of each chunk
+        with self.assertNumQueries(3):
+            result = [
+                i.demographics_set.all()[0].hospital_number
+                for i in streaming.iterator(
+                    patients, "demographics_set", chunk_size=2
+                )
+            ]
+        self.assertEqual(result, ["1", "2", "3"])
+
+
+class IterCsvTestCase(OpalTestCase):
+    def test_iter_csv(self):
+        result = list(streaming.iter_csv(
+            [[1, "a,b"], [2, "c"]], headers=["id", "name"]
+        ))
+        self.assertEqual(result, ['id,name\r\n', '1,"a,b"\r\n', '2,c\r\n'])
+
+    def test_iter_csv_without_headers(self):
+        self.assertEqual(list(streaming.iter_csv([[1]])), ['1\r\n'])
+
+    def test_iter_csv_is_lazy(self):
+        def rows():
+            yield [1]
+            raise ValueError("should not be reached")
+        result = streaming.iter_csv(rows())
+        self.assertEqual(next(result), '1\r\n')
+
+
+class IterDictCsvTestCase(OpalTestCase):
+    def test_iter_dict_csv(self):
+        result = list(streaming.iter_dict_csv(
+            [{"id": 1, "name": "a"}, {"id": 2, "name": "b"}]
+        ))
+        self.assertEqual(result, ['id,name\r\n', '1,a\r\n', '2,b\r\n'])
+
+    def test_empty(self):
+        self.assertEqual(list(streaming.iter_dict_csv([])), [])
+
+
+class IterZipTestCase(OpalTestCase):
+    def test_iter_zip(self):
+        lines = ["line {}\n".format(i) for i in range(1000)]
+        data = b"".join(streaming.iter_zip("some.csv", lines))
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            self.assertEqual(archive.namelist(), ["some.csv"])
+            self.assertEqual(
+                archive.read("some.csv").decode("utf8"), "".join(lines)
+            )
+
+
+class ResponseTestCase(OpalTestCase):
+    def test_csv_response(self):
+        response = streaming.csv_response("some.csv", [[1]], headers=["id"])
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertEqual(
+            response["Content-Disposition"], 'attachment; filename="some.csv"'
+        )
+        self.assertEqual(
+            b"".join(response.streaming_content), b"id\r\n1\r\n"
+        )
+
+    def test_zip_csv_response(self):
+        response = streaming.zip_csv_response("some", [{"id": 1}])
+        self.assertEqual(response["Content-Type"], "application/zip")
+        self.assertEqual(
+            response["Content-Disposition"], 'attachment; filename="some.zip"'
+        )
+        data = b"".join(response.streaming_content)
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            self.assertEqual(archive.read("some.csv"), b"id\r\n1\r\n")
+
+    def test_file_response(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "extract.csv")
+            with open(file_path, "w") as fh:
+                fh.write("id\n1\n")
+            response = streaming.file_response(file_path, "some.csv")
+            self.assertEqual(
+                response["Content-Disposition"],
+                'attachment; filename="some.csv"'
+            )
+            self.assertEqual(
+                b"".join(response.streaming_content), b"id\n1\n"
+            )
+            response.close()
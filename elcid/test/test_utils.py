@@ -92,6 +92,50 @@ class FindPatientsFromMRNsTestCase(OpalTestCase):
         self.assertEqual(result, {})
 
 
+class GetMRNToPatientIdTestCase(OpalTestCase):
+    def test_get_mrn_to_patient_id(self):
+        patient, _ = self.new_patient_and_episode_please()
+        patient.demographics_set.update(hospital_number="123")
+        patient.mergedmrn_set.create(mrn="456")
+        # patients without hospital numbers are ignored
+        self.new_patient_and_episode_please()
+        with self.assertNumQueries(2):
+            result = utils.get_mrn_to_patient_id()
+        self.assertEqual(result, {"123": patient.id, "456": patient.id})
+
+    def test_hospital_numbers_take_precedence(self):
+        patient, _ = self.new_patient_and_episode_please()
+        patient.demographics_set.update(hospital_number="123")
+        other, _ = self.new_patient_and_episode_please()
+        other.mergedmrn_set.create(mrn="123")
+        self.assertEqual(utils.get_mrn_to_patient_id(), {"123": patient.id})
+
+    def test_find_patient_ids_from_mrns(self):
+        result = utils.find_patient_ids_from_mrns(
+            ["123", "0456", "789", "", None, "000"],
+            {"123": 1, "456": 2}
+        )
+        self.assertEqual(result, {"123": 1, "0456": 2})
+
+
+class GetCohortMRNsTestCase(OpalTestCase):
+    def test_get_cohort_mrns(self):
+        patient, _ = self.new_patient_and_episode_please()
+        patient.demographics_set.update(hospital_number="123")
+        patient.mergedmrn_set.create(mrn="456")
+        self.assertEqual(utils.get_cohort_mrns(), {"123", "456"})
+
+    def test_strips_leading_zeros(self):
+        patient, _ = self.new_patient_and_episode_please()
+        patient.demographics_set.update(hospital_number="000123")
+        patient.mergedmrn_set.create(mrn="000")
+        self.assertEqual(utils.get_cohort_mrns(), {"123"})
+
+    def test_ignores_empty_hospital_numbers(self):
+        self.new_patient_and_episode_please()
+        self.assertEqual(utils.get_cohort_mrns(), set())
+
+
 @patch('elcid.utils.send_mail')
 @patch('elcid.utils.logger')
 @override_settings(
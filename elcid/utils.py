@@ -132,6 +132,68 @@ def find_patients_from_mrns(mrns):
     return result
 
 
+def get_mrn_to_patient_id():
+    """
+    Returns a dictionary of {mrn: patient id} for every
+    hospital number and merged MRN in elCID.
+
+    This loads the whole cohort in two queries so that callers
+    matching large numbers of upstream MRNs, e.g. the lab test
+    delta, can do so in memory with find_patient_ids_from_mrns.
+
+    As with find_patients_from_mrns hospital numbers take
+    precedence over merged MRNs.
+    """
+    result = dict(models.MergedMRN.objects.values_list('mrn', 'patient_id'))
+    result.update(models.Demographics.objects.exclude(
+        hospital_number=''
+    ).exclude(
+        hospital_number=None
+    ).values_list('hospital_number', 'patient_id'))
+    return result
+
+
+def find_patient_ids_from_mrns(mrns, mrn_to_patient_id):
+    """
+    Takes in an iterable of upstream MRNs and the result of
+    get_mrn_to_patient_id and returns a dictionary of
+    {mrn: patient id}.
+
+    MRNs are matched in the same way as find_patients_from_mrns,
+    ignoring leading zeros, and MRNs that do not match a patient
+    are silently ignored.
+    """
+    result = {}
+    for mrn in mrns:
+        if not mrn:
+            continue
+        patient_id = mrn_to_patient_id.get(mrn.strip().lstrip('0'))
+        if patient_id is not None:
+            result[mrn] = patient_id
+    return result
+
+
+def get_cohort_mrns():
+    """
+    Returns the set of MRNs of patients in elCID, ie
+    their hospital numbers and merged MRNs.
+
+    Upstream MRNs can be prefixed with zeros so MRNs are returned
+    without leading zeros and queries compare them to upstream
+    MRNs without theirs, see prod_api.IN_COHORT.
+    """
+    mrns = set(models.Demographics.objects.exclude(
+        hospital_number=''
+    ).values_list('hospital_number', flat=True))
+    mrns.update(
+        models.MergedMRN.objects.values_list('mrn', flat=True)
+    )
+    mrns.discard(None)
+    result = {mrn.strip().lstrip('0') for mrn in mrns}
+    result.discard('')
+    return result
+
+
 def send_email(subject, body, html_message=None):
     """
     Sends an email to the admins prefixing the subject with
@@ -78,3 +78,4 @@ admin.site.register(rmodels.Version, admin.ModelAdmin)
 admin.site.register(rmodels.Revision, admin.ModelAdmin)
 admin.site.unregister(imodels.InitialPatientLoad)
 admin.site.register(imodels.InitialPatientLoad, InitialPatientLoadAdmin)
+admin.site.register(imodels.SyncCursor, admin.ModelAdmin)
@@ -21,9 +21,10 @@ class BaseApi(object):
             "Please a method that get's all raw data about a patient"
         )
 
-    def data_deltas(self, some_datetime):
+    def data_deltas(self, some_datetime, mrn_to_patient_id=None):
         """ All data (ie demographics/upstream lab tests) about a patient
-            since the datetime
+            since the datetime, for patients in MRN_TO_PATIENT_ID
+            (see elcid.utils.get_mrn_to_patient_id)
         """
         raise NotImplementedError(
             "Please a method that gets the data that has changed for a patient"
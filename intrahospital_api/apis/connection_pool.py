@@ -0,0 +1,280 @@
+"""
+Pools of persistent connections to the upstream SQL Server databases.
+
+Opening a TDS session means a TCP connection, a TLS handshake and a login,
+which costs far more than most of the queries we send. Rather than
+connecting per query we keep a small pool of open connections per
+upstream database (hospital, trust, warehouse, EPMA) and hand them out
+to the ProdApi.
+
+Pools are configured with settings.UPSTREAM_DB_POOL, which can be
+overridden per database with a "pool" key on the database settings
+e.g. HOSPITAL_DB["pool"] = {"max_size": 10}
+"""
+from contextlib import contextmanager
+import os
+import threading
+import time
+
+from django.conf import settings
+import pytds
+from pytds.tds import OperationalError, ClosedConnectionError
+
+from intrahospital_api import logger
+
+
+DEFAULT_POOL_SETTINGS = dict(
+    # the number of idle connections we keep open regardless of idle time
+    min_size=1,
+    # the maximum number of connections open to the database at once
+    max_size=5,
+    # close idle connections after this many seconds
+    max_idle=300,
+    # check a connection is still alive with a SELECT 1 if it has been
+    # idle for more than this many seconds
+    health_check_after=60,
+    # how long to wait for a free connection before raising PoolTimeout
+    timeout=60,
+)
+
+# Errors that mean the connection itself is no longer usable
+CONNECTION_ERRORS = (OperationalError, ClosedConnectionError, OSError,)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def get_pool_settings(db_settings):
+    pool_settings = dict(DEFAULT_POOL_SETTINGS)
+    pool_settings.update(getattr(settings, "UPSTREAM_DB_POOL", {}))
+    pool_settings.update(db_settings.get("pool") or {})
+    return pool_settings
+
+
+class ConnectionPool(object):
+    def __init__(
+        self,
+        db_settings,
+        min_size,
+        max_size,
+        max_idle,
+        health_check_after,
+        timeout
+    ):
+        self.db_settings = db_settings
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.health_check_after = health_check_after
+        self.timeout = timeout
+
+        # (connection, time last returned to the pool)
+        # the most recently used connections are at the end
+        self.idle = []
+        self.size = 0
+        self.condition = threading.Condition()
+
+    def __str__(self):
+        return "{}/{}".format(
+            self.db_settings["ip_address"], self.db_settings["database"]
+        )
+
+    def connect(self):
+        logger.info("Opening upstream connection to {}".format(self))
+        return pytds.connect(
+            self.db_settings["ip_address"],
+            self.db_settings["database"],
+            self.db_settings["username"],
+            self.db_settings["password"],
+            as_dict=True
+        )
+
+    def close_connection(self, conn):
+        try:
+            conn.close()
+        except Exception as e:
+            logger.info("Error closing upstream connection to {} {}".format(
+                self, e
+            ))
+
+    def is_healthy(self, conn):
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+                cur.fetchall()
+            conn.rollback()
+        except CONNECTION_ERRORS as e:
+            logger.info("Upstream connection to {} failed health check {}".format(
+                self, e
+            ))
+            return False
+        return True
+
+    def evict_idle(self):
+        """
+        Close connections that have been idle for longer than max_idle
+        leaving at least min_size connections open.
+
+        Expects to be called with the condition held.
+        """
+        now = time.monotonic()
+        while len(self.idle) > self.min_size:
+            conn, last_used = self.idle[0]
+            if now - last_used < self.max_idle:
+                break
+            self.idle.pop(0)
+            self.size -= 1
+            self.close_connection(conn)
+
+    def take_idle(self):
+        """
+        Removes the most recently used idle connection from the pool
+        returning (connection, time last returned to the pool), or None.
+
+        Expects to be called with the condition held.
+        """
+        self.evict_idle()
+        if not self.idle:
+            return
+        return self.idle.pop()
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self.condition:
+                while True:
+                    idle = self.take_idle()
+                    if idle is not None:
+                        break
+                    if self.size < self.max_size:
+                        self.size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(
+                            "Unable to get a connection to {} within {}s".format(
+                                self, self.timeout
+                            )
+                        )
+                    self.condition.wait(remaining)
+
+            if idle is None:
+                break
+
+            # Health checks are a round trip upstream so are run outside
+            # of the lock, the connection still counts towards size
+            conn, last_used = idle
+            if time.monotonic() - last_used <= self.health_check_after:
+                return conn
+            if self.is_healthy(conn):
+                return conn
+            self.close_connection(conn)
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+
+        # Connect outside of the lock so that other threads can
+        # use idle connections while we are logging in
+        try:
+            return self.connect()
+        except Exception:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, conn, discard=False):
+        """
+        Return a connection to the pool, if discard is True
+        or we cannot reset the connection then close it.
+        """
+        if not discard:
+            try:
+                # end any transaction opened by the last query
+                conn.rollback()
+            except CONNECTION_ERRORS:
+                discard = True
+
+        with self.condition:
+            if discard:
+                self.size -= 1
+                self.close_connection(conn)
+            else:
+                self.idle.append((conn, time.monotonic(),))
+            self.evict_idle()
+            self.condition.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Yields a connection from the pool.
+
+        Connections that raise a connection error are closed
+        rather than returned to the pool.
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+        except CONNECTION_ERRORS:
+            self.release(conn, discard=True)
+            raise
+        except Exception:
+            self.release(conn)
+            raise
+        except BaseException:
+            # e.g. a generator reading from the connection was closed
+            # part way through a result set, the connection still has
+            # unread rows so cannot be reused
+            self.release(conn, discard=True)
+            raise
+        else:
+            self.release(conn)
+
+    def clear(self):
+        """
+        Close all idle connections, used when we think the upstream
+        database has dropped our connections.
+        """
+        with self.condition:
+            while self.idle:
+                conn, _ = self.idle.pop()
+                self.size -= 1
+                self.close_connection(conn)
+            self.condition.notify_all()
+
+
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_settings):
+    """
+    Returns the pool for the database described by the db settings
+    e.g. settings.HOSPITAL_DB, creating it if necessary.
+
+    Pools are per process, connections are not shared with processes
+    that are forked after they are opened.
+    """
+    global _pools, _pools_pid
+    key = (
+        db_settings["ip_address"],
+        db_settings["database"],
+        db_settings["username"],
+    )
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _pools = {}
+            _pools_pid = os.getpid()
+        if key not in _pools:
+            _pools[key] = ConnectionPool(
+                db_settings, **get_pool_settings(db_settings)
+            )
+        return _pools[key]
+
+
+def close_all():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.clear()
@@ -486,5 +486,5 @@ class DevApi(base_api.BaseApi):
     def raw_data(self, hospital_number, **filter_kwargs):
         return [RAW_TEST_DATA]
 
-    def data_deltas(self, some_datetime):
+    def data_deltas(self, some_datetime, mrn_to_patient_id=None):
         return []
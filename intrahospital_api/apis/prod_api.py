@@ -2,26 +2,35 @@
 API for production
 """
 from collections import defaultdict
-from functools import wraps
+from functools import lru_cache, wraps
+import itertools
 import time
 
 from django.conf import settings
 from django.utils import timezone
-import pytds
 from pytds.tds import OperationalError
 
 from elcid.models import (
     Demographics, ContactInformation, NextOfKinDetails, GPDetails,
     MasterFileMeta, MergedMRN
 )
-from elcid.utils import timing
-from intrahospital_api.apis import base_api
+from elcid.utils import (
+    timing, get_cohort_mrns, get_mrn_to_patient_id, find_patient_ids_from_mrns
+)
+from intrahospital_api.apis import base_api, connection_pool
 from intrahospital_api import logger
 from intrahospital_api.constants import EXTERNAL_SYSTEM
 
 # if we fail in a query, the amount of seconds we wait before retrying
 RETRY_DELAY = 30
 
+# The number of rows we read from the cursor at a time when streaming
+STREAM_CHUNK_SIZE = 5000
+
+# The number of MRNs we send in a single IN query, SQL Server
+# allows a maximum of 2100 parameters per query
+MRN_CHUNK_SIZE = 500
+
 PATIENT_MASTERFILE_VIEW = "VIEW_CRS_Patient_Masterfile"
 
 PATHOLOGY_DEMOGRAPHICS_QUERY = "SELECT top(1) * FROM {view} WHERE Patient_Number = \
@@ -45,8 +54,33 @@ ALL_DATA_QUERY_WITH_LAB_NUMBER = "SELECT * FROM {view} WHERE Patient_Number = \
 ALL_DATA_QUERY_WITH_LAB_TEST_TYPE = "SELECT * FROM {view} WHERE Patient_Number = \
 @hospital_number AND OBR_exam_code_Text = @test_type ORDER BY date_inserted DESC;"
 
+ALL_DATA_QUERY_FOR_HOSPITAL_NUMBERS = "SELECT * FROM {view} WHERE Patient_Number \
+IN ({{mrns}}) ORDER BY date_inserted DESC;"
+
 ALL_DATA_SINCE = "SELECT * FROM {view} WHERE date_inserted > @since ORDER BY Patient_Number, date_inserted DESC;"
 
+# A temporary table of the MRNs of the patients in elCID that cohort
+# queries join on so that upstream only returns rows for our patients
+CREATE_COHORT_TABLE = """
+IF OBJECT_ID('tempdb..#elcid_cohort') IS NOT NULL DROP TABLE #elcid_cohort;
+CREATE TABLE #elcid_cohort (
+    mrn VARCHAR(255) COLLATE DATABASE_DEFAULT PRIMARY KEY
+);
+"""
+
+INSERT_COHORT_MRNS = "INSERT INTO #elcid_cohort (mrn) VALUES {values};"
+
+# #elcid_cohort holds MRNs without their leading zeros so upstream
+# MRNs are matched without theirs, however many there are, in the
+# same way as lstrip('0'). The '.' means an MRN of only zeros is ''.
+IN_COHORT = "SUBSTRING({mrn}, PATINDEX('%[^0]%', {mrn} + '.'), LEN({mrn}) + 1) \
+IN (SELECT mrn FROM #elcid_cohort)"
+
+ALL_DATA_SINCE_FOR_COHORT = "SELECT * FROM {{view}} WHERE date_inserted > @since \
+AND {in_cohort} ORDER BY Patient_Number, date_inserted DESC;".format(
+    in_cohort=IN_COHORT.format(mrn="Patient_Number")
+)
+
 
 ETHNICITY_MAPPING = {
     "99": "Other - Not Known",
@@ -83,7 +117,39 @@ def to_datetime_str(some_datetime):
         so we need to convert all datetimes into strings
     """
     if some_datetime:
-        return some_datetime.strftime(settings.DATETIME_INPUT_FORMATS[0])
+        return _format_datetime(
+            some_datetime, settings.DATETIME_INPUT_FORMATS[0]
+        )
+
+
+@lru_cache(maxsize=4096)
+def _format_datetime(some_datetime, datetime_format):
+    # The observations of a lab test share the same datetimes
+    # so we only format each datetime once
+    return some_datetime.strftime(datetime_format)
+
+
+def compile_getters(cls, fields):
+    """
+    Returns a tuple of (field, cls.get_{field}) for FIELDS so that
+    row mappers can build dictionaries without looking up each
+    getter by name for every row.
+    """
+    return tuple(
+        (field, getattr(cls, "get_{}".format(field)),)
+        for field in dict.fromkeys(fields)
+    )
+
+
+def wait_to_retry(name, error):
+    """
+    Logs that NAME failed with ERROR and waits RETRY_DELAY
+    seconds for the upstream database to become available
+    """
+    logger.info('{}: failed with {}, retrying in {}s'.format(
+        name, str(error), RETRY_DELAY
+    ))
+    time.sleep(RETRY_DELAY)
 
 
 def db_retry(f):
@@ -96,10 +162,7 @@ def db_retry(f):
         try:
             result = f(*args, **kw)
         except OperationalError as o:
-            logger.info('{}: failed with {}, retrying in {}s'.format(
-                f.__name__, str(o), RETRY_DELAY
-            ))
-            time.sleep(RETRY_DELAY)
+            wait_to_retry(f.__name__, o)
             result = f(*args, **kw)
         return result
     return wrap
@@ -127,6 +190,8 @@ class MainDemographicsRow(object):
         'main_language'    : 'MAIN_LANGUAGE',
     }
 
+    __slots__ = ("db_row",)
+
     def __init__(self, db_row):
         self.db_row = db_row
 
@@ -158,93 +223,104 @@ class MainDemographicsRow(object):
         return not alive
 
     def get_demographics_dict(self):
-        result = {}
-        for field in self.MODIFIED_DEMOGRAPHICS_FIELDS:
-            result[field] = getattr(self, "get_{}".format(field))()
+        db_row = self.db_row
+        result = {
+            field: getter(self) for field, getter in self.MODIFIED_GETTERS
+        }
+        for field, their_field in self.DIRECT_FIELDS:
+            result[field] = db_row.get(their_field)
+        return result
 
-        for field in self.DIRECT_UPSTREAM_FIELDS_TO_ELCID_FIELDS:
-            result[field] = self.db_row.get(
-                self.DIRECT_UPSTREAM_FIELDS_TO_ELCID_FIELDS[field]
-            )
 
-        return result
+MainDemographicsRow.MODIFIED_GETTERS = compile_getters(
+    MainDemographicsRow, MainDemographicsRow.MODIFIED_DEMOGRAPHICS_FIELDS
+)
+MainDemographicsRow.DIRECT_FIELDS = tuple(
+    MainDemographicsRow.DIRECT_UPSTREAM_FIELDS_TO_ELCID_FIELDS.items()
+)
 
-def get_contact_information(row):
-    mapping = {
-        "address_line_1": "ADDRESS_LINE1",
-        "address_line_2": "ADDRESS_LINE2",
-        "address_line_3": "ADDRESS_LINE3",
-        "address_line_4": "ADDRESS_LINE4",
-        "postcode": "POSTCODE",
-        "home_telephone": "HOME_TELEPHONE",
-        "work_telephone": "WORK_TELEPHONE",
-        "mobile_telephone": "MOBILE_TELEPHONE",
-        "email": "EMAIL"
+
+def map_row(row, mapping):
+    """
+    Returns {our field: row[their field]} for the
+    (our field, their field) pairs in MAPPING
+    """
+    return {
+        our_field: row[their_field] for our_field, their_field in mapping
     }
-    result = {}
-    for our_field, their_field in mapping.items():
-        result[our_field] = row[their_field]
 
+
+CONTACT_INFORMATION_MAPPING = (
+    ("address_line_1", "ADDRESS_LINE1"),
+    ("address_line_2", "ADDRESS_LINE2"),
+    ("address_line_3", "ADDRESS_LINE3"),
+    ("address_line_4", "ADDRESS_LINE4"),
+    ("postcode", "POSTCODE"),
+    ("home_telephone", "HOME_TELEPHONE"),
+    ("work_telephone", "WORK_TELEPHONE"),
+    ("mobile_telephone", "MOBILE_TELEPHONE"),
+    ("email", "EMAIL"),
+)
+
+NEXT_OF_KIN_MAPPING = (
+    ("nok_type", "NOK_TYPE"),
+    ("surname", "NOK_SURNAME"),
+    ("forename_1", "NOK_FORENAME1"),
+    ("forename_2", "NOK_FORENAME2"),
+    ("relationship", "NOK_relationship"),
+    ("address_1", "NOK_address1"),
+    ("address_2", "NOK_address2"),
+    ("address_3", "NOK_address3"),
+    ("address_4", "NOK_address4"),
+    ("postcode", "NOK_Postcode"),
+    ("home_telephone", "nok_home_telephone"),
+    ("work_telephone", "nok_work_telephone"),
+)
+
+GP_DETAILS_MAPPING = (
+    ("crs_gp_masterfile_id", "CRS_GP_MASTERFILE_ID"),
+    ("national_code", "GP_NATIONAL_CODE"),
+    ("practice_code", "GP_PRACTICE_CODE"),
+    ("title", "gp_title"),
+    ("initials", "GP_INITIALS"),
+    ("surname", "GP_SURNAME"),
+    ("address_1", "GP_ADDRESS1"),
+    ("address_2", "GP_ADDRESS2"),
+    ("address_3", "GP_ADDRESS3"),
+    ("address_4", "GP_ADDRESS4"),
+    ("postcode", "GP_POSTCODE"),
+    ("telephone", "GP_TELEPHONE"),
+)
+
+MASTER_FILE_META_MAPPING = (
+    ("insert_date", "INSERT_DATE"),
+    ("last_updated", "LAST_UPDATED"),
+    ("merged", "MERGED"),
+    ("merge_comments", "MERGE_COMMENTS"),
+    ("active_inactive", "ACTIVE_INACTIVE"),
+)
+
+
+def get_contact_information(row):
+    result = map_row(row, CONTACT_INFORMATION_MAPPING)
     result["external_system"] = EXTERNAL_SYSTEM
     return result
 
 
 def get_next_of_kin_details(row):
-    mapping = {
-        "nok_type": "NOK_TYPE",
-        "surname": "NOK_SURNAME",
-        "forename_1": "NOK_FORENAME1",
-        "forename_2": "NOK_FORENAME2",
-        "relationship": "NOK_relationship",
-        "address_1": "NOK_address1",
-        "address_2": "NOK_address2",
-        "address_3": "NOK_address3",
-        "address_4": "NOK_address4",
-        "postcode": "NOK_Postcode",
-        "home_telephone": "nok_home_telephone",
-        "work_telephone": "nok_work_telephone",
-    }
-    result = {}
-    for our_field, their_field in mapping.items():
-        result[our_field] = row[their_field]
-
+    result = map_row(row, NEXT_OF_KIN_MAPPING)
     result["external_system"] = EXTERNAL_SYSTEM
     return result
 
-def get_gp_details(row):
-    mapping = {
-        "crs_gp_masterfile_id": "CRS_GP_MASTERFILE_ID",
-        "national_code": "GP_NATIONAL_CODE",
-        "practice_code": "GP_PRACTICE_CODE",
-        "title": "gp_title",
-        "initials": "GP_INITIALS",
-        "surname": "GP_SURNAME",
-        "address_1": "GP_ADDRESS1",
-        "address_2": "GP_ADDRESS2",
-        "address_3": "GP_ADDRESS3",
-        "address_4": "GP_ADDRESS4",
-        "postcode": "GP_POSTCODE",
-        "telephone": "GP_TELEPHONE"
-    }
-    result = {}
-    for our_field, their_field in mapping.items():
-        result[our_field] = row[their_field]
 
+def get_gp_details(row):
+    result = map_row(row, GP_DETAILS_MAPPING)
     result["external_system"] = EXTERNAL_SYSTEM
     return result
 
 
 def get_master_file_meta(row):
-    mapping = {
-        "insert_date": "INSERT_DATE",
-        "last_updated": "LAST_UPDATED",
-        "merged": "MERGED",
-        "merge_comments": "MERGE_COMMENTS",
-        "active_inactive": "ACTIVE_INACTIVE",
-    }
-    result = {}
-    for our_field, their_field in mapping.items():
-        result[our_field] = row[their_field]
+    result = map_row(row, MASTER_FILE_META_MAPPING)
 
     if result["last_updated"]:
         result["last_updated"] = timezone.make_aware(
@@ -302,6 +378,8 @@ class PathologyRow(object):
 
     RESULT_FIELDS = LAB_TEST_FIELDS + OBSERVATION_FIELDS
 
+    __slots__ = ("db_row",)
+
     def __init__(self, db_row):
         self.db_row = db_row
 
@@ -355,10 +433,9 @@ class PathologyRow(object):
         return self.get_or_fallback("CRS_Title", "title")
 
     def get_demographics_dict(self):
-        result = {}
-        for field in self.DEMOGRAPHICS_FIELDS:
-            result[field] = getattr(self, "get_{}".format(field))()
-        return result
+        return {
+            field: getter(self) for field, getter in self.DEMOGRAPHICS_GETTERS
+        }
 
     def get_status(self):
         status_abbr = self.db_row.get("OBX_Status")
@@ -447,30 +524,42 @@ class PathologyRow(object):
         return to_datetime_str(self.db_row.get("last_updated"))
 
     def get_results_dict(self):
-        result = {}
-        for field in self.RESULT_FIELDS:
-            result[field] = getattr(self, "get_{}".format(field))()
-
-        return result
+        return {
+            field: getter(self) for field, getter in self.RESULT_GETTERS
+        }
 
     def get_lab_test_dict(self):
-        result = {}
-        for field in self.LAB_TEST_FIELDS:
-            result[field] = getattr(self, "get_{}".format(field))()
-        return result
+        return {
+            field: getter(self) for field, getter in self.LAB_TEST_GETTERS
+        }
 
     def get_observation_dict(self):
-        result = {}
-        for field in self.OBSERVATION_FIELDS:
-            result[field] = getattr(self, "get_{}".format(field))()
-        return result
+        return {
+            field: getter(self) for field, getter in self.OBSERVATION_GETTERS
+        }
 
     def get_all_fields(self):
-        result = {}
-        fields = self.DEMOGRAPHICS_FIELDS + self.RESULT_FIELDS
-        for field in fields:
-            result[field] = getattr(self, "get_{}".format(field))()
-        return result
+        return {
+            field: getter(self) for field, getter in self.ALL_GETTERS
+        }
+
+
+PathologyRow.DEMOGRAPHICS_GETTERS = compile_getters(
+    PathologyRow, PathologyRow.DEMOGRAPHICS_FIELDS
+)
+PathologyRow.LAB_TEST_GETTERS = compile_getters(
+    PathologyRow, PathologyRow.LAB_TEST_FIELDS
+)
+PathologyRow.OBSERVATION_GETTERS = compile_getters(
+    PathologyRow, PathologyRow.OBSERVATION_FIELDS
+)
+PathologyRow.RESULT_GETTERS = compile_getters(
+    PathologyRow, PathologyRow.RESULT_FIELDS
+)
+PathologyRow.ALL_GETTERS = compile_getters(
+    PathologyRow,
+    PathologyRow.DEMOGRAPHICS_FIELDS + PathologyRow.RESULT_FIELDS
+)
 
 
 class ProdApi(base_api.BaseApi):
@@ -499,72 +588,243 @@ class ProdApi(base_api.BaseApi):
         """
         Given an INSERT query, and optional PARAMS, execute and commit
         an insert on the upstream hospital database.
+
+        If the insert fails with an OperationalError before we commit
+        nothing has been written so we close the idle connections and
+        try once more on a new connection. A failed commit is not
+        retried as the insert may have been written.
         """
-        with pytds.connect(
-            self.hospital_settings["ip_address"],
-            self.hospital_settings["database"],
-            self.hospital_settings["username"],
-            self.hospital_settings["password"],
-            as_dict=True
-        ) as conn:
-            with conn.cursor() as cur:
-                logger.info(
-                    "Running upstream insert {} {}".format(insert, params)
-                )
-                cur.execute(insert, params)
-                conn.commit()
+        pool = connection_pool.get_pool(self.hospital_settings)
+        executed = False
+        try:
+            with pool.connection() as conn:
+                with conn.cursor() as cur:
+                    logger.info(
+                        "Running upstream insert {} {}".format(insert, params)
+                    )
+                    cur.execute(insert, params)
+                    executed = True
+                    conn.commit()
+        except OperationalError as o:
+            if executed:
+                raise
+            logger.info('upstream insert failed with {}, reconnecting'.format(
+                str(o)
+            ))
+            pool.clear()
+            with pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(insert, params)
+                    conn.commit()
 
-    def execute_hospital_query(self, query, params=None):
-        with pytds.connect(
-            self.hospital_settings["ip_address"],
-            self.hospital_settings["database"],
-            self.hospital_settings["username"],
-            self.hospital_settings["password"],
-            as_dict=True
-        ) as conn:
-            with conn.cursor() as cur:
-                logger.info(
-                    "Running upstream query {} {}".format(query, params)
-                )
-                cur.execute(query, params)
-                result = cur.fetchall()
+    def execute_query(self, db_settings, query, params=None, log_name="upstream"):
+        """
+        Runs a query on a pooled connection to the database
+        described by db_settings and returns all rows.
+
+        If the query fails with an OperationalError the upstream
+        database has often dropped our connections, so we close
+        the idle connections and try once more on a new connection.
+        """
+        pool = connection_pool.get_pool(db_settings)
+        try:
+            result = self._execute_query_on_pool(
+                pool, query, params, log_name
+            )
+        except OperationalError as o:
+            logger.info('{} query failed with {}, reconnecting'.format(
+                log_name, str(o)
+            ))
+            pool.clear()
+            result = self._execute_query_on_pool(
+                pool, query, params, log_name
+            )
         logger.debug(result)
         return result
 
-    def execute_trust_query(self, query, params=None):
-        with pytds.connect(
-            self.trust_settings["ip_address"],
-            self.trust_settings["database"],
-            self.trust_settings["username"],
-            self.trust_settings["password"],
-            as_dict=True
-        ) as conn:
+    def _execute_query_on_pool(self, pool, query, params, log_name):
+        with pool.connection() as conn:
             with conn.cursor() as cur:
                 logger.info(
-                    "Running upstream query {} {}".format(query, params)
+                    "Running {} query {} {}".format(log_name, query, params)
                 )
                 cur.execute(query, params)
-                result = cur.fetchall()
-        logger.debug(result)
-        return result
+                return cur.fetchall()
 
-    def execute_warehouse_query(self, query, params=None):
-        with pytds.connect(
-            self.warehouse_settings["ip_address"],
-            self.warehouse_settings["database"],
-            self.warehouse_settings["username"],
-            self.warehouse_settings["password"],
-            as_dict=True
-        ) as conn:
+    def stage_cohort(self, cur, mrns):
+        """
+        Creates the #elcid_cohort temporary table on the cursor's
+        connection containing MRNS.
+
+        The table is dropped when the connection is rolled back as
+        it is returned to the pool.
+        """
+        mrns = list(dict.fromkeys(mrns))
+        logger.info("Staging {} cohort MRNs upstream".format(len(mrns)))
+        cur.execute(CREATE_COHORT_TABLE)
+        for chunk_start in range(0, len(mrns), MRN_CHUNK_SIZE):
+            chunk = mrns[chunk_start:chunk_start + MRN_CHUNK_SIZE]
+            params = {}
+            values = []
+            for idx, mrn in enumerate(chunk):
+                params["mrn_{}".format(idx)] = mrn
+                values.append("(@mrn_{})".format(idx))
+            cur.execute(
+                INSERT_COHORT_MRNS.format(values=", ".join(values)),
+                params
+            )
+
+    def execute_query_iter(
+        self,
+        db_settings,
+        query,
+        params=None,
+        log_name="upstream",
+        chunk_size=None,
+        cohort_mrns=None,
+    ):
+        """
+        Runs a query on a pooled connection to the database described
+        by db_settings and yields the rows, reading them from the
+        cursor CHUNK_SIZE rows at a time so that the whole result
+        is never held in memory.
+
+        If COHORT_MRNS is passed they are staged in #elcid_cohort
+        before the query is run.
+
+        If the query fails with an OperationalError before any rows
+        have been yielded we close the idle connections and, as
+        db_retry does, wait RETRY_DELAY seconds before trying once more
+        on a new connection. Once rows have been yielded the caller
+        has acted on them so we re-raise.
+        """
+        if chunk_size is None:
+            chunk_size = STREAM_CHUNK_SIZE
+        pool = connection_pool.get_pool(db_settings)
+        rows = self._execute_query_iter_on_pool(
+            pool, query, params, log_name, chunk_size, cohort_mrns
+        )
+        yielded = False
+        try:
+            for row in rows:
+                yielded = True
+                yield row
+        except OperationalError as o:
+            if yielded:
+                raise
+            pool.clear()
+            wait_to_retry('{} query'.format(log_name), o)
+            yield from self._execute_query_iter_on_pool(
+                pool, query, params, log_name, chunk_size, cohort_mrns
+            )
+
+    def _execute_query_iter_on_pool(
+        self, pool, query, params, log_name, chunk_size, cohort_mrns
+    ):
+        with pool.connection() as conn:
             with conn.cursor() as cur:
+                if cohort_mrns is not None:
+                    self.stage_cohort(cur, cohort_mrns)
                 logger.info(
-                    "Running warehouse query {} {}".format(query, params)
+                    "Streaming {} query {} {}".format(log_name, query, params)
                 )
+                t1 = time.time()
                 cur.execute(query, params)
-                result = cur.fetchall()
-        logger.debug(result)
+                logger.info('{} query executed in {:.4f}s'.format(
+                    log_name, time.time() - t1
+                ))
+                while True:
+                    rows = cur.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield from rows
+
+    def execute_trust_query_iter(self, query, params=None):
+        return self.execute_query_iter(self.trust_settings, query, params)
+
+    def execute_trust_query_for_cohort_iter(self, query, params=None):
+        """
+        Streams the rows of a QUERY that joins on #elcid_cohort
+        after staging the MRNs of all our patients.
+        """
+        return self.execute_query_iter(
+            self.trust_settings, query, params, cohort_mrns=get_cohort_mrns()
+        )
+
+    def execute_hospital_query_for_cohort(self, query, params=None):
+        """
+        Returns the rows of a QUERY that joins on #elcid_cohort
+        after staging the MRNs of all our patients.
+        """
+        return list(self.execute_query_iter(
+            self.hospital_settings,
+            query,
+            params,
+            cohort_mrns=get_cohort_mrns()
+        ))
+
+    def execute_hospital_query(self, query, params=None):
+        return self.execute_query(self.hospital_settings, query, params)
+
+    def execute_trust_query(self, query, params=None):
+        return self.execute_query(self.trust_settings, query, params)
+
+    def execute_warehouse_query(self, query, params=None):
+        return self.execute_query(
+            self.warehouse_settings, query, params, log_name="warehouse"
+        )
+
+    def execute_query_for_mrns(
+        self, execute, query, mrns, mrn_field, params=None
+    ):
+        """
+        Runs a QUERY that contains an "IN ({mrns})" clause for all MRNS
+        using EXECUTE e.g. self.execute_hospital_query.
+
+        MRNs are sent as parameters in chunks of MRN_CHUNK_SIZE.
+
+        Returns a dictionary of {mrn: [rows]} grouped by the
+        row's MRN_FIELD with an entry for every MRN passed in.
+        """
+        mrns = list(dict.fromkeys(mrns))
+        result = {mrn: [] for mrn in mrns}
+        for chunk_start in range(0, len(mrns), MRN_CHUNK_SIZE):
+            chunk = mrns[chunk_start:chunk_start + MRN_CHUNK_SIZE]
+            chunk_params = dict(params or {})
+            param_names = []
+            for idx, mrn in enumerate(chunk):
+                param_name = "mrn_{}".format(idx)
+                chunk_params[param_name] = mrn
+                param_names.append("@{}".format(param_name))
+            rows = execute(
+                query.format(mrns=", ".join(param_names)),
+                params=chunk_params
+            )
+            for row in rows:
+                result.setdefault(row[mrn_field], []).append(row)
         return result
 
+    def execute_hospital_query_for_mrns(
+        self, query, mrns, mrn_field, params=None
+    ):
+        return self.execute_query_for_mrns(
+            self.execute_hospital_query, query, mrns, mrn_field, params
+        )
+
+    def execute_trust_query_for_mrns(
+        self, query, mrns, mrn_field, params=None
+    ):
+        return self.execute_query_for_mrns(
+            self.execute_trust_query, query, mrns, mrn_field, params
+        )
+
+    def execute_warehouse_query_for_mrns(
+        self, query, mrns, mrn_field, params=None
+    ):
+        return self.execute_query_for_mrns(
+            self.execute_warehouse_query, query, mrns, mrn_field, params
+        )
+
     @property
     def pathology_demographics_query(self):
         return PATHOLOGY_DEMOGRAPHICS_QUERY.format(
@@ -577,12 +837,24 @@ class ProdApi(base_api.BaseApi):
             view=self.trust_settings["view"]
         )
 
+    @property
+    def all_data_for_hospital_numbers_query(self):
+        return ALL_DATA_QUERY_FOR_HOSPITAL_NUMBERS.format(
+            view=self.trust_settings["view"]
+        )
+
     @property
     def all_data_since_query(self):
         return ALL_DATA_SINCE.format(
             view=self.trust_settings["view"]
         )
 
+    @property
+    def all_data_since_for_cohort_query(self):
+        return ALL_DATA_SINCE_FOR_COHORT.format(
+            view=self.trust_settings["view"]
+        )
+
     @property
     def all_data_query_for_lab_number(self):
         return ALL_DATA_QUERY_WITH_LAB_NUMBER.format(
@@ -712,44 +984,61 @@ class ProdApi(base_api.BaseApi):
                 params=dict(hospital_number=hospital_number)
             )
 
-    @timing
-    @db_retry
     def data_delta_query(self, since):
-        all_rows = self.execute_trust_query(
-            self.all_data_since_query,
-            params=dict(since=since)
-        )
+        """
+        Yields a PathologyRow for every row inserted since SINCE
+        ordered by hospital number, streamed from the upstream
+        database.
+
+        If settings.UPSTREAM_COHORT_FILTER is True only rows
+        for patients in elCID are returned.
+        """
+        if settings.UPSTREAM_COHORT_FILTER:
+            all_rows = self.execute_trust_query_for_cohort_iter(
+                self.all_data_since_for_cohort_query,
+                params=dict(since=since)
+            )
+        else:
+            all_rows = self.execute_trust_query_iter(
+                self.all_data_since_query,
+                params=dict(since=since)
+            )
         return (PathologyRow(r) for r in all_rows)
 
-    def data_deltas(self, some_datetime):
+    def data_deltas(self, some_datetime, mrn_to_patient_id=None):
         """
-        Returns a list of instances like
+        Yields instances like
         {
          "demographics" : demographics, the first (ie the most recent) demographics result in the set.
          "lab_tests": all lab tests for the patient
         }
-        """
-        all_rows = self.data_delta_query(some_datetime)
-
-        hospital_number_to_rows = defaultdict(list)
 
-        for row in all_rows:
-            hospital_number_to_rows[row.get_hospital_number()].append(row)
+        for the hospital numbers (including zero prefixed and merged MRNs)
+        in MRN_TO_PATIENT_ID, which is loaded with get_mrn_to_patient_id
+        if it is not passed in.
 
-        result = []
-
-        for hospital_number, rows in hospital_number_to_rows.items():
-            if Demographics.objects.filter(
-                hospital_number=hospital_number
-            ).exists():
-                demographics = rows[0].get_demographics_dict()
-                lab_tests = self.cast_rows_to_lab_test(rows)
-                result.append(dict(
-                    demographics=demographics,
-                    lab_tests=lab_tests
-                ))
+        Upstream rows are ordered by hospital number so each patient is
+        yielded as soon as all of their rows have been read, this means
+        we only ever hold a single patient's rows in memory.
+        """
+        if mrn_to_patient_id is None:
+            mrn_to_patient_id = get_mrn_to_patient_id()
+        all_rows = self.data_delta_query(some_datetime)
 
-        return result
+        for hospital_number, rows in itertools.groupby(
+            all_rows, key=lambda row: row.get_hospital_number()
+        ):
+            if not find_patient_ids_from_mrns(
+                [hospital_number], mrn_to_patient_id
+            ):
+                continue
+            rows = list(rows)
+            demographics = rows[0].get_demographics_dict()
+            lab_tests = self.cast_rows_to_lab_test(rows)
+            yield dict(
+                demographics=demographics,
+                lab_tests=lab_tests
+            )
 
     def cast_rows_to_lab_test(self, rows):
         """ We cast multiple rows to lab tests.
@@ -761,24 +1050,20 @@ class ProdApi(base_api.BaseApi):
 
         """
         lab_number_type_to_observations = defaultdict(list)
-        lab_number_type_to_lab_test = dict()
+        lab_number_type_to_row = dict()
 
         for row in rows:
-            lab_test_dict = row.get_lab_test_dict()
-            lab_number = lab_test_dict["external_identifier"]
-            lab_test_type = lab_test_dict["test_name"]
-            lab_number_type_to_lab_test[
-                (lab_number, lab_test_type,)
-            ] = lab_test_dict
-            lab_number_type_to_observations[
-                (lab_number, lab_test_type,)
-            ].append(
+            key = (row.get_external_identifier(), row.get_test_name(),)
+            # the lab test fields are the same for each observation,
+            # we use the last row as we always have
+            lab_number_type_to_row[key] = row
+            lab_number_type_to_observations[key].append(
                 row.get_observation_dict()
             )
         result = []
 
-        for external_id_and_type, lab_test in lab_number_type_to_lab_test.items():
-            lab_test = lab_number_type_to_lab_test[external_id_and_type]
+        for external_id_and_type, row in lab_number_type_to_row.items():
+            lab_test = row.get_lab_test_dict()
             lab_test["observations"] = lab_number_type_to_observations[
                 external_id_and_type
             ]
@@ -796,43 +1081,80 @@ class ProdApi(base_api.BaseApi):
         any zero prefixed MRNs included in the table for
         the MRN.
         """
-        query = """
-        SELECT DISTINCT Patient_Number FROM tQuest.Pathology_Result_View
-        WHERE Patient_Number LIKE '%%0' + @hospital_number
+        return self.query_for_zero_prefixed_mrns([hospital_number])[
+            hospital_number
+        ]
+
+    def query_for_zero_prefixed_mrns(self, hospital_numbers):
+        """
+        Returns a dictionary of {hospital_number: [zero prefixed hospital numbers]}
+        for the zero prefixed versions of the hospital numbers that
+        exist in the results table.
         """
-        other_hns = self.execute_trust_query(
-            query, params={"hospital_number": hospital_number}
+        result = {hospital_number: [] for hospital_number in hospital_numbers}
+        hospital_numbers = list(result.keys())
+        for chunk_start in range(0, len(hospital_numbers), MRN_CHUNK_SIZE):
+            chunk = hospital_numbers[chunk_start:chunk_start + MRN_CHUNK_SIZE]
+            params = {}
+            conditions = []
+            for idx, hospital_number in enumerate(chunk):
+                params["mrn_{}".format(idx)] = hospital_number
+                conditions.append(
+                    "Patient_Number LIKE '%%0' + @mrn_{}".format(idx)
+                )
+            query = """
+            SELECT DISTINCT Patient_Number FROM tQuest.Pathology_Result_View
+            WHERE {}
+            """.format(" OR ".join(conditions))
+            other_hns = self.execute_trust_query(query, params=params)
+            # we know the above query may return false positives
+            # e.g. if we look for 0234 it will return 20234
+            for row in other_hns:
+                stripped = row["Patient_Number"].lstrip('0')
+                if stripped in result:
+                    result[stripped].append(row["Patient_Number"])
+        return result
+
+    def raw_data_for_hospital_numbers(self, hospital_numbers):
+        """
+        Returns {hospital_number: [rows]} for all the rows
+        in the results table for the hospital numbers.
+        """
+        return self.execute_trust_query_for_mrns(
+            self.all_data_for_hospital_numbers_query,
+            hospital_numbers,
+            "Patient_Number"
         )
-        # we know the above query may return false positives
-        # e.g. if we look for 0234 it will return 20234
-        return [
-            i["Patient_Number"] for i in other_hns if i["Patient_Number"].lstrip('0') == hospital_number
-        ]
 
     @timing
-    def results_for_hospital_number(self, hospital_number):
+    def results_for_hospital_number(self, hospital_number, merged_mrns=None):
         """
         Returns all the results for an MRN
         aggregated into labtest: observations([])
 
         Also checks for alternative MRNs to fetch, due to
         upstream 0 prefixing or Cerner merges.
+
+        If MERGED_MRNS is not passed in they are looked up
+        from the MergedMRN table.
         """
-        merged_mrns = list(set(MergedMRN.objects.filter(
-            patient__demographics__hospital_number=hospital_number
-        ).values_list('mrn', flat=True)))
+        if merged_mrns is None:
+            merged_mrns = MergedMRN.objects.filter(
+                patient__demographics__hospital_number=hospital_number
+            ).values_list('mrn', flat=True)
+        merged_mrns = list(set(merged_mrns))
 
         all_mrns = [hospital_number] + merged_mrns
         zero_prefixed_mrns = []
 
-        for mrn in all_mrns:
-            zero_prefixed_mrns += self.query_for_zero_prefixed(mrn)
+        for prefixed in self.query_for_zero_prefixed_mrns(all_mrns).values():
+            zero_prefixed_mrns += prefixed
 
         all_mrns = all_mrns + zero_prefixed_mrns
         raw_rows = []
 
-        for mrn in all_mrns:
-            raw_rows += self.raw_data(mrn)
+        for mrn_rows in self.raw_data_for_hospital_numbers(all_mrns).values():
+            raw_rows += mrn_rows
 
         rows = (PathologyRow(raw_row) for raw_row in raw_rows)
         return self.cast_rows_to_lab_test(rows)
@@ -17,5 +17,9 @@ INTRAHOSPITAL_ROLES = set([
 SEND_TO_EPR = "send_to_epr"
 EXTERNAL_SYSTEM = "RFH Database"
 
+# SyncCursor feeds
+LAB_TEST_SYNC_CURSOR = "lab_tests"
+PATIENT_INFORMATION_SYNC_CURSOR = "patient_information"
+
 MERGE_LOAD_MINUTES = "MERGE_LOAD_MINUTES"
 TOTAL_MERGE_COUNT = "TOTAL_MERGE_COUNT"
@@ -1,19 +1,29 @@
 """
 Functions for loading data from upstream.
 """
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import traceback
 
+from django import db
 from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
 from django.utils import timezone
 from django.conf import settings
 from opal.models import Patient
 
 from elcid import models as emodels
 from elcid.utils import timing
-from plugins.admissions.loader import load_encounters, load_transfer_history_for_patient
-from plugins.appointments.loader import load_appointments
-from plugins.imaging.loader import load_imaging
+from plugins.admissions.loader import (
+    fetch_encounters,
+    update_encounters_from_query_result,
+    fetch_transfer_histories,
+    create_transfer_histories
+)
+from plugins.appointments.loader import (
+    fetch_appointments, update_appointments_from_query_result
+)
+from plugins.imaging.loader import fetch_imaging, update_patient_imaging
 
 from intrahospital_api import models
 from intrahospital_api import get_api
@@ -30,13 +40,35 @@ def log_errors(name):
     logger.error(error)
 
 
+def get_patient_for_mrn(hospital_number):
+    """
+    Returns the patient with HOSPITAL_NUMBER as their hospital number
+    or, if there is none, the patient that HOSPITAL_NUMBER has been
+    merged into.
+
+    Both are looked up in a single query.
+    """
+    demographics = emodels.Demographics.objects.filter(
+        hospital_number=hospital_number
+    )
+    merged_mrns = emodels.MergedMRN.objects.filter(mrn=hospital_number)
+    return Patient.objects.filter(
+        Q(id__in=demographics.values('patient_id')) |
+        Q(id__in=merged_mrns.values('patient_id'))
+    ).annotate(
+        is_active_mrn=Exists(demographics.filter(patient_id=OuterRef('id')))
+    ).order_by('-is_active_mrn', '-id').first()
+
+
 @timing
 def search_upstream_demographics(hospital_number):
+    """
+    Returns the upstream demographics of the active MRN
+    for HOSPITAL_NUMBER.
+    """
     started = timezone.now()
     try:
-        active_mrn, _ = update_demographics.get_active_mrn_and_merged_mrn_data(
-            hospital_number
-        )
+        active_mrn = update_demographics.get_active_mrn(hospital_number)
         result = api.demographics(active_mrn)
     except:
         stopped = timezone.now()
@@ -148,46 +180,145 @@ def async_load_patient(patient_id, patient_load_id):
         raise
 
 
+def fetch_results(mrns):
+    return api.results_for_hospital_number(mrns[0], merged_mrns=mrns[1:])
+
+
+def update_results(patient, results):
+    logger.info(
+        f"Loaded results for patient id {patient.id}"
+    )
+    update_lab_tests.update_tests(patient, results)
+    logger.info(
+        f"Tests updated for patient id {patient.id}"
+    )
+
+
+def fetch_patient_information(mrns):
+    if mrns[0]:
+        return update_demographics.fetch_patient_information(mrns[0])
+
+
+def get_initial_loaders():
+    """
+    Returns a list of (name, fetch, update) for the upstream
+    data we load when a patient is added.
+
+    fetch(mrns) queries upstream for the patient's MRNs, the
+    first MRN is the patient's hospital number followed by
+    any merged MRNs. It does not use our database so that it
+    can be run in a thread.
+
+    update(patient, fetched) saves the fetched data.
+    """
+    return [
+        ('results', fetch_results, update_results),
+        (
+            'update_patient_information',
+            fetch_patient_information,
+            update_demographics.update_patient_information_from_upstream
+        ),
+        (
+            'load_imaging',
+            fetch_imaging,
+            update_patient_imaging
+        ),
+        (
+            'load_encounters',
+            fetch_encounters,
+            lambda patient, rows: update_encounters_from_query_result(rows)
+        ),
+        (
+            'load_appointments',
+            fetch_appointments,
+            lambda patient, rows: update_appointments_from_query_result(rows)
+        ),
+        (
+            'load_transfer_history_for_patient',
+            fetch_transfer_histories,
+            lambda patient, rows: create_transfer_histories(rows)
+        ),
+        # Discharge summaries are currently inaccurate
+        # load_dischargesummaries
+    ]
+
+
+def fetch_in_thread(fetch, mrns):
+    """
+    Runs fetch(mrns) returning (result, None) or (None, traceback)
+    if it raised an exception.
+    """
+    try:
+        return fetch(mrns), None
+    except Exception:
+        return None, traceback.format_exc()
+    finally:
+        # Django opens a database connection per thread, make
+        # sure we do not leave any open.
+        db.connections.close_all()
+
+
+def fetch_all(loaders, mrns):
+    """
+    Runs the fetch for all loaders returning a dictionary of
+    {name: (result, traceback)}.
+
+    If settings.INITIAL_LOAD_CONCURRENTLY is True the fetches are run
+    in parallel so the time taken is that of the slowest upstream
+    query rather than the sum of them.
+    """
+    if not settings.INITIAL_LOAD_CONCURRENTLY:
+        result = {}
+        for name, fetch, _ in loaders:
+            try:
+                result[name] = (fetch(mrns), None,)
+            except Exception:
+                result[name] = (None, traceback.format_exc(),)
+        return result
+
+    with ThreadPoolExecutor(max_workers=len(loaders)) as executor:
+        futures = {
+            name: executor.submit(fetch_in_thread, fetch, mrns)
+            for name, fetch, _ in loaders
+        }
+    return {name: future.result() for name, future in futures.items()}
+
+
 @timing
 def _load_patient(patient, patient_load):
     logger.info(
         "Started patient {} Initial Load {}".format(patient.id, patient_load.id)
     )
     failed = []
+    loaders = get_initial_loaders()
     try:
-        with transaction.atomic():
-            hospital_number = patient.demographics_set.first().hospital_number
-            results = api.results_for_hospital_number(hospital_number)
-            logger.info(
-                f"Loaded results for patient id {patient.id}"
-            )
-            update_lab_tests.update_tests(patient, results)
-            logger.info(
-                f"Tests updated for patient id {patient.id}"
-            )
+        hospital_number = patient.demographics_set.first().hospital_number
+        merged_mrns = list(
+            patient.mergedmrn_set.values_list('mrn', flat=True)
+        )
     except Exception:
-        msg = f"Initial patient load for patient id {patient.id} failed on results"
-        logger.error(f"{msg}\n{traceback.format_exc()}")
-        failed.append('results')
-
-    loaders = [
-        update_demographics.update_patient_information,
-        load_imaging,
-        load_encounters,
-        load_appointments,
-        load_transfer_history_for_patient,
-        # Discharge summaries are currently inaccurate
-        # load_dischargesummaries
-    ]
-
-    for loader in loaders:
-        loader_name = loader.__name__
+        # Without the patient's MRNs every loader has failed
+        mrn_traceback = traceback.format_exc()
+        fetched = {
+            loader_name: (None, mrn_traceback,)
+            for loader_name, _, _ in loaders
+        }
+    else:
+        mrns = [hospital_number] + merged_mrns
+        fetched = fetch_all(loaders, mrns)
+
+    for loader_name, _, update in loaders:
+        msg = f"Initial patient load for patient id {patient.id} failed on {loader_name}"
+        result, fetch_traceback = fetched[loader_name]
+        if fetch_traceback:
+            logger.error(f"{msg}\n{fetch_traceback}")
+            failed.append(loader_name)
+            continue
         try:
             with transaction.atomic():
-                loader(patient)
+                update(patient, result)
                 logger.info(f'Completed {loader_name} for patient id {patient.id}')
-        except Exception as ex:
-            msg = f"Initial patient load for patient id {patient.id} failed on {loader_name}"
+        except Exception:
             logger.error(f"{msg}\n{traceback.format_exc()}")
             failed.append(loader_name)
     if failed:
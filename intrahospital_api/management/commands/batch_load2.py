@@ -2,6 +2,7 @@
 A management command that is run by a cron job
 """
 import datetime
+import itertools
 import time
 from django.db import transaction
 from django.core.management.base import BaseCommand
@@ -10,36 +11,59 @@ from opal.models import Patient
 from elcid import utils
 from intrahospital_api.loader import api
 from intrahospital_api import update_lab_tests
+from intrahospital_api.constants import LAB_TEST_SYNC_CURSOR
+from intrahospital_api.models import SyncCursor
 from plugins.labtests.models import Observation
 from plugins.monitoring.models import Fact
 
-MAX_AMOUNT = 350000
+# The number of patients from the delta we update at a time
+PATIENT_BATCH_SIZE = 100
 
 
 @transaction.atomic
-def update_patient(patient, lab_tests):
-    update_lab_tests.update_tests(patient, lab_tests)
+def update_batch(patients_and_lab_tests):
+    update_lab_tests.bulk_update_tests(patients_and_lab_tests)
 
 
-def get_count(since):
-
-    query = """
-    SELECT count(*)
-    FROM tQuest.Pathology_Result_View
-    WHERE date_inserted >= @since
+def batches(iterable, size):
+    """
+    Yields lists of SIZE items from ITERABLE
     """
-    return api.execute_trust_query(query, params={"since": since})[0][0]
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
 
 
-def send_too_many_email(since_dt, count):
-    str_format = '%d/%m/%Y %H:%M:%S'
-    since = since_dt.strftime(str_format)
-    msg = "\n".join([
-        f"Trying to lab tests load since {since}.",
-        f"We found {count} lab tests which is over the threshold of {MAX_AMOUNT}.",
-        "Cancelling the load"
-    ])
-    utils.send_email("Too many labtests", msg)
+def update_patients(items, mrn_to_patient_id):
+    """
+    Takes a list of data_deltas items and the mapping of
+    MRNs in our cohort from get_mrn_to_patient_id and
+    updates the lab tests of the patients in our cohort.
+
+    Returns the number of lab tests received from upstream.
+    """
+    obs_count = 0
+    mrns = [item['demographics']["hospital_number"] for item in items]
+    mrn_to_patient_id = utils.find_patient_ids_from_mrns(
+        mrns, mrn_to_patient_id
+    )
+    patients = Patient.objects.in_bulk(set(mrn_to_patient_id.values()))
+    patients_and_lab_tests = []
+
+    for item in items:
+        obs_count += len(item['lab_tests'])
+        mrn = item['demographics']["hospital_number"]
+        patient = patients.get(mrn_to_patient_id.get(mrn))
+        # The patient is not in our cohort
+        if not patient:
+            continue
+        patients_and_lab_tests.append((patient, item["lab_tests"]))
+    if patients_and_lab_tests:
+        update_batch(patients_and_lab_tests)
+    return obs_count
 
 
 class Command(BaseCommand):
@@ -53,38 +77,47 @@ class Command(BaseCommand):
         t1 = time.time()
         obs_count = 0
 
-        since = datetime.datetime.now() - datetime.timedelta(hours=48)
-
-        tquery1 = time.time()
-
-        # Loading too many rows at once causes memory issues.
-        # The max amount is significantly more than we expect
-        # so if we receive more, email admins and return.
-        count = get_count(since)
-        if count > MAX_AMOUNT:
-            send_too_many_email(since, count)
-            return
-        data = api.data_deltas(since)
-        tquery2 = time.time()
-
-        mrns = [item['demographics']["hospital_number"] for item in data]
-        patient_to_mrn = utils.find_patients_from_mrns(mrns)
-
-        for item in data:
-            obs_count += len(item['lab_tests'])
-            mrn = item['demographics']["hospital_number"]
-            patient = patient_to_mrn.get(mrn)
-            # The patient is not in our cohort
-            if not patient:
-                continue
-            update_patient(patient,  item["lab_tests"])
+        # The upstream date_inserted is not returned by data_deltas so
+        # the cursor is the time we started querying. Upstream timestamps
+        # are naive.
+        started = timezone.now()
+        since = SyncCursor.get_since(
+            LAB_TEST_SYNC_CURSOR, started - datetime.timedelta(hours=48)
+        )
+        since = timezone.make_naive(since)
+
+        # Load the MRNs of our cohort once, data_deltas uses them to skip
+        # upstream rows for patients not in elCID
+        mrn_to_patient_id = utils.get_mrn_to_patient_id()
+
+        # Upstream rows are streamed and each patient's lab tests are
+        # yielded once all their rows have been read, so we only hold
+        # a batch of patients in memory however large the delta is.
+        data = api.data_deltas(since, mrn_to_patient_id=mrn_to_patient_id)
+
+        # Rows are read from upstream as we iterate so time how long we
+        # spend waiting on each batch rather than a single query
+        upstream_query_time = 0
+        patient_batches = batches(data, PATIENT_BATCH_SIZE)
+        while True:
+            tquery1 = time.time()
+            items = next(patient_batches, None)
+            upstream_query_time += time.time() - tquery1
+            if items is None:
+                break
+            obs_count += update_patients(items, mrn_to_patient_id)
+
+        # Each batch is saved in its own transaction, only move the cursor
+        # once they have all been saved
+        with transaction.atomic():
+            SyncCursor.advance(LAB_TEST_SYNC_CURSOR, [started])
 
         t2 = time.time()
 
         kw['total_obs'] = Observation.objects.all().count()
         kw['obs_diff'] = kw['total_obs'] - pre_obs
         kw['time'] = int(t2-t1)
-        kw['upstream_query_time'] = int(tquery2 - tquery1)
+        kw['upstream_query_time'] = int(upstream_query_time)
         kw['48hr_obs'] = obs_count
 
         # Save as Facts
@@ -0,0 +1,122 @@
+"""
+A management command that times how long the ProdApi takes to
+map a synthetic lab test delta and master file rows into the
+dictionaries we save, without touching the upstream databases.
+
+example calling code is
+
+python manage.py benchmark_row_mappers --rows 300000
+"""
+import datetime
+import time
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from intrahospital_api.apis import prod_api
+from intrahospital_api.apis.dev_api import RAW_TEST_DATA, RAW_MASTER_FILE_DATA
+
+# The shape of the synthetic delta, each patient has
+# TESTS_PER_PATIENT lab tests with OBSERVATIONS_PER_TEST observations
+TESTS_PER_PATIENT = 5
+OBSERVATIONS_PER_TEST = 10
+
+DB_SETTINGS = dict(
+    ip_address="0.0.0.0",
+    database="benchmark",
+    username="benchmark",
+    password="benchmark",
+    view="benchmark",
+)
+
+
+def get_pathology_rows(count):
+    """
+    Returns COUNT upstream pathology rows ordered by patient number
+    as data_delta_query would return them.
+    """
+    rows = []
+    observation_date = datetime.datetime(2022, 3, 1, 10)
+    rows_per_patient = TESTS_PER_PATIENT * OBSERVATIONS_PER_TEST
+    for idx in range(count):
+        patient_idx, patient_row = divmod(idx, rows_per_patient)
+        test_idx, observation_idx = divmod(patient_row, OBSERVATIONS_PER_TEST)
+        row = dict(RAW_TEST_DATA)
+        row["Patient_Number"] = str(10000000 + patient_idx)
+        row["Result_ID"] = "{}-{}".format(patient_idx, test_idx)
+        row["OBX_id"] = idx
+        row["OBX_exam_code_Text"] = "Observation {}".format(observation_idx)
+        row["Result_Value"] = str(observation_idx)
+        row["Observation_date"] = observation_date + datetime.timedelta(
+            minutes=idx
+        )
+        rows.append(row)
+    return rows
+
+
+def get_master_file_rows(count):
+    rows = []
+    for idx in range(count):
+        row = dict(RAW_MASTER_FILE_DATA)
+        row["PATIENT_NUMBER"] = str(10000000 + idx)
+        rows.append(row)
+    return rows
+
+
+def map_master_file_row(row):
+    return (
+        prod_api.MainDemographicsRow(row).get_demographics_dict(),
+        prod_api.get_contact_information(row),
+        prod_api.get_next_of_kin_details(row),
+        prod_api.get_gp_details(row),
+        prod_api.get_master_file_meta(row),
+    )
+
+
+class Command(BaseCommand):
+    help = "Times mapping synthetic upstream rows with the ProdApi"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=300000)
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def time(self, name, repeat, func):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = func()
+            timings.append(time.perf_counter() - start)
+        self.stdout.write("{}: best {:.3f}s of {} ({} items)".format(
+            name, min(timings), repeat, result
+        ))
+
+    def handle(self, *args, **options):
+        count = options["rows"]
+        repeat = options["repeat"]
+        with override_settings(HOSPITAL_DB=DB_SETTINGS, TRUST_DB=DB_SETTINGS):
+            api = prod_api.ProdApi()
+
+        pathology_rows = get_pathology_rows(count)
+        mrn_to_patient_id = {
+            row["Patient_Number"]: 1 for row in pathology_rows
+        }
+        api.data_delta_query = lambda since: (
+            prod_api.PathologyRow(row) for row in pathology_rows
+        )
+
+        def data_deltas():
+            deltas = api.data_deltas(
+                None, mrn_to_patient_id=mrn_to_patient_id
+            )
+            return sum(len(i["lab_tests"]) for i in deltas)
+
+        self.time(
+            "data_deltas {} rows".format(count), repeat, data_deltas
+        )
+
+        master_file_rows = get_master_file_rows(count)
+
+        def master_file():
+            return len([map_master_file_row(row) for row in master_file_rows])
+
+        self.time(
+            "master file {} rows".format(count), repeat, master_file
+        )
@@ -12,6 +12,7 @@ from plugins.dischargesummary import models as discharge_models
 from plugins.handover import models as handover_models
 from plugins.ipc import models as ipc_models
 from plugins.labtests import models as lab_models
+from plugins.labtests import summaries as lab_summaries
 from intrahospital_api import models as intrahospital_api_models
 from plugins.icu import models as icu_models
 from plugins.rnoh import models as rnoh_models
@@ -293,8 +294,12 @@ def move_lab_tests(old_patient, new_patient):
     merge much faster.
     """
     lab_models.LabTest.objects.filter(patient_id=old_patient.id).update(
-        patient_id=new_patient.id
+        patient_id=new_patient.id, updated_at=timezone.now()
     )
+    lab_models.PositiveOrganism.objects.filter(
+        patient_id=old_patient.id
+    ).update(patient_id=new_patient.id)
+    lab_summaries.rebuild_patient_summaries(new_patient)
 
 @transaction.atomic
 def merge_elcid_data(*, old_patient, new_patient):
@@ -358,6 +363,10 @@ def merge_elcid_data(*, old_patient, new_patient):
         our_merge_datetime=timezone.now()
     )
     updates_statuses(new_patient)
+    # Bed statuses are moved without invalidating
+    # the patient lists, see elcid.patient_list_cache
+    from elcid import patient_list_cache
+    patient_list_cache.invalidate_patient(new_patient.id)
     new_patient_json = json.dumps(new_patient.to_dict(ohc), indent=4, cls=OpalSerializer)
     log_str = f'Merged patient id={new_patient.id}'
     logger.info(log_str)
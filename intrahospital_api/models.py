@@ -1,4 +1,5 @@
-from django.db import models
+import datetime
+from django.db import connection, models
 from django.utils import timezone
 from elcid.utils import model_method_logging
 import opal.models as omodels
@@ -103,3 +104,65 @@ class InitialPatientLoad(PatientSubrecord):
         """ For the purposes of the front end this model is read only.
         """
         pass
+
+
+class SyncCursor(models.Model):
+    """
+    The most recent upstream timestamp that an incremental
+    loader (e.g. batch_load2, fetch_appointments) has
+    successfully saved.
+
+    Loaders query upstream from the cursor rather than
+    a fixed window so that each run only loads what has
+    changed since the last successful run and a missed run
+    does not lose data.
+    """
+    # Query from this long before the cursor in case upstream
+    # rows are committed out of order
+    OVERLAP = datetime.timedelta(minutes=15)
+
+    feed = models.CharField(max_length=255, unique=True)
+    last_synced = models.DateTimeField()
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.feed} {self.last_synced}"
+
+    @classmethod
+    def get_since(cls, feed, default):
+        """
+        Returns the datetime the loader for FEED should
+        query from, or DEFAULT if the feed has not been synced.
+        """
+        cursor = cls.objects.filter(feed=feed).first()
+        if cursor is None:
+            return default
+        return cursor.last_synced - cls.OVERLAP
+
+    @classmethod
+    def advance(cls, feed, timestamps):
+        """
+        Moves the cursor for FEED to the most recent of
+        TIMESTAMPS. Naive timestamps (as they come from upstream)
+        are treated as being in the current timezone.
+
+        The cursor never moves backwards. This must be called
+        in a transaction, ideally the one that saves the upstream
+        data so that the cursor only moves if the data is committed.
+        """
+        assert connection.in_atomic_block, (
+            "SyncCursor.advance must be called in a transaction"
+        )
+        timestamps = [
+            timezone.make_aware(i) if timezone.is_naive(i) else i
+            for i in timestamps if i
+        ]
+        if not timestamps:
+            return
+        latest = max(timestamps)
+        cursor = cls.objects.select_for_update().filter(feed=feed).first()
+        if cursor is None:
+            cls.objects.create(feed=feed, last_synced=latest)
+        elif latest > cursor.last_synced:
+            cursor.last_synced = latest
+            cursor.save()
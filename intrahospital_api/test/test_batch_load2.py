@@ -1,4 +1,9 @@
+import datetime
+from django.utils import timezone
 from plugins.labtests import models
+from intrahospital_api.constants import LAB_TEST_SYNC_CURSOR
+from intrahospital_api.models import SyncCursor
+from plugins.monitoring.models import Fact
 from opal.core.test import OpalTestCase
 from intrahospital_api.management.commands import batch_load2
 from unittest.mock import patch
@@ -6,9 +11,8 @@ from unittest.mock import patch
 ROOT = "intrahospital_api.management.commands.batch_load2"
 
 class BatchLoad2TestCase(OpalTestCase):
-	@patch(f"{ROOT}.get_count")
 	@patch(f"{ROOT}.api")
-	def test_handle(self, api, get_count):
+	def test_handle(self, api):
 		lab_fields = [
 			i.name for i in models.LabTest._meta.get_fields() if i.name not in [
 				"created_at", "updated_at"
@@ -36,9 +40,88 @@ class BatchLoad2TestCase(OpalTestCase):
 		}]
 		patient, _ = self.new_patient_and_episode_please()
 		patient.demographics_set.update(hospital_number="123")
-		api.data_deltas.return_value = query_result
-		get_count.return_value = 1
+		api.data_deltas.return_value = iter(query_result)
 		batch_load2.Command().handle()
 		self.assertTrue(
 			patient.lab_tests.filter(lab_number="234").exists()
 		)
+
+	@patch(f"{ROOT}.PATIENT_BATCH_SIZE", 2)
+	@patch(f"{ROOT}.update_batch")
+	@patch(f"{ROOT}.api")
+	def test_handle_batches(self, api, update_batch):
+		patients = []
+		query_result = []
+		for hn in ["123", "124", "125"]:
+			patient, _ = self.new_patient_and_episode_please()
+			patient.demographics_set.update(hospital_number=hn)
+			patients.append(patient)
+			query_result.append({
+				"demographics": {"hospital_number": hn},
+				"lab_tests": [{"external_identifier": hn}]
+			})
+		# a patient not in our cohort
+		query_result.append({
+			"demographics": {"hospital_number": "126"},
+			"lab_tests": [{"external_identifier": "126"}]
+		})
+		api.data_deltas.return_value = iter(query_result)
+		batch_load2.Command().handle()
+		self.assertEqual(update_batch.call_count, 2)
+		first_batch = update_batch.call_args_list[0][0][0]
+		second_batch = update_batch.call_args_list[1][0][0]
+		self.assertEqual([i[0] for i in first_batch], patients[:2])
+		self.assertEqual([i[0] for i in second_batch], patients[2:])
+		self.assertEqual(
+			Fact.objects.get(label="48hr Observations").value_int, 4
+		)
+
+	@patch(f"{ROOT}.timezone.now")
+	@patch(f"{ROOT}.api")
+	def test_handle_sync_cursor(self, api, now):
+		started = timezone.make_aware(datetime.datetime(2022, 3, 2, 10))
+		now.return_value = started
+		api.data_deltas.return_value = iter([])
+		batch_load2.Command().handle()
+		api.data_deltas.assert_called_once_with(
+			datetime.datetime(2022, 3, 2, 10) - datetime.timedelta(hours=48),
+			mrn_to_patient_id={}
+		)
+		self.assertEqual(
+			SyncCursor.objects.get(feed=LAB_TEST_SYNC_CURSOR).last_synced,
+			started
+		)
+
+		later = started + datetime.timedelta(hours=1)
+		now.return_value = later
+		api.data_deltas.return_value = iter([])
+		batch_load2.Command().handle()
+		api.data_deltas.assert_called_with(
+			datetime.datetime(2022, 3, 2, 10) - SyncCursor.OVERLAP,
+			mrn_to_patient_id={}
+		)
+		self.assertEqual(
+			SyncCursor.objects.get(feed=LAB_TEST_SYNC_CURSOR).last_synced,
+			later
+		)
+
+	@patch(f"{ROOT}.update_batch")
+	@patch(f"{ROOT}.api")
+	def test_handle_zero_prefixed_and_merged_mrns(self, api, update_batch):
+		patient, _ = self.new_patient_and_episode_please()
+		patient.demographics_set.update(hospital_number="123")
+		other, _ = self.new_patient_and_episode_please()
+		other.demographics_set.update(hospital_number="124")
+		other.mergedmrn_set.create(mrn="125")
+		api.data_deltas.return_value = iter([
+			{"demographics": {"hospital_number": "0123"}, "lab_tests": []},
+			{"demographics": {"hospital_number": "125"}, "lab_tests": []},
+		])
+		batch_load2.Command().handle()
+		self.assertEqual(
+			api.data_deltas.call_args[1]["mrn_to_patient_id"],
+			{"123": patient.id, "124": other.id, "125": other.id}
+		)
+		self.assertEqual(
+			[i[0] for i in update_batch.call_args[0][0]], [patient, other]
+		)
@@ -0,0 +1,31 @@
+from unittest import mock
+from opal.core.test import OpalTestCase
+from intrahospital_api.management.commands import benchmark_row_mappers
+
+
+class GetPathologyRowsTestCase(OpalTestCase):
+    def test_get_pathology_rows(self):
+        rows = benchmark_row_mappers.get_pathology_rows(60)
+        self.assertEqual(len(rows), 60)
+        # 50 rows per patient, 10 observations per test
+        self.assertEqual(
+            len({i["Patient_Number"] for i in rows}), 2
+        )
+        self.assertEqual(len({i["Result_ID"] for i in rows}), 6)
+        self.assertEqual(len({i["OBX_id"] for i in rows}), 60)
+
+
+class BenchmarkRowMappersTestCase(OpalTestCase):
+    def setUp(self):
+        self.cmd = benchmark_row_mappers.Command()
+
+    def test_handle(self):
+        with mock.patch.object(self.cmd.stdout, "write") as writer:
+            self.cmd.handle(rows=100, repeat=1)
+        self.assertEqual(writer.call_count, 2)
+        data_deltas = writer.call_args_list[0][0][0]
+        self.assertTrue(data_deltas.startswith("data_deltas 100 rows: best"))
+        self.assertTrue(data_deltas.endswith("of 1 (10 items)"))
+        master_file = writer.call_args_list[1][0][0]
+        self.assertTrue(master_file.startswith("master file 100 rows: best"))
+        self.assertTrue(master_file.endswith("of 1 (100 items)"))
@@ -0,0 +1,215 @@
+from unittest import mock
+import threading
+from django.test import override_settings
+from pytds.tds import OperationalError
+from opal.core.test import OpalTestCase
+from intrahospital_api.apis import connection_pool
+
+
+DB_SETTINGS = dict(
+    ip_address="0.0.0.0",
+    database="made_up",
+    username="some_username",
+    password="some_password",
+    view="some_view"
+)
+
+
+@mock.patch('intrahospital_api.apis.connection_pool.pytds')
+@mock.patch('intrahospital_api.apis.connection_pool.time')
+class ConnectionPoolTestCase(OpalTestCase):
+    def get_pool(self, **kwargs):
+        pool_settings = dict(connection_pool.DEFAULT_POOL_SETTINGS)
+        pool_settings.update(kwargs)
+        return connection_pool.ConnectionPool(DB_SETTINGS, **pool_settings)
+
+    def test_connect(self, time, pytds):
+        pool = self.get_pool()
+        pool.connect()
+        pytds.connect.assert_called_once_with(
+            "0.0.0.0",
+            "made_up",
+            "some_username",
+            "some_password",
+            as_dict=True
+        )
+
+    def test_reuses_connections(self, time, pytds):
+        time.monotonic.return_value = 0
+        pytds.connect.side_effect = lambda *a, **k: mock.MagicMock()
+        pool = self.get_pool()
+        with pool.connection() as conn_1:
+            pass
+        with pool.connection() as conn_2:
+            pass
+        self.assertIs(conn_1, conn_2)
+        self.assertEqual(pytds.connect.call_count, 1)
+        self.assertTrue(conn_1.rollback.called)
+        self.assertEqual(pool.size, 1)
+
+    def test_opens_new_connections_when_busy(self, time, pytds):
+        time.monotonic.return_value = 0
+        pytds.connect.side_effect = lambda *a, **k: mock.MagicMock()
+        pool = self.get_pool()
+        with pool.connection() as conn_1:
+            with pool.connection() as conn_2:
+                self.assertIsNot(conn_1, conn_2)
+        self.assertEqual(pool.size, 2)
+        self.assertEqual(len(pool.idle), 2)
+
+    def test_max_size(self, time, pytds):
+        time.monotonic.return_value = 0
+        pool = self.get_pool(max_size=1, timeout=0)
+        with pool.connection():
+            with self.assertRaises(connection_pool.PoolTimeout):
+                pool.acquire()
+
+    def test_discards_on_operational_error(self, time, pytds):
+        time.monotonic.return_value = 0
+        pool = self.get_pool()
+        with self.assertRaises(OperationalError):
+            with pool.connection() as conn:
+                raise OperationalError('boom')
+        self.assertTrue(conn.close.called)
+        self.assertEqual(pool.size, 0)
+        self.assertEqual(pool.idle, [])
+
+    def test_keeps_connection_on_other_errors(self, time, pytds):
+        time.monotonic.return_value = 0
+        pool = self.get_pool()
+        with self.assertRaises(ValueError):
+            with pool.connection() as conn:
+                raise ValueError('boom')
+        self.assertFalse(conn.close.called)
+        self.assertTrue(conn.rollback.called)
+        self.assertEqual(pool.size, 1)
+
+    def test_discards_when_a_generator_is_closed(self, time, pytds):
+        time.monotonic.return_value = 0
+        pool = self.get_pool()
+
+        def read():
+            with pool.connection() as conn:
+                yield conn
+                yield conn
+
+        reader = read()
+        conn = next(reader)
+        reader.close()
+        self.assertTrue(conn.close.called)
+        self.assertEqual(pool.size, 0)
+
+    def test_health_check_failure(self, time, pytds):
+        broken = mock.MagicMock()
+        broken.cursor().__enter__().execute.side_effect = OperationalError(
+            'boom'
+        )
+        working = mock.MagicMock()
+        pytds.connect.side_effect = [broken, working]
+        pool = self.get_pool(health_check_after=60, max_idle=300)
+        time.monotonic.return_value = 0
+        with pool.connection():
+            pass
+        time.monotonic.return_value = 61
+        with pool.connection() as conn:
+            self.assertIs(conn, working)
+        self.assertTrue(broken.close.called)
+        self.assertEqual(pool.size, 1)
+
+    def test_health_check_runs_outside_the_lock(self, time, pytds):
+        pool = self.get_pool(health_check_after=60)
+        time.monotonic.return_value = 0
+        with pool.connection():
+            pass
+        locked = []
+
+        def is_healthy(conn):
+            # try to take the lock from another thread
+            def take_lock():
+                acquired = pool.condition.acquire(blocking=False)
+                locked.append(not acquired)
+                if acquired:
+                    pool.condition.release()
+            thread = threading.Thread(target=take_lock)
+            thread.start()
+            thread.join()
+            return True
+
+        time.monotonic.return_value = 61
+        with mock.patch.object(pool, "is_healthy", side_effect=is_healthy):
+            with pool.connection():
+                pass
+        self.assertEqual(locked, [False])
+        self.assertEqual(pool.size, 1)
+
+    def test_health_check_not_run_on_recent_connections(self, time, pytds):
+        pool = self.get_pool(health_check_after=60)
+        time.monotonic.return_value = 0
+        with pool.connection() as conn:
+            pass
+        conn.cursor.reset_mock()
+        time.monotonic.return_value = 30
+        with pool.connection():
+            pass
+        self.assertFalse(conn.cursor.called)
+
+    def test_evicts_idle_connections(self, time, pytds):
+        pytds.connect.side_effect = lambda *a, **k: mock.MagicMock()
+        pool = self.get_pool(min_size=1, max_idle=300)
+        time.monotonic.return_value = 0
+        with pool.connection() as conn_1:
+            with pool.connection() as conn_2:
+                pass
+        time.monotonic.return_value = 301
+        pool.evict_idle()
+        # we keep the min size open
+        self.assertEqual(pool.size, 1)
+        self.assertEqual(len(pool.idle), 1)
+        self.assertEqual(
+            len([i for i in [conn_1, conn_2] if i.close.called]), 1
+        )
+
+    def test_clear(self, time, pytds):
+        time.monotonic.return_value = 0
+        pool = self.get_pool()
+        with pool.connection() as conn:
+            pass
+        pool.clear()
+        self.assertTrue(conn.close.called)
+        self.assertEqual(pool.size, 0)
+
+    def test_failed_connect(self, time, pytds):
+        time.monotonic.return_value = 0
+        pytds.connect.side_effect = OperationalError('boom')
+        pool = self.get_pool()
+        with self.assertRaises(OperationalError):
+            pool.acquire()
+        self.assertEqual(pool.size, 0)
+
+
+class GetPoolTestCase(OpalTestCase):
+    def setUp(self):
+        connection_pool._pools.clear()
+
+    def test_returns_the_same_pool(self):
+        self.assertIs(
+            connection_pool.get_pool(DB_SETTINGS),
+            connection_pool.get_pool(dict(DB_SETTINGS))
+        )
+
+    def test_returns_different_pools_per_database(self):
+        other = dict(DB_SETTINGS, database="other")
+        self.assertIsNot(
+            connection_pool.get_pool(DB_SETTINGS),
+            connection_pool.get_pool(other)
+        )
+
+    @override_settings(UPSTREAM_DB_POOL=dict(max_size=3, max_idle=10))
+    def test_settings(self):
+        db_settings = dict(DB_SETTINGS, pool=dict(max_size=2))
+        pool = connection_pool.get_pool(db_settings)
+        self.assertEqual(pool.max_size, 2)
+        self.assertEqual(pool.max_idle, 10)
+        self.assertEqual(
+            pool.min_size, connection_pool.DEFAULT_POOL_SETTINGS["min_size"]
+        )
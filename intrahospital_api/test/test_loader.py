@@ -21,24 +21,24 @@ class ApiTestCase(OpalTestCase):
     __name__="results_for_hospital_number"
 )
 @mock.patch(
-    "intrahospital_api.loader.update_demographics.update_patient_information",
-    __name__="update_patient_information"
+    "intrahospital_api.loader.update_demographics.fetch_patient_information",
+    return_value=None
 )
 @mock.patch(
-    "intrahospital_api.loader.load_imaging",
-    __name__="load_imaging"
+    "intrahospital_api.loader.fetch_imaging",
+    return_value=[]
 )
 @mock.patch(
-    "intrahospital_api.loader.load_encounters",
-    __name__="load_encounters"
+    "intrahospital_api.loader.fetch_encounters",
+    return_value=[]
 )
 @mock.patch(
-    "intrahospital_api.loader.load_transfer_history_for_patient",
-    __name__="load_transfer_history_for_patient"
+    "intrahospital_api.loader.fetch_transfer_histories",
+    return_value=[]
 )
 @mock.patch(
-    "intrahospital_api.loader.load_appointments",
-    __name__="load_appointments"
+    "intrahospital_api.loader.fetch_appointments",
+    return_value=[]
 )
 @mock.patch(
     "intrahospital_api.loader.logger",
@@ -46,6 +46,7 @@ class ApiTestCase(OpalTestCase):
 class _LoadPatientTestCase(OpalTestCase):
     def setUp(self):
         self.patient, _ = self.new_patient_and_episode_please()
+        self.patient.demographics_set.update(hospital_number="123")
         self.initial_patient_load = self.patient.initialpatientload_set.create(
             started=timezone.now()
         )
@@ -66,6 +67,41 @@ class _LoadPatientTestCase(OpalTestCase):
             self.initial_patient_load.state, self.initial_patient_load.FAILURE
         )
 
+    @override_settings(INITIAL_LOAD_CONCURRENTLY=False)
+    def test_fail_not_concurrent(
+        self,
+        logger,
+        *args
+    ):
+        args[0].side_effect = ValueError('failed')
+        loader._load_patient(self.patient, self.initial_patient_load)
+        call_args = logger.error.call_args_list
+        self.assertEqual(len(call_args), 1)
+        err_msg = logger.error.call_args[0][0]
+        self.assertIn(f'Initial patient load for patient id {self.patient.id} failed on load_appointments', err_msg)
+        self.assertIn(f'ValueError: failed', err_msg)
+        self.assertEqual(
+            self.initial_patient_load.state, self.initial_patient_load.FAILURE
+        )
+
+    @mock.patch("intrahospital_api.loader.update_appointments_from_query_result")
+    def test_update_fail(
+        self,
+        update_appointments_from_query_result,
+        logger,
+        *args
+    ):
+        update_appointments_from_query_result.side_effect = ValueError('failed')
+        loader._load_patient(self.patient, self.initial_patient_load)
+        call_args = logger.error.call_args_list
+        self.assertEqual(len(call_args), 1)
+        err_msg = logger.error.call_args[0][0]
+        self.assertIn(f'Initial patient load for patient id {self.patient.id} failed on load_appointments', err_msg)
+        self.assertIn(f'ValueError: failed', err_msg)
+        self.assertEqual(
+            self.initial_patient_load.state, self.initial_patient_load.FAILURE
+        )
+
     def test_results_fail(
         self,
         logger,
@@ -89,6 +125,7 @@ class _LoadPatientTestCase(OpalTestCase):
             f'Started patient {self.patient.id} Initial Load {self.initial_patient_load.id}',
             f'Loaded results for patient id {self.patient.id}',
             f'Tests updated for patient id {self.patient.id}',
+            f'Completed results for patient id {self.patient.id}',
             f'Completed update_patient_information for patient id {self.patient.id}',
             f'Completed load_imaging for patient id {self.patient.id}',
             f'Completed load_encounters for patient id {self.patient.id}',
@@ -98,6 +135,36 @@ class _LoadPatientTestCase(OpalTestCase):
         self.assertEqual(
             call_args_list, expected
         )
+        self.assertEqual(
+            self.initial_patient_load.state, self.initial_patient_load.SUCCESS
+        )
+
+    def test_fetches_all_mrns(self, logger, *args):
+        self.patient.mergedmrn_set.create(mrn="456")
+        loader._load_patient(self.patient, self.initial_patient_load)
+        results_for_hospital_number = args[-1]
+        results_for_hospital_number.assert_called_once_with(
+            "123", merged_mrns=["456"]
+        )
+        args[-2].assert_called_once_with("123")
+        for fetch in args[:-2]:
+            fetch.assert_called_once_with(["123", "456"])
+
+    def test_no_demographics(self, logger, *args):
+        self.patient.demographics_set.all().delete()
+        loader._load_patient(self.patient, self.initial_patient_load)
+        err_msgs = [i[0][0] for i in logger.error.call_args_list]
+        self.assertEqual(len(err_msgs), len(loader.get_initial_loaders()))
+        self.assertIn(
+            f'Initial patient load for patient id {self.patient.id} failed on results',
+            err_msgs[0]
+        )
+        self.assertIn('AttributeError', err_msgs[0])
+        for fetch in args:
+            self.assertFalse(fetch.called)
+        self.assertEqual(
+            self.initial_patient_load.state, self.initial_patient_load.FAILURE
+        )
 
 
 class LogErrorsTestCase(ApiTestCase):
@@ -110,22 +177,22 @@ class LogErrorsTestCase(ApiTestCase):
 class LoadDemographicsTestCase(ApiTestCase):
 
     @mock.patch.object(loader.api, 'demographics')
-    @mock.patch('intrahospital_api.loader.update_demographics.get_active_mrn_and_merged_mrn_data')
-    def test_success(self, get_active_mrn_and_merged_mrn_data, demographics):
+    @mock.patch('intrahospital_api.loader.update_demographics.get_active_mrn')
+    def test_success(self, get_active_mrn, demographics):
         demographics.return_value = "success"
-        get_active_mrn_and_merged_mrn_data.return_value = ("some_hospital_number", [],)
+        get_active_mrn.return_value = "some_hospital_number"
         result = loader.search_upstream_demographics("some_hospital_number")
         demographics.assert_called_once_with("some_hospital_number")
-        get_active_mrn_and_merged_mrn_data.assert_called_once_with("some_hospital_number")
+        get_active_mrn.assert_called_once_with("some_hospital_number")
         self.assertEqual(result, "success")
 
     @mock.patch.object(loader.api, 'demographics')
     @mock.patch.object(loader.logger, 'info')
     @mock.patch('intrahospital_api.loader.log_errors')
-    @mock.patch('intrahospital_api.loader.update_demographics.get_active_mrn_and_merged_mrn_data')
-    def test_failed(self, get_active_mrn_and_merged_mrn_data, log_err, info, demographics):
+    @mock.patch('intrahospital_api.loader.update_demographics.get_active_mrn')
+    def test_failed(self, get_active_mrn, log_err, info, demographics):
         demographics.side_effect = ValueError("Boom")
-        get_active_mrn_and_merged_mrn_data.return_value = ("some_hospital_number", [],)
+        get_active_mrn.return_value = "some_hospital_number"
         demographics.return_value = "success"
         loader.search_upstream_demographics("some_hospital_number")
         self.assertEqual(info.call_count, 1)
@@ -134,13 +201,36 @@ class LoadDemographicsTestCase(ApiTestCase):
     @override_settings(
         INTRAHOSPITAL_API='intrahospital_api.apis.dev_api.DevApi'
     )
-    @mock.patch('intrahospital_api.loader.update_demographics.get_active_mrn_and_merged_mrn_data')
-    def test_integration(self, get_active_mrn_and_merged_mrn_data):
-        get_active_mrn_and_merged_mrn_data.return_value = ("some_number", [],)
+    @mock.patch('intrahospital_api.loader.update_demographics.get_active_mrn')
+    def test_integration(self, get_active_mrn):
+        get_active_mrn.return_value = "some_number"
         result = loader.search_upstream_demographics("some_number")
         self.assertTrue(isinstance(result, dict))
 
 
+class GetPatientForMrnTestCase(ApiTestCase):
+    def setUp(self):
+        self.patient, _ = self.new_patient_and_episode_please()
+        self.patient.demographics_set.update(hospital_number="123")
+
+    def test_hospital_number(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(loader.get_patient_for_mrn("123"), self.patient)
+
+    def test_merged_mrn(self):
+        self.patient.mergedmrn_set.create(mrn="456")
+        with self.assertNumQueries(1):
+            self.assertEqual(loader.get_patient_for_mrn("456"), self.patient)
+
+    def test_prefers_the_hospital_number(self):
+        other_patient, _ = self.new_patient_and_episode_please()
+        other_patient.mergedmrn_set.create(mrn="123")
+        self.assertEqual(loader.get_patient_for_mrn("123"), self.patient)
+
+    def test_not_found(self):
+        self.assertIsNone(loader.get_patient_for_mrn("456"))
+
+
 @mock.patch('intrahospital_api.loader.async_task')
 @mock.patch('intrahospital_api.loader._load_patient')
 class LoadLabTestsForPatientTestCase(ApiTestCase):
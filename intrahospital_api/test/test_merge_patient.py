@@ -51,6 +51,10 @@ PATIENT_RELATED_IGNORE_LIST = set([
     elcid_models.GPDetails,
     elcid_models.NextOfKinDetails,
 
+    # moved or rebuilt with the lab tests by move_lab_tests
+    lab_models.LabTestSummary,
+    lab_models.PositiveOrganism,
+
     # not used
     elcid_models.DuplicatePatient,
     lab_models.ObservationHistory,
@@ -439,6 +443,34 @@ class MoveRelatedRecordTestCase(OpalTestCase):
             ).exists()
         )
 
+    def test_move_lab_tests_moves_positive_organisms(self):
+        lab_test = self.old_patient.lab_tests.create(
+            test_name="BLOOD CULTURE",
+            datetime_ordered=timezone.now()
+        )
+        lab_test.observation_set.create(
+            observation_name="Blood Culture",
+            observation_value="Staphylococcus aureus"
+        )
+        lab_models.PositiveOrganism.update_for_lab_tests([lab_test])
+        merge_patient.move_lab_tests(self.old_patient, self.new_patient)
+        self.assertEqual(
+            self.new_patient.positive_organisms.get().lab_test_id,
+            lab_test.id
+        )
+
+    def test_move_lab_tests_rebuilds_summaries(self):
+        self.old_patient.lab_tests.create(
+            test_name="Blood culture",
+            lab_number="123",
+            datetime_ordered=timezone.now()
+        )
+        merge_patient.move_lab_tests(self.old_patient, self.new_patient)
+        self.assertEqual(
+            self.new_patient.lab_test_summaries.get().test_name,
+            "Blood culture"
+        )
+
 
     def test_episode_non_singleton(self):
         """
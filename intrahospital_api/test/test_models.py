@@ -1,4 +1,6 @@
+import datetime
 from unittest.mock import PropertyMock, patch
+from django.utils import timezone
 from opal.core.test import OpalTestCase
 from intrahospital_api import models
 
@@ -28,3 +30,73 @@ class InitialPatientLoadTestCase(OpalTestCase):
     def test_update_from_dict(self):
         self.ipl.update_from_dict(dict(state=self.ipl.SUCCESS))
         self.assertEqual(self.ipl.state, self.ipl.RUNNING)
+
+
+class SyncCursorTestCase(OpalTestCase):
+    def setUp(self):
+        self.synced = timezone.make_aware(datetime.datetime(2022, 3, 1, 10))
+
+    def test_get_since_default(self):
+        default = timezone.now()
+        self.assertEqual(
+            models.SyncCursor.get_since("some_feed", default), default
+        )
+
+    def test_get_since(self):
+        models.SyncCursor.objects.create(
+            feed="some_feed", last_synced=self.synced
+        )
+        self.assertEqual(
+            models.SyncCursor.get_since("some_feed", timezone.now()),
+            self.synced - models.SyncCursor.OVERLAP
+        )
+
+    def test_advance_creates(self):
+        models.SyncCursor.advance("some_feed", [
+            self.synced - datetime.timedelta(1), None, self.synced
+        ])
+        self.assertEqual(
+            models.SyncCursor.objects.get(feed="some_feed").last_synced,
+            self.synced
+        )
+
+    def test_advance_naive(self):
+        models.SyncCursor.advance(
+            "some_feed", [datetime.datetime(2022, 3, 1, 10)]
+        )
+        self.assertEqual(
+            models.SyncCursor.objects.get(feed="some_feed").last_synced,
+            self.synced
+        )
+
+    def test_advance_updates(self):
+        models.SyncCursor.objects.create(
+            feed="some_feed", last_synced=self.synced
+        )
+        later = self.synced + datetime.timedelta(hours=1)
+        models.SyncCursor.advance("some_feed", [later])
+        self.assertEqual(
+            models.SyncCursor.objects.get(feed="some_feed").last_synced,
+            later
+        )
+
+    def test_advance_does_not_move_backwards(self):
+        models.SyncCursor.objects.create(
+            feed="some_feed", last_synced=self.synced
+        )
+        models.SyncCursor.advance(
+            "some_feed", [self.synced - datetime.timedelta(hours=1)]
+        )
+        self.assertEqual(
+            models.SyncCursor.objects.get(feed="some_feed").last_synced,
+            self.synced
+        )
+
+    def test_advance_no_timestamps(self):
+        models.SyncCursor.advance("some_feed", [None])
+        self.assertFalse(models.SyncCursor.objects.exists())
+
+    def test_advance_outside_a_transaction(self):
+        with patch.object(models.connection, "in_atomic_block", False):
+            with self.assertRaises(AssertionError):
+                models.SyncCursor.advance("some_feed", [self.synced])
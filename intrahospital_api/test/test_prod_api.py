@@ -4,7 +4,7 @@ from django.test import override_settings
 from pytds.tds import OperationalError
 from datetime import datetime
 from opal.core.test import OpalTestCase
-from intrahospital_api.apis import prod_api
+from intrahospital_api.apis import prod_api, connection_pool
 from intrahospital_api import constants
 
 
@@ -149,6 +149,35 @@ class DbRetry(OpalTestCase):
         )
 
 
+class CompileGettersTestCase(OpalTestCase):
+    def test_compile_getters(self):
+        result = prod_api.compile_getters(
+            prod_api.PathologyRow, ["test_name", "status", "test_name"]
+        )
+        self.assertEqual(result, (
+            ("test_name", prod_api.PathologyRow.get_test_name,),
+            ("status", prod_api.PathologyRow.get_status,),
+        ))
+
+
+class ToDatetimeStrTestCase(OpalTestCase):
+    def test_to_datetime_str(self):
+        self.assertEqual(
+            prod_api.to_datetime_str(datetime(2015, 7, 18, 16, 18)),
+            "18/07/2015 16:18:00"
+        )
+
+    def test_none(self):
+        self.assertIsNone(prod_api.to_datetime_str(None))
+
+    @override_settings(DATETIME_INPUT_FORMATS=["%Y-%m-%d %H:%M"])
+    def test_uses_the_datetime_input_format(self):
+        self.assertEqual(
+            prod_api.to_datetime_str(datetime(2015, 7, 18, 16, 18)),
+            "2015-07-18 16:18"
+        )
+
+
 class PathologyRowTestCase(OpalTestCase):
     def get_row(self, **kwargs):
         raw_data = copy.copy(FAKE_PATHOLOGY_DATA)
@@ -460,6 +489,10 @@ class ProdApiTestcase(OpalTestCase):
         view="some_view"
     )
 
+    def setUp(self):
+        # connections are kept in a module level pool
+        connection_pool._pools.clear()
+
     def get_api(self):
         with override_settings(
             HOSPITAL_DB=self.REQUIRED_FIELDS,
@@ -494,10 +527,29 @@ class ProdApiTestcase(OpalTestCase):
         self.assertEqual(api.hospital_settings, self.REQUIRED_FIELDS)
         self.assertEqual(api.trust_settings, self.REQUIRED_FIELDS)
 
-    @mock.patch('intrahospital_api.apis.prod_api.pytds')
+    def test_cast_rows_to_lab_test(self):
+        api = self.get_api()
+        rows = [
+            self.get_row(OBX_id=1, Result_ID="1", OBX_Status="P"),
+            self.get_row(OBX_id=2, Result_ID="2"),
+            self.get_row(OBX_id=3, Result_ID="1", OBX_Status="F"),
+        ]
+        result = api.cast_rows_to_lab_test(rows)
+        self.assertEqual(
+            [i["external_identifier"] for i in result], ["1", "2"]
+        )
+        self.assertEqual(
+            [i["observation_number"] for i in result[0]["observations"]],
+            [1, 3]
+        )
+        # the lab test fields come from the last row
+        self.assertEqual(result[0]["status"], "complete")
+        self.assertEqual(result[0]["external_system"], prod_api.EXTERNAL_SYSTEM)
+
+    @mock.patch('intrahospital_api.apis.connection_pool.pytds')
     def test_execute_hospital_query_with_params(self, pytds):
         api = self.get_api()
-        conn = pytds.connect().__enter__()
+        conn = pytds.connect()
         cursor = conn.cursor().__enter__()
         cursor.fetchall.return_value = ["some_results"]
         result = api.execute_hospital_query(
@@ -512,10 +564,10 @@ class ProdApiTestcase(OpalTestCase):
         )
         self.assertTrue(cursor.fetchall.called)
 
-    @mock.patch('intrahospital_api.apis.prod_api.pytds')
+    @mock.patch('intrahospital_api.apis.connection_pool.pytds')
     def test_execute_hospital_query_without_params(self, pytds):
         api = self.get_api()
-        conn = pytds.connect().__enter__()
+        conn = pytds.connect()
         cursor = conn.cursor().__enter__()
         cursor.fetchall.return_value = ["some_results"]
         result = api.execute_hospital_query("some query")
@@ -525,6 +577,64 @@ class ProdApiTestcase(OpalTestCase):
         cursor.execute.assert_called_once_with("some query", None)
         self.assertTrue(cursor.fetchall.called)
 
+    @mock.patch('intrahospital_api.apis.connection_pool.pytds')
+    def test_execute_hospital_query_reuses_connection(self, pytds):
+        api = self.get_api()
+        api.execute_hospital_query("some query")
+        api.execute_hospital_query("some other query")
+        self.assertEqual(pytds.connect.call_count, 1)
+
+    @mock.patch('intrahospital_api.apis.connection_pool.pytds')
+    def test_execute_hospital_query_reconnects(self, pytds):
+        api = self.get_api()
+        broken = mock.MagicMock()
+        broken.cursor().__enter__().execute.side_effect = OperationalError(
+            'boom'
+        )
+        working = mock.MagicMock()
+        working.cursor().__enter__().fetchall.return_value = ["some_results"]
+        pytds.connect.side_effect = [broken, working]
+        result = api.execute_hospital_query("some query")
+        self.assertEqual(result, ["some_results"])
+        self.assertTrue(broken.close.called)
+        self.assertFalse(working.close.called)
+
+    @mock.patch('intrahospital_api.apis.connection_pool.pytds')
+    def test_execute_hospital_insert(self, pytds):
+        api = self.get_api()
+        conn = pytds.connect()
+        cursor = conn.cursor().__enter__()
+        api.execute_hospital_insert("some insert", dict(a="b"))
+        cursor.execute.assert_called_once_with("some insert", dict(a="b"))
+        self.assertTrue(conn.commit.called)
+
+    @mock.patch('intrahospital_api.apis.connection_pool.pytds')
+    def test_execute_hospital_insert_reconnects(self, pytds):
+        api = self.get_api()
+        broken = mock.MagicMock()
+        broken.cursor().__enter__().execute.side_effect = OperationalError(
+            'boom'
+        )
+        working = mock.MagicMock()
+        pytds.connect.side_effect = [broken, working]
+        api.execute_hospital_insert("some insert", dict(a="b"))
+        working.cursor().__enter__().execute.assert_called_once_with(
+            "some insert", dict(a="b")
+        )
+        self.assertFalse(broken.commit.called)
+        self.assertTrue(working.commit.called)
+        self.assertTrue(broken.close.called)
+
+    @mock.patch('intrahospital_api.apis.connection_pool.pytds')
+    def test_execute_hospital_insert_does_not_retry_commit(self, pytds):
+        api = self.get_api()
+        conn = pytds.connect()
+        conn.commit.side_effect = OperationalError('boom')
+        cursor = conn.cursor().__enter__()
+        with self.assertRaises(OperationalError):
+            api.execute_hospital_insert("some insert", dict(a="b"))
+        self.assertEqual(cursor.execute.call_count, 1)
+
     def test_raw_data(self):
         api = self.get_api()
         expected = [copy.copy(FAKE_PATHOLOGY_DATA)]
@@ -545,6 +655,109 @@ class ProdApiTestcase(OpalTestCase):
             )
         )
 
+    def test_execute_query_for_mrns(self):
+        api = self.get_api()
+        execute = mock.MagicMock()
+        execute.return_value = [
+            {"mrn": "123", "value": 1},
+            {"mrn": "123", "value": 2},
+            {"mrn": "456", "value": 3},
+        ]
+        result = api.execute_query_for_mrns(
+            execute,
+            "SELECT * FROM some_view WHERE mrn IN ({mrns}) AND x = @x",
+            ["123", "456", "789", "123"],
+            "mrn",
+            params={"x": "y"}
+        )
+        self.assertEqual(result, {
+            "123": [{"mrn": "123", "value": 1}, {"mrn": "123", "value": 2}],
+            "456": [{"mrn": "456", "value": 3}],
+            "789": [],
+        })
+        execute.assert_called_once_with(
+            "SELECT * FROM some_view WHERE mrn IN (@mrn_0, @mrn_1, @mrn_2) AND x = @x",
+            params={"x": "y", "mrn_0": "123", "mrn_1": "456", "mrn_2": "789"}
+        )
+
+    @mock.patch("intrahospital_api.apis.prod_api.MRN_CHUNK_SIZE", 2)
+    def test_execute_query_for_mrns_chunks(self):
+        api = self.get_api()
+        execute = mock.MagicMock()
+        execute.side_effect = [
+            [{"mrn": "1"}, {"mrn": "2"}],
+            [{"mrn": "3"}],
+        ]
+        result = api.execute_query_for_mrns(
+            execute, "SELECT * FROM v WHERE mrn IN ({mrns})", ["1", "2", "3"], "mrn"
+        )
+        self.assertEqual(
+            result, {"1": [{"mrn": "1"}], "2": [{"mrn": "2"}], "3": [{"mrn": "3"}]}
+        )
+        self.assertEqual(execute.call_count, 2)
+        self.assertEqual(
+            execute.call_args_list[1][0][0],
+            "SELECT * FROM v WHERE mrn IN (@mrn_0)"
+        )
+        self.assertEqual(
+            execute.call_args_list[1][1]["params"], {"mrn_0": "3"}
+        )
+
+    def test_query_for_zero_prefixed_mrns(self):
+        api = self.get_api()
+        with mock.patch.object(api, "execute_trust_query") as execute_query:
+            execute_query.return_value = [
+                {"Patient_Number": "0123"},
+                {"Patient_Number": "00123"},
+                # a false positive from the LIKE query
+                {"Patient_Number": "20123"},
+                {"Patient_Number": "0456"},
+            ]
+            result = api.query_for_zero_prefixed_mrns(["123", "456", "789"])
+        self.assertEqual(result, {
+            "123": ["0123", "00123"],
+            "456": ["0456"],
+            "789": [],
+        })
+        self.assertEqual(execute_query.call_count, 1)
+        self.assertIn(
+            "Patient_Number LIKE '%%0' + @mrn_0 OR Patient_Number LIKE '%%0' + @mrn_1",
+            execute_query.call_args[0][0]
+        )
+        self.assertEqual(
+            execute_query.call_args[1]["params"],
+            {"mrn_0": "123", "mrn_1": "456", "mrn_2": "789"}
+        )
+
+    def test_results_for_hospital_number(self):
+        api = self.get_api()
+        patient, _ = self.new_patient_and_episode_please()
+        patient.demographics_set.update(hospital_number="123")
+        patient.mergedmrn_set.create(mrn="456")
+        with mock.patch.object(api, "execute_trust_query") as execute_query:
+            execute_query.side_effect = [
+                [{"Patient_Number": "0123"}],
+                [
+                    copy.copy(FAKE_PATHOLOGY_DATA),
+                    dict(FAKE_PATHOLOGY_DATA, Patient_Number="0123", Result_ID="2"),
+                ]
+            ]
+            result = api.results_for_hospital_number("123")
+        self.assertEqual(execute_query.call_count, 2)
+        self.assertEqual(
+            execute_query.call_args[0][0],
+            "SELECT * FROM some_view WHERE Patient_Number IN \
+(@mrn_0, @mrn_1, @mrn_2) ORDER BY date_inserted DESC;"
+        )
+        self.assertEqual(
+            execute_query.call_args[1]["params"],
+            {"mrn_0": "123", "mrn_1": "456", "mrn_2": "0123"}
+        )
+        self.assertEqual(
+            sorted(i["external_identifier"] for i in result),
+            ["0013I245895", "2"]
+        )
+
     def test_pathology_demographics_success(self):
         api = self.get_api()
         with mock.patch.object(api, "execute_trust_query") as execute_query:
@@ -720,11 +933,158 @@ class ProdApiTestcase(OpalTestCase):
             ]
             execute_query.return_value = expected
             since = datetime.now()
-            result = api.data_deltas(since)
+            result = list(api.data_deltas(since))
         self.assertEqual(
             result, expected_result
         )
 
+    def test_data_deltas_streams(self):
+        """
+        Each patient should be yielded as soon as
+        the rows for the next patient are reached
+        """
+        api = self.get_api()
+        for hn in ["123", "125"]:
+            patient, _ = self.new_patient_and_episode_please()
+            patient.demographics_set.update(hospital_number=hn)
+
+        rows_read = []
+
+        def rows():
+            for hn in ["123", "123", "125"]:
+                rows_read.append(hn)
+                yield self.get_row(Patient_Number=hn)
+
+        with mock.patch.object(api, "data_delta_query") as execute_query:
+            execute_query.return_value = rows()
+            result = api.data_deltas(datetime.now())
+            first = next(result)
+            self.assertEqual(first["demographics"]["hospital_number"], "123")
+            self.assertEqual(rows_read, ["123", "123", "125"])
+            second = next(result)
+            self.assertEqual(second["demographics"]["hospital_number"], "125")
+            with self.assertRaises(StopIteration):
+                next(result)
+
+    @mock.patch("intrahospital_api.apis.prod_api.MRN_CHUNK_SIZE", 2)
+    def test_stage_cohort(self):
+        api = self.get_api()
+        cursor = mock.MagicMock()
+        api.stage_cohort(cursor, ["123", "456", "789", "123"])
+        self.assertEqual(cursor.execute.call_count, 3)
+        self.assertEqual(
+            cursor.execute.call_args_list[0][0][0],
+            prod_api.CREATE_COHORT_TABLE
+        )
+        self.assertEqual(
+            cursor.execute.call_args_list[1][0],
+            (
+                "INSERT INTO #elcid_cohort (mrn) VALUES (@mrn_0), (@mrn_1);",
+                {"mrn_0": "123", "mrn_1": "456"},
+            )
+        )
+        self.assertEqual(
+            cursor.execute.call_args_list[2][0],
+            (
+                "INSERT INTO #elcid_cohort (mrn) VALUES (@mrn_0);",
+                {"mrn_0": "789"},
+            )
+        )
+
+    @mock.patch('intrahospital_api.apis.connection_pool.pytds')
+    def test_execute_hospital_query_for_cohort(self, pytds):
+        patient, _ = self.new_patient_and_episode_please()
+        patient.demographics_set.update(hospital_number="123")
+        api = self.get_api()
+        cursor = pytds.connect().cursor().__enter__()
+        cursor.fetchmany.side_effect = [[{"mrn": "123"}], []]
+        with mock.patch.object(api, "stage_cohort") as stage_cohort:
+            result = api.execute_hospital_query_for_cohort(
+                "SELECT * FROM some_view JOIN #elcid_cohort", params={"x": 1}
+            )
+        self.assertEqual(result, [{"mrn": "123"}])
+        stage_cohort.assert_called_once_with(cursor, {"123"})
+        cursor.execute.assert_called_once_with(
+            "SELECT * FROM some_view JOIN #elcid_cohort", {"x": 1}
+        )
+
+    @mock.patch("intrahospital_api.apis.prod_api.time.sleep")
+    @mock.patch('intrahospital_api.apis.connection_pool.pytds')
+    def test_execute_query_iter_reconnects(self, pytds, sleep):
+        api = self.get_api()
+        broken = mock.MagicMock()
+        broken.cursor().__enter__().execute.side_effect = OperationalError(
+            'boom'
+        )
+        working = mock.MagicMock()
+        working.cursor().__enter__().fetchmany.side_effect = [
+            ["some_results"], []
+        ]
+        pytds.connect.side_effect = [broken, working]
+        with mock.patch.object(prod_api.logger, "info") as info:
+            result = list(api.execute_trust_query_iter("some query"))
+        self.assertEqual(result, ["some_results"])
+        self.assertTrue(broken.close.called)
+        self.assertFalse(working.close.called)
+        sleep.assert_called_once_with(30)
+        info.assert_any_call(
+            'upstream query: failed with boom, retrying in 30s'
+        )
+
+    @mock.patch("intrahospital_api.apis.prod_api.time.sleep")
+    @mock.patch('intrahospital_api.apis.connection_pool.pytds')
+    def test_execute_query_iter_does_not_retry_after_rows(self, pytds, sleep):
+        api = self.get_api()
+        cursor = pytds.connect().cursor().__enter__()
+        cursor.fetchmany.side_effect = [
+            ["some_results"], OperationalError('boom')
+        ]
+        rows = api.execute_trust_query_iter("some query")
+        self.assertEqual(next(rows), "some_results")
+        with self.assertRaises(OperationalError):
+            next(rows)
+        self.assertEqual(cursor.execute.call_count, 1)
+        self.assertFalse(sleep.called)
+
+    @override_settings(UPSTREAM_COHORT_FILTER=True)
+    @mock.patch('intrahospital_api.apis.connection_pool.pytds')
+    def test_data_delta_query_cohort_filter(self, pytds):
+        api = self.get_api()
+        cursor = pytds.connect().cursor().__enter__()
+        cursor.fetchmany.side_effect = [[copy.copy(FAKE_PATHOLOGY_DATA)], []]
+        since = datetime.now()
+        with mock.patch.object(api, "stage_cohort") as stage_cohort:
+            result = list(api.data_delta_query(since))
+        self.assertEqual(len(result), 1)
+        self.assertTrue(stage_cohort.called)
+        cursor.execute.assert_called_once_with(
+            "SELECT * FROM some_view WHERE date_inserted > @since \
+AND SUBSTRING(Patient_Number, PATINDEX('%[^0]%', Patient_Number + '.'), \
+LEN(Patient_Number) + 1) IN (SELECT mrn FROM #elcid_cohort) \
+ORDER BY Patient_Number, date_inserted DESC;",
+            dict(since=since)
+        )
+
+    @mock.patch('intrahospital_api.apis.connection_pool.pytds')
+    def test_data_delta_query(self, pytds):
+        api = self.get_api()
+        cursor = pytds.connect().cursor().__enter__()
+        cursor.fetchmany.side_effect = [
+            [copy.copy(FAKE_PATHOLOGY_DATA), copy.copy(FAKE_PATHOLOGY_DATA)],
+            [copy.copy(FAKE_PATHOLOGY_DATA)],
+            [],
+        ]
+        since = datetime.now()
+        result = list(api.data_delta_query(since))
+        self.assertEqual(len(result), 3)
+        self.assertEqual(result[0].get_hospital_number(), "20552710")
+        cursor.execute.assert_called_once_with(
+            "SELECT * FROM some_view WHERE date_inserted > @since ORDER BY \
+Patient_Number, date_inserted DESC;",
+            dict(since=since)
+        )
+        cursor.fetchmany.assert_called_with(prod_api.STREAM_CHUNK_SIZE)
+
     def test_data_deltas_none(self):
         """
         If the db query does not return anything
@@ -741,7 +1101,7 @@ class ProdApiTestcase(OpalTestCase):
             expected = []
             execute_query.return_value = expected
             since = datetime.now()
-            result = api.data_deltas(since)
+            result = list(api.data_deltas(since))
         self.assertEqual(
             result, []
         )
@@ -763,11 +1123,42 @@ class ProdApiTestcase(OpalTestCase):
             expected = [self.get_row()]
             execute_query.return_value = expected
             since = datetime.now()
-            result = api.data_deltas(since)
+            result = list(api.data_deltas(since))
         self.assertEqual(
             result, []
         )
 
+    def test_data_deltas_merged_and_zero_prefixed(self):
+        api = self.get_api()
+        patient, _ = self.new_patient_and_episode_please()
+        patient.demographics_set.update(hospital_number='123')
+        patient.mergedmrn_set.create(mrn='20552710')
+
+        with mock.patch.object(api, "data_delta_query") as execute_query:
+            execute_query.return_value = [
+                self.get_row(Patient_Number='0123'),
+                self.get_row(),
+                self.get_row(Patient_Number='124'),
+            ]
+            result = list(api.data_deltas(datetime.now()))
+        self.assertEqual(
+            [i["demographics"]["hospital_number"] for i in result],
+            ['0123', '20552710']
+        )
+
+    def test_data_deltas_with_mrn_to_patient_id(self):
+        api = self.get_api()
+        with mock.patch.object(api, "data_delta_query") as execute_query:
+            execute_query.return_value = [
+                self.get_row(),
+                self.get_row(Patient_Number='124'),
+            ]
+            with self.assertNumQueries(0):
+                result = list(api.data_deltas(
+                    datetime.now(), mrn_to_patient_id={'20552710': 1}
+                ))
+        self.assertEqual(len(result), 1)
+
     def test_data_deltas_multiple_tests(self):
         """
         If there are multiple tests for a patient
@@ -855,7 +1246,7 @@ class ProdApiTestcase(OpalTestCase):
         with mock.patch.object(api, "data_delta_query") as execute_query:
             execute_query.return_value = expected
             since = datetime.now()
-            result = api.data_deltas(since)
+            result = list(api.data_deltas(since))
             # we don't care about lab test ordering
             result[0]["lab_tests"] = sorted(result[0]["lab_tests"], key=lambda x: int(x["external_identifier"]))
         self.assertEqual(
@@ -951,7 +1342,7 @@ class ProdApiTestcase(OpalTestCase):
         with mock.patch.object(api, "data_delta_query") as execute_query:
             execute_query.return_value = expected
             since = datetime.now()
-            result = api.data_deltas(since)
+            result = list(api.data_deltas(since))
 
         result[0]["lab_tests"] = sorted(
             result[0]["lab_tests"], key=lambda x: x["test_name"]
@@ -1034,7 +1425,7 @@ class ProdApiTestcase(OpalTestCase):
         with mock.patch.object(api, "data_delta_query") as execute_query:
             execute_query.return_value = expected
             since = datetime.now()
-            result = api.data_deltas(since)
+            result = list(api.data_deltas(since))
         self.assertEqual(
             result, expected_result
         )
@@ -1148,7 +1539,7 @@ class ProdApiTestcase(OpalTestCase):
         with mock.patch.object(api, "data_delta_query") as execute_query:
             execute_query.return_value = expected
             since = datetime.now()
-            result = api.data_deltas(since)
+            result = list(api.data_deltas(since))
             result = sorted(
                 result, key=lambda x: int(x["demographics"]["hospital_number"])
             )
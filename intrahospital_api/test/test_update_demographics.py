@@ -1008,6 +1008,56 @@ class GetActiveMrnAndMergedMrnDataTestCase(OpalTestCase):
         self.assertEqual(str(err.exception), "Unable to find a masterfile row for 123")
 
 
+@mock.patch("intrahospital_api.update_demographics.get_masterfile_row")
+@mock.patch("intrahospital_api.update_demographics.api")
+class GetActiveMrnTestCase(OpalTestCase):
+    def query_for_mrns(self, mapping):
+        def execute(query, mrns, mrn_field):
+            return {
+                mrn: [mapping[mrn]] if mrn in mapping else [] for mrn in mrns
+            }
+        return execute
+
+    def test_not_merged(self, api, get_masterfile_row):
+        api.execute_hospital_query_for_mrns.side_effect = self.query_for_mrns(
+            {"123": {"MERGED": "N", "MERGE_COMMENTS": None}}
+        )
+        self.assertEqual(update_demographics.get_active_mrn("123"), "123")
+        self.assertEqual(api.execute_hospital_query_for_mrns.call_count, 1)
+        self.assertFalse(get_masterfile_row.called)
+
+    def test_merged(self, api, get_masterfile_row):
+        api.execute_hospital_query_for_mrns.side_effect = self.query_for_mrns(
+            GetActiveMrnAndMergedMrnDataTestCase.COMPLEX_MAPPING
+        )
+        self.assertEqual(update_demographics.get_active_mrn("345"), "567")
+        # One query per level of the chain 345 -> 456 -> 567
+        self.assertEqual(
+            [i[0][1] for i in api.execute_hospital_query_for_mrns.call_args_list],
+            [["345"], ["456"], ["567"]]
+        )
+        self.assertFalse(get_masterfile_row.called)
+
+    @mock.patch("intrahospital_api.update_demographics.MERGE_CHAIN_MAX_DEPTH", 2)
+    @mock.patch("intrahospital_api.update_demographics.logger")
+    def test_chain_too_deep(self, logger, api, get_masterfile_row):
+        api.execute_hospital_query_for_mrns.side_effect = self.query_for_mrns(
+            GetActiveMrnAndMergedMrnDataTestCase.COMPLEX_MAPPING
+        )
+        self.assertEqual(update_demographics.get_active_mrn("345"), "345")
+        self.assertEqual(api.execute_hospital_query_for_mrns.call_count, 2)
+        logger.warn.assert_called_once_with(
+            "Unable to resolve the merge chain for 345, no rows for ['567']"
+        )
+        self.assertFalse(get_masterfile_row.called)
+
+    def test_not_found(self, api, get_masterfile_row):
+        api.execute_hospital_query_for_mrns.side_effect = self.query_for_mrns({})
+        with self.assertRaises(update_demographics.CernerPatientNotFoundException):
+            update_demographics.get_active_mrn("123")
+        self.assertFalse(get_masterfile_row.called)
+
+
 @mock.patch("intrahospital_api.update_demographics.loader.get_or_create_patient")
 @mock.patch("intrahospital_api.update_demographics.loader.load_patient")
 @mock.patch("intrahospital_api.update_demographics.merge_patient.merge_elcid_data")
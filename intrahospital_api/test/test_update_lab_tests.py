@@ -1,3 +1,4 @@
+from unittest import mock
 import datetime
 from django.utils import timezone
 from opal.core.test import OpalTestCase
@@ -34,8 +35,8 @@ class TestGetOrCreateLabTest(OpalTestCase):
         self.patient, _ = self.new_patient_and_episode_please()
 
     def test_creates_lab_test(self):
-        lt = update_lab_tests.delete_and_create_lab_test(
-            self.patient, self.api_dict
+        lt, = update_lab_tests.bulk_update_tests(
+            [(self.patient, [self.api_dict])]
         )
 
         self.assertEqual(
@@ -130,8 +131,8 @@ class TestGetOrCreateLabTest(OpalTestCase):
             "test_name": "Anti-CV2 (CRMP-5) antibodies",
         })
 
-        lt = update_lab_tests.delete_and_create_lab_test(
-            self.patient, self.api_dict
+        lt, = update_lab_tests.bulk_update_tests(
+            [(self.patient, [self.api_dict])]
         )
         self.assertEqual(lt.status, "Success")
         # check the model did actually save
@@ -139,3 +140,184 @@ class TestGetOrCreateLabTest(OpalTestCase):
             lab_test_models.LabTest.objects.get().status,
             "Success"
         )
+
+
+class BulkUpdateTestsTestCase(OpalTestCase):
+    def setUp(self):
+        self.patient, _ = self.new_patient_and_episode_please()
+        self.other_patient, _ = self.new_patient_and_episode_please()
+
+    def get_api_dict(self, lab_number, test_name, status="Success"):
+        return {
+            "clinical_info":  'testing',
+            "accession_number": "123456",
+            "datetime_ordered": "17/07/2015 04:15:10",
+            "department_int": 9,
+            "encounter_consultant_name": "DR. M. SMITH",
+            "encounter_location_name": "RAL 6 NORTH",
+            "encounter_location_code": "6N",
+            "external_identifier": lab_number,
+            "site": u'some site',
+            "status": status,
+            "test_code": "AN12",
+            "test_name": test_name,
+            "observations": [{
+                "last_updated": "18/07/2015 04:15:10",
+                "observation_datetime": "19/07/2015 04:15:10",
+                "reported_datetime": "20/07/2015 04:15:10",
+                "observation_name": "Aerobic bottle culture",
+                "observation_number": "12312",
+                "observation_value": "123",
+                "reference_range": "3.5 - 11",
+                "units": "g"
+            }]
+        }
+
+    def test_creates_lab_tests_for_multiple_patients(self):
+        update_lab_tests.bulk_update_tests([
+            (self.patient, [
+                self.get_api_dict("1", "BLOOD CULTURE"),
+                self.get_api_dict("2", "BLOOD CULTURE"),
+            ]),
+            (self.other_patient, [self.get_api_dict("1", "BLOOD CULTURE")]),
+        ])
+        self.assertEqual(self.patient.lab_tests.count(), 2)
+        self.assertEqual(self.other_patient.lab_tests.count(), 1)
+        lab_test = self.other_patient.lab_tests.get()
+        self.assertEqual(lab_test.status, "Success")
+        self.assertEqual(
+            lab_test.observation_set.get().observation_value, "123"
+        )
+        self.assertEqual(lab_test_models.Observation.objects.count(), 3)
+
+    def test_replaces_only_matching_lab_tests(self):
+        update_lab_tests.bulk_update_tests([
+            (self.patient, [
+                self.get_api_dict("1", "BLOOD CULTURE", status="Pending"),
+                self.get_api_dict("1", "GENTAMICIN LEVEL", status="Pending"),
+            ]),
+            (self.other_patient, [
+                self.get_api_dict("1", "BLOOD CULTURE", status="Pending")
+            ]),
+        ])
+        update_lab_tests.bulk_update_tests([
+            (self.patient, [self.get_api_dict("1", "BLOOD CULTURE")]),
+        ])
+        self.assertEqual(
+            self.patient.lab_tests.get(test_name="BLOOD CULTURE").status,
+            "Success"
+        )
+        self.assertEqual(
+            self.patient.lab_tests.get(test_name="GENTAMICIN LEVEL").status,
+            "Pending"
+        )
+        self.assertEqual(
+            self.other_patient.lab_tests.get().status, "Pending"
+        )
+        self.assertEqual(lab_test_models.LabTest.objects.count(), 3)
+        self.assertEqual(lab_test_models.Observation.objects.count(), 3)
+
+    def test_last_duplicate_wins(self):
+        update_lab_tests.bulk_update_tests([
+            (self.patient, [
+                self.get_api_dict("1", "BLOOD CULTURE", status="Pending"),
+                self.get_api_dict("1", "BLOOD CULTURE"),
+            ]),
+        ])
+        self.assertEqual(self.patient.lab_tests.get().status, "Success")
+
+    def test_skips_tests_without_a_lab_number_or_name(self):
+        update_lab_tests.bulk_update_tests([
+            (self.patient, [self.get_api_dict(None, None)]),
+        ])
+        self.assertFalse(self.patient.lab_tests.exists())
+
+    def test_update_tests(self):
+        update_lab_tests.update_tests(
+            self.patient, [self.get_api_dict("1", "BLOOD CULTURE")]
+        )
+        self.assertEqual(
+            self.patient.lab_tests.get().observation_set.count(), 1
+        )
+
+    def test_skips_unchanged_lab_tests(self):
+        update_lab_tests.bulk_update_tests([
+            (self.patient, [self.get_api_dict("1", "BLOOD CULTURE")]),
+        ])
+        lab_test = self.patient.lab_tests.get()
+        observation = lab_test.observation_set.get()
+        created = update_lab_tests.bulk_update_tests([
+            (self.patient, [self.get_api_dict("1", "BLOOD CULTURE")]),
+        ])
+        self.assertEqual(created, [])
+        self.assertEqual(self.patient.lab_tests.get().id, lab_test.id)
+        self.assertEqual(
+            lab_test_models.Observation.objects.get().id, observation.id
+        )
+
+    def test_rewrites_changed_observations(self):
+        update_lab_tests.bulk_update_tests([
+            (self.patient, [self.get_api_dict("1", "BLOOD CULTURE")]),
+        ])
+        lab_test_id = self.patient.lab_tests.get().id
+        api_dict = self.get_api_dict("1", "BLOOD CULTURE")
+        api_dict["observations"][0]["observation_value"] = "124"
+        created = update_lab_tests.bulk_update_tests([
+            (self.patient, [api_dict]),
+        ])
+        self.assertEqual(len(created), 1)
+        lab_test = self.patient.lab_tests.get()
+        self.assertNotEqual(lab_test.id, lab_test_id)
+        self.assertEqual(
+            lab_test.observation_set.get().observation_value, "124"
+        )
+
+    def test_rebuilds_summaries_of_changed_test_types(self):
+        update_lab_tests.bulk_update_tests([
+            (self.patient, [
+                self.get_api_dict("1", "BLOOD CULTURE", status="Pending"),
+                self.get_api_dict("1", "GENTAMICIN LEVEL"),
+            ]),
+        ])
+        summaries = self.patient.lab_test_summaries.all()
+        self.assertEqual(
+            set(i.test_name for i in summaries),
+            {"BLOOD CULTURE", "GENTAMICIN LEVEL"}
+        )
+        with mock.patch.object(
+            update_lab_tests.lab_test_summaries, "rebuild_summaries"
+        ) as rebuild_summaries:
+            update_lab_tests.bulk_update_tests([
+                (self.patient, [
+                    self.get_api_dict("1", "BLOOD CULTURE"),
+                    self.get_api_dict("1", "GENTAMICIN LEVEL"),
+                ]),
+            ])
+        rebuild_summaries.assert_called_once_with(
+            {self.patient.id: {"BLOOD CULTURE"}}
+        )
+
+    def test_rewrites_tests_without_a_fingerprint(self):
+        update_lab_tests.bulk_update_tests([
+            (self.patient, [self.get_api_dict("1", "BLOOD CULTURE")]),
+        ])
+        lab_test_models.LabTest.objects.update(fingerprint=None)
+        created = update_lab_tests.bulk_update_tests([
+            (self.patient, [self.get_api_dict("1", "BLOOD CULTURE")]),
+        ])
+        self.assertEqual(len(created), 1)
+        self.assertEqual(self.patient.lab_tests.count(), 1)
+        self.assertEqual(lab_test_models.Observation.objects.count(), 1)
+
+    def test_updates_positive_organisms(self):
+        api_dict = self.get_api_dict("1", "BLOOD CULTURE")
+        api_dict["observations"][0]["observation_name"] = "Blood Culture"
+        api_dict["observations"][0]["observation_value"] = "Escherichia coli"
+        update_lab_tests.bulk_update_tests([(self.patient, [api_dict])])
+        self.assertEqual(
+            self.patient.positive_organisms.get().organism,
+            lab_test_models.PositiveOrganism.E_COLI
+        )
+        api_dict["observations"][0]["observation_value"] = "No growth"
+        update_lab_tests.bulk_update_tests([(self.patient, [api_dict])])
+        self.assertFalse(self.patient.positive_organisms.exists())
@@ -22,7 +22,10 @@ from elcid import constants, models
 from plugins.monitoring.models import Fact
 from intrahospital_api import logger, loader, get_api, merge_patient
 from intrahospital_api import merge_patient
-from intrahospital_api.constants import EXTERNAL_SYSTEM
+from intrahospital_api.constants import (
+    EXTERNAL_SYSTEM, PATIENT_INFORMATION_SYNC_CURSOR
+)
+from intrahospital_api.models import SyncCursor
 from intrahospital_api.exceptions import MergeException, CernerPatientNotFoundException
 
 api = get_api()
@@ -45,6 +48,16 @@ GET_MERGED_DATA_FOR_ALL_MERGED_PATIENTS = """
     WHERE MERGED = 'Y'
 """
 
+GET_MERGED_DATA_FOR_MRNS = """
+    SELECT Patient_Number, ACTIVE_INACTIVE, MERGE_COMMENTS, MERGED
+    FROM CRS_Patient_Masterfile
+    WHERE Patient_Number IN ({mrns})
+"""
+
+# The most levels of merge comments we follow
+# when looking up the merge chain of an MRN
+MERGE_CHAIN_MAX_DEPTH = 5
+
 # If we receive more than this number, send an email
 # notifiying the admins
 MERGED_MRN_COUNT_EMAIL_THRESHOLD = 300
@@ -538,6 +551,72 @@ def get_active_mrn_and_merged_mrn_data(mrn, mrn_to_upstream_merge_data=None):
 
     return active_mrn, merged_mrn_dicts
 
+
+def get_merge_chain_data(mrn):
+    """
+    Returns the masterfile rows for the MRN and the MRNs related to it
+    through merge comments in the format of get_mrn_to_upstream_merge_data
+    and a list of MRNs named in merge comments that we do not have a row for.
+
+    Rows are fetched from upstream a level of the merge chain at a time
+    with one query per level for at most MERGE_CHAIN_MAX_DEPTH levels.
+    """
+    mrn_to_upstream_merge_data = {}
+    fetched = set()
+    to_fetch = [mrn]
+    for _ in range(MERGE_CHAIN_MAX_DEPTH):
+        if not to_fetch:
+            break
+        fetched.update(to_fetch)
+        mrn_to_rows = api.execute_hospital_query_for_mrns(
+            GET_MERGED_DATA_FOR_MRNS, to_fetch, "Patient_Number"
+        )
+        to_fetch = []
+        for fetched_mrn, rows in mrn_to_rows.items():
+            if len(rows) > 1:
+                raise ValueError(f'Multiple results found for MRN {fetched_mrn}')
+            if not rows:
+                continue
+            mrn_to_upstream_merge_data[fetched_mrn] = rows[0]
+            merge_comments = rows[0]["MERGE_COMMENTS"] or ""
+            for found_mrn, _ in get_mrn_and_date_from_merge_comment(merge_comments):
+                if found_mrn not in fetched and found_mrn not in to_fetch:
+                    to_fetch.append(found_mrn)
+
+    unresolved = []
+    for row in mrn_to_upstream_merge_data.values():
+        merge_comments = row["MERGE_COMMENTS"] or ""
+        for found_mrn, _ in get_mrn_and_date_from_merge_comment(merge_comments):
+            if found_mrn not in mrn_to_upstream_merge_data and found_mrn not in unresolved:
+                unresolved.append(found_mrn)
+    return mrn_to_upstream_merge_data, unresolved
+
+
+def get_active_mrn(mrn):
+    """
+    Returns the active MRN for an MRN, which may be the MRN itself.
+
+    The merge chain is fetched from upstream with get_merge_chain_data
+    so this takes at most MERGE_CHAIN_MAX_DEPTH queries. If the chain
+    is deeper than that or names MRNs missing from the masterfile
+    we log a warning and return the MRN.
+    """
+    mrn_to_upstream_merge_data, unresolved = get_merge_chain_data(mrn)
+    if mrn not in mrn_to_upstream_merge_data:
+        raise CernerPatientNotFoundException(
+            f'Unable to find a masterfile row for {mrn}'
+        )
+    if unresolved:
+        logger.warn(
+            f"Unable to resolve the merge chain for {mrn}, no rows for {unresolved}"
+        )
+        return mrn
+    active_mrn, _ = get_active_mrn_and_merged_mrn_data(
+        mrn, mrn_to_upstream_merge_data
+    )
+    return active_mrn
+
+
 def update_patient_subrecords_from_upstream_dict(patient, upstream_patient_information):
     """
     Updates a patient's:
@@ -577,6 +656,25 @@ def update_patient_subrecords_from_upstream_dict(patient, upstream_patient_infor
     update_if_changed(next_of_kin_details, upstream_next_of_kin_details)
 
 
+def fetch_patient_information(hospital_number):
+    """
+    Returns the upstream master file information for a hospital number
+    """
+    upstream_patient_information = api.patient_masterfile(
+        hospital_number
+    )
+
+    if upstream_patient_information is None:
+        # If the hn begins with leading 0(s)
+        # the data is sometimes empty in the CRS_* fields.
+        # So if we cannot find rows with 0 prefixes
+        # remove the prefix
+        upstream_patient_information = api.patient_masterfile(
+            hospital_number.lstrip("0")
+        )
+    return upstream_patient_information
+
+
 def update_patient_information(patient):
     """
     Updates a patient with the upstream demographics
@@ -593,19 +691,16 @@ def update_patient_information(patient):
         logger.info(msg)
         return
 
-    upstream_patient_information = api.patient_masterfile(
-        hospital_number
+    upstream_patient_information = fetch_patient_information(hospital_number)
+    update_patient_information_from_upstream(
+        patient, upstream_patient_information
     )
 
-    if upstream_patient_information is None:
-        # If the hn begins with leading 0(s)
-        # the data is sometimes empty in the CRS_* fields.
-        # So if we cannot find rows with 0 prefixes
-        # remove the prefix
-        upstream_patient_information = api.patient_masterfile(
-            hospital_number.lstrip("0")
-        )
 
+def update_patient_information_from_upstream(patient, upstream_patient_information):
+    """
+    Updates a patient with the result of fetch_patient_information
+    """
     # this should never really happen but has..
     # It happens in the case of a patient who has previously
     # matched with WinPath but who's hospital_number has
@@ -680,16 +775,18 @@ def get_patients_from_master_file_rows(rows):
 
 def sync_recent_patient_information():
     """
-    Syncs the patient information for
-    the last four hours.
+    Syncs the patient information since the
+    patient information SyncCursor, or for
+    the last four hours if we have not synced before.
     """
     start = time()
     four_hours_ago = timezone.now() - datetime.timedelta(
         hours=4
     )
-    changed_count = update_patient_information_since(
-        four_hours_ago
+    since = SyncCursor.get_since(
+        PATIENT_INFORMATION_SYNC_CURSOR, four_hours_ago
     )
+    changed_count = update_patient_information_since(since)
     end = time()
     Fact.objects.create(
         when=timezone.now(),
@@ -755,6 +852,12 @@ def update_patient_information_since(last_updated):
         patient__in=[i.patient for i in new_master_files]
     ).delete()
     models.MasterFileMeta.objects.bulk_create(new_master_files)
+    master_file_api_name = models.MasterFileMeta.get_api_name()
+    SyncCursor.advance(PATIENT_INFORMATION_SYNC_CURSOR, [
+        row.get(master_file_api_name, {}).get("last_updated") or
+        row.get(master_file_api_name, {}).get("insert_date")
+        for row in rows
+    ])
     after_update = time()
     logger.info(f"patient information: query time {(after_query-before_query)/60}")
     logger.info(f"patient information: update time {(after_update-after_query)/60}")
@@ -1,4 +1,7 @@
+from collections import defaultdict
+from django.db import connection
 from plugins.labtests import models as lab_test_models
+from plugins.labtests import summaries as lab_test_summaries
 from intrahospital_api import get_api
 
 api = get_api()
@@ -24,24 +27,107 @@ def update_tests(patient, lab_tests):
     that need saving updates those that need
     updating.
     """
-    lab_tests = clean_lab_test_dicts(lab_tests)
-    for lab_test in lab_tests:
-        delete_and_create_lab_test(patient, lab_test)
+    bulk_update_tests([(patient, lab_tests)])
 
 
-def delete_and_create_lab_test(patient, lab_test):
-    """"
-    Lab tests should be unique for lab_number, test
-    name and patient. So if we have a new on coming
-    in, delete the existing one and create a new test.
+def get_lab_test_key(patient, lab_test):
+    return (patient.id, lab_test["external_identifier"], lab_test["test_name"])
+
+
+def get_existing_fingerprints(keys):
+    """
+    Takes a set of (patient id, lab number, test name) keys
+    and returns {key: [(lab test id, fingerprint)]} for the
+    lab tests we already hold for those keys.
+    """
+    result = {}
+    if not keys:
+        return result
+    patient_ids = set(i[0] for i in keys)
+    lab_numbers = set(i[1] for i in keys)
+    existing = lab_test_models.LabTest.objects.filter(
+        patient_id__in=patient_ids, lab_number__in=lab_numbers
+    ).values_list('id', 'patient_id', 'lab_number', 'test_name', 'fingerprint')
+    for lab_test_id, patient_id, lab_number, test_name, fingerprint in existing:
+        key = (patient_id, lab_number, test_name,)
+        if key in keys:
+            result.setdefault(key, []).append((lab_test_id, fingerprint,))
+    return result
+
+
+def delete_lab_tests(lab_test_ids):
+    """
+    Deletes the lab tests and their observations
+    """
+    if lab_test_ids:
+        lab_test_models.Observation.objects.filter(
+            test_id__in=lab_test_ids
+        ).delete()
+        lab_test_models.LabTest.objects.filter(id__in=lab_test_ids).delete()
+
+
+def bulk_update_tests(patients_and_lab_tests):
     """
+    Takes in a list of (patient, lab tests) and replaces
+    the patients' existing lab tests with the same lab number
+    and test name.
+
+    Rather than deleting and creating each test in turn,
+    all existing tests are deleted at once, then the new tests
+    and their observations are inserted with bulk_create.
+
+    If the same test appears more than once the last one wins.
+
+    Tests whose fingerprint matches the test we already hold
+    are left alone.
+
+    The patients' lab test summaries are rebuilt for the test
+    types that have changed.
+
+    Returns the lab tests that were created.
+    """
+    by_key = {}
+    for patient, lab_tests in patients_and_lab_tests:
+        for lab_test in clean_lab_test_dicts(lab_tests):
+            by_key[get_lab_test_key(patient, lab_test)] = (patient, lab_test)
+
+    existing = get_existing_fingerprints(set(by_key.keys()))
+    to_delete = []
+    to_create = []
+    tests = []
+    for key, (patient, lab_test) in by_key.items():
+        test = lab_test_models.LabTest()
+        test.set_from_api_dict(patient, lab_test)
+        existing_tests = existing.get(key, [])
+        if [i[1] for i in existing_tests] == [test.fingerprint]:
+            continue
+        to_delete.extend(i[0] for i in existing_tests)
+        to_create.append((patient, lab_test,))
+        tests.append(test)
+
+    delete_lab_tests(to_delete)
+
+    if connection.features.can_return_ids_from_bulk_insert:
+        lab_test_models.LabTest.objects.bulk_create(tests)
+    else:
+        # Without RETURNING (e.g. sqlite) bulk_create does not
+        # set the ids we need for the observations
+        for test in tests:
+            test.save()
 
-    lab_test_models.LabTest.objects.filter(
-        lab_number=lab_test["external_identifier"],
-        test_name=lab_test["test_name"],
-        patient=patient
-    ).delete()
-    test = lab_test_models.LabTest()
-    test.create_from_api_dict(patient, lab_test)
-    return test
+    observations = []
+    for test, (_, lab_test) in zip(tests, to_create):
+        for obs_dict in lab_test["observations"]:
+            observation = lab_test_models.Observation.translate_to_object(
+                obs_dict
+            )
+            observation.test = test
+            observations.append(observation)
+    lab_test_models.Observation.objects.bulk_create(observations)
+    lab_test_models.PositiveOrganism.update_for_lab_tests(tests)
 
+    patient_ids_to_test_names = defaultdict(set)
+    for test in tests:
+        patient_ids_to_test_names[test.patient_id].add(test.test_name)
+    lab_test_summaries.rebuild_summaries(patient_ids_to_test_names)
+    return tests
@@ -58,6 +58,10 @@ TRANSFER_HISTORY_COUNT_FACT = "Transfer history count fact"
 ENCOUNTER_LOAD_MINUTES = "Encounter Load Minutes"
 TOTAL_ENCOUNTERS = "Total Encounters"
 
+# SyncCursor feeds
+ENCOUNTERS_SYNC_CURSOR = "encounters"
+TRANSFER_HISTORY_SYNC_CURSOR = "transfer_history"
+
 
 RFH_HOSPITAL_SITE_CODE    = 'RAL01'
 BARNET_HOSPITAL_SITE_CODE = 'RAL26'
@@ -2,7 +2,7 @@
 Load admissions from upsteam
 """
 import datetime
-from collections import defaultdict
+from collections import Counter, defaultdict
 import time
 
 from django.db import transaction
@@ -15,9 +15,10 @@ from elcid.models import Demographics
 from elcid.utils import find_patients_from_mrns
 from intrahospital_api.apis.prod_api import ProdApi as ProdAPI
 from intrahospital_api.exceptions import CernerPatientNotFoundException
+from intrahospital_api.models import SyncCursor
 
 from plugins.admissions.models import Encounter, PatientEncounterStatus, TransferHistory, BedStatus
-from plugins.admissions import logger
+from plugins.admissions import logger, constants
 
 
 # UPDATED_DATE is the max of TRANS_UPDATED
@@ -35,7 +36,7 @@ Q_GET_TRANSFERS_FOR_MRN = """
     SELECT *
     FROM INP.TRANSFER_HISTORY_EL_CID WITH (NOLOCK)
     WHERE
-    LOCAL_PATIENT_IDENTIFIER = @mrn
+    LOCAL_PATIENT_IDENTIFIER IN ({mrns})
 """
 
 Q_GET_RECENT_ENCOUNTERS = """
@@ -50,7 +51,7 @@ Q_GET_ALL_PATIENT_ENCOUNTERS = """
 SELECT *
 FROM CRS_ENCOUNTERS
 WHERE
-PID_3_MRN = @mrn
+PID_3_MRN IN ({mrns})
 """
 
 Q_GET_ALL_HISTORY = """
@@ -127,25 +128,30 @@ def update_encounters_from_query_result(rows):
     )
 
 
-def load_encounters(patient):
+def fetch_encounters(mrns):
     """
-    Load any upstream admission data we may not have for PATIENT
+    Returns the upstream encounter rows for MRNS
     """
     api = ProdAPI()
+    encounters = []
+    mrn_to_rows = api.execute_hospital_query_for_mrns(
+        Q_GET_ALL_PATIENT_ENCOUNTERS, mrns, 'PID_3_MRN'
+    )
+    for rows in mrn_to_rows.values():
+        encounters.extend(rows)
+    return encounters
+
 
+def load_encounters(patient):
+    """
+    Load any upstream admission data we may not have for PATIENT
+    """
     mrn = patient.demographics().hospital_number
     other_mrns = list(
         patient.mergedmrn_set.values_list('mrn', flat=True)
     )
     all_mrns = [mrn] + other_mrns
-    encounters = []
-    for mrn in all_mrns:
-        query_result = api.execute_hospital_query(
-            Q_GET_ALL_PATIENT_ENCOUNTERS,
-            params={'mrn': mrn}
-        )
-        encounters.extend(query_result)
-    update_encounters_from_query_result(encounters)
+    update_encounters_from_query_result(fetch_encounters(all_mrns))
 
 
 def load_excounters_since(timestamp):
@@ -164,6 +170,8 @@ def load_excounters_since(timestamp):
 
     If the patient is one we are interested in we either create or update
     our copy of the encounter data using the upstream ID.
+
+    Advances the encounters SyncCursor to the most recent LAST_UPDATED.
     """
     api = ProdAPI()
 
@@ -171,7 +179,14 @@ def load_excounters_since(timestamp):
         Q_GET_RECENT_ENCOUNTERS,
         params={'timestamp': timestamp}
     )
+    # Not run in a transaction as we may create patients,
+    # the cursor is only advanced once the encounters are saved
     update_encounters_from_query_result(encounters)
+    with transaction.atomic():
+        SyncCursor.advance(
+            constants.ENCOUNTERS_SYNC_CURSOR,
+            [i.get("LAST_UPDATED") for i in encounters]
+        )
 
 
 def cast_to_transfer_history(upstream_dict, patient):
@@ -205,27 +220,38 @@ def load_transfer_history_since(since):
     logger.info(
         f"Transfer histories: queries {len(query_result)} rows in {query_time}s"
     )
-    created = create_transfer_histories(query_result)
+    with transaction.atomic():
+        created = create_transfer_histories(query_result)
+        SyncCursor.advance(
+            constants.TRANSFER_HISTORY_SYNC_CURSOR,
+            [i.get("UPDATED_DATE") for i in query_result]
+        )
     created_end = time.time()
     logger.info(f'Transfer histories: created {len(created)} in {created_end - query_end}')
     return created
 
 
-def load_transfer_history_for_patient(patient):
+def fetch_transfer_histories(mrns):
+    """
+    Returns the upstream transfer history rows for MRNS
+    """
     api = ProdAPI()
+    transfers = []
+    mrn_to_rows = api.execute_warehouse_query_for_mrns(
+        Q_GET_TRANSFERS_FOR_MRN, mrns, 'LOCAL_PATIENT_IDENTIFIER'
+    )
+    for rows in mrn_to_rows.values():
+        transfers.extend(rows)
+    return transfers
+
+
+def load_transfer_history_for_patient(patient):
     mrn = patient.demographics().hospital_number
     other_mrns = list(
         patient.mergedmrn_set.values_list('mrn', flat=True)
     )
     all_mrns = [mrn] + other_mrns
-    transfers = []
-    for mrn in all_mrns:
-        query_result = api.execute_warehouse_query(
-            Q_GET_TRANSFERS_FOR_MRN,
-            params={'mrn': mrn}
-        )
-        transfers.extend(query_result)
-    created = create_transfer_histories(transfers)
+    created = create_transfer_histories(fetch_transfer_histories(all_mrns))
     return created
 
 
@@ -294,11 +320,28 @@ def create_transfer_histories(unfiltered_rows):
     return transfer_histories
 
 
+def get_bed_status_values():
+    """
+    Returns {patient id: Counter of bed status rows} for the
+    patients with a bed status, used to tell which patients'
+    bed statuses have changed when they are reloaded.
+    """
+    fields = [i.attname for i in BedStatus._meta.concrete_fields if i.name != 'id']
+    result = defaultdict(Counter)
+    for row in BedStatus.objects.exclude(patient=None).values_list(*fields):
+        result[row[fields.index('patient_id')]][row] += 1
+    return result
+
+
 def load_bed_status():
     """
     Flush and re-load the upstream current_bed_status
+
+    The patient list cache is invalidated only for patients
+    whose bed statuses have changed.
     """
     from intrahospital_api.loader import create_rfh_patient_from_hospital_number
+    from elcid import patient_list_cache
 
     api = ProdAPI()
 
@@ -322,6 +365,7 @@ def load_bed_status():
 
 
     with transaction.atomic():
+        before = get_bed_status_values()
         BedStatus.objects.all().delete()
         for bed_data in status:
             # A bed can not have a patient, this is ok.
@@ -334,3 +378,8 @@ def load_bed_status():
                     v
                 )
             bed_status.save()
+
+    after = get_bed_status_values()
+    for patient_id in set(before) | set(after):
+        if before.get(patient_id) != after.get(patient_id):
+            patient_list_cache.invalidate_patient(patient_id)
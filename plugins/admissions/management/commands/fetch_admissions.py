@@ -9,6 +9,7 @@ from django.core.management import BaseCommand
 from django.utils import timezone
 
 from plugins.monitoring.models import Fact
+from intrahospital_api.models import SyncCursor
 
 from plugins.admissions import loader, logger, models, constants
 
@@ -19,7 +20,13 @@ class Command(BaseCommand):
         try:
             t1 = time.time()
             timestamp = datetime.datetime.now() - datetime.timedelta(days=1)
-            loader.load_excounters_since(timestamp)
+            since = SyncCursor.get_since(
+                constants.ENCOUNTERS_SYNC_CURSOR, timestamp
+            )
+            if timezone.is_aware(since):
+                # upstream timestamps are naive
+                since = timezone.make_naive(since)
+            loader.load_excounters_since(since)
             t2 = time.time()
 
             when             = timezone.make_aware(datetime.datetime.fromtimestamp(t1))
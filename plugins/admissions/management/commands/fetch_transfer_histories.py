@@ -7,6 +7,7 @@ import time
 from django.utils import timezone
 from django.core.management import BaseCommand
 from plugins.monitoring.models import Fact
+from intrahospital_api.models import SyncCursor
 from plugins.admissions import loader, logger, constants, models
 
 
@@ -15,7 +16,10 @@ class Command(BaseCommand):
         forty_days_ago = timezone.now() - datetime.timedelta(40)
         time_start = time.time()
         try:
-            created = loader.load_transfer_history_since(forty_days_ago)
+            since = SyncCursor.get_since(
+                constants.TRANSFER_HISTORY_SYNC_CURSOR, forty_days_ago
+            )
+            created = loader.load_transfer_history_since(since)
             time_end = time.time()
             Fact.objects.create(
                 when=timezone.now(),
@@ -7,10 +7,10 @@ from django.core.management.base import BaseCommand
 from django.conf import settings
 from django.utils import timezone
 from django.db import models
-import pytds
 
 from elcid import models as elcid_models
 from elcid.utils import timing
+from intrahospital_api.apis import connection_pool
 from plugins.admissions.models import TransferHistory
 from plugins.admissions import logger
 
@@ -59,13 +59,8 @@ def stream_result():
     with open(FILE_NAME, "w") as csv_file:
         writer = csv.DictWriter(csv_file, fieldnames=get_column_headers())
         writer.writeheader()
-        with pytds.connect(
-            settings.WAREHOUSE_DB["ip_address"],
-            settings.WAREHOUSE_DB["database"],
-            settings.WAREHOUSE_DB["username"],
-            settings.WAREHOUSE_DB["password"],
-            as_dict=True,
-        ) as conn:
+        pool = connection_pool.get_pool(settings.WAREHOUSE_DB)
+        with pool.connection() as conn:
             with conn.cursor() as cur:
                 logger.info('Starting Query')
                 cur.execute(query)
@@ -1,12 +1,16 @@
 """
 Unittests for the module plugins.admissions.management.commands.fetch_admissions
 """
+import datetime
 from unittest import mock
 
+from django.utils import timezone
 from opal.core.test import OpalTestCase
 
+from intrahospital_api.models import SyncCursor
 from plugins.monitoring.models import Fact
 
+from plugins.admissions import constants
 from plugins.admissions.management.commands import fetch_admissions
 
 
@@ -19,3 +23,16 @@ class CommandTestCase(OpalTestCase):
             cmd = fetch_admissions.Command()
             cmd.handle()
             self.assertEqual(2, Fact.objects.all().count())
+
+    def test_uses_the_sync_cursor(self):
+        SyncCursor.objects.create(
+            feed=constants.ENCOUNTERS_SYNC_CURSOR,
+            last_synced=timezone.make_aware(datetime.datetime(2022, 3, 1, 10))
+        )
+        with mock.patch.object(
+            fetch_admissions.loader, 'load_excounters_since'
+        ) as load_excounters_since:
+            fetch_admissions.Command().handle()
+        load_excounters_since.assert_called_once_with(
+            datetime.datetime(2022, 3, 1, 10) - SyncCursor.OVERLAP
+        )
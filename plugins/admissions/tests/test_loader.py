@@ -1,12 +1,26 @@
 import datetime
 from opal.core.test import OpalTestCase
+from django.test import override_settings
 from django.utils import timezone
-from plugins.admissions import loader, models
+from elcid import patient_list_cache
+from plugins.admissions import loader, models, constants
+from intrahospital_api.models import SyncCursor
 from opal.models import Patient
 from unittest.mock import patch
 from elcid import episode_categories
 
 
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'patient_lists': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'test_admissions_patient_lists',
+    },
+}
+
+
 class CreateTransferHistoriesTestCase(OpalTestCase):
     def test_simple_create_transfer_histories(self):
         """
@@ -211,6 +225,48 @@ class LoadBedStatusTestCase(OpalTestCase):
         bed_status = models.BedStatus.objects.get()
         self.assertIsNone(bed_status.patient)
 
+    def get_patient_versions(self, *patients):
+        return patient_list_cache.get_versions([
+            patient_list_cache.get_patient_version_key(i.id) for i in patients
+        ])
+
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_unchanged_bed_status_does_not_invalidate(self, prod_api, create_rfh_patient_from_hospital_number):
+        patient, _ = self.new_patient_and_episode_please()
+        patient.demographics_set.update(hospital_number="123")
+        self.bed_status_row["Local_Patient_Identifier"] = "123"
+        self.bed_status_row["Ward_Name"] = "8 West"
+        prod_api.return_value.execute_warehouse_query.return_value = [
+            self.bed_status_row
+        ]
+        loader.load_bed_status()
+        versions = self.get_patient_versions(patient)
+        loader.load_bed_status()
+        self.assertEqual(self.get_patient_versions(patient), versions)
+
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_changed_bed_status_invalidates(self, prod_api, create_rfh_patient_from_hospital_number):
+        patient, _ = self.new_patient_and_episode_please()
+        patient.demographics_set.update(hospital_number="123")
+        other_patient, _ = self.new_patient_and_episode_please()
+        other_patient.demographics_set.update(hospital_number="456")
+        other_row = dict(self.bed_status_row)
+        other_row["Local_Patient_Identifier"] = "456"
+        self.bed_status_row["Local_Patient_Identifier"] = "123"
+        self.bed_status_row["Ward_Name"] = "8 West"
+        prod_api.return_value.execute_warehouse_query.return_value = [
+            self.bed_status_row, other_row
+        ]
+        loader.load_bed_status()
+        versions = self.get_patient_versions(patient, other_patient)
+        self.bed_status_row["Ward_Name"] = "9 East"
+        loader.load_bed_status()
+        new_versions = self.get_patient_versions(patient, other_patient)
+        key = patient_list_cache.get_patient_version_key(patient.id)
+        other_key = patient_list_cache.get_patient_version_key(other_patient.id)
+        self.assertNotEqual(new_versions[key], versions[key])
+        self.assertEqual(new_versions[other_key], versions[other_key])
+
 
 @patch('intrahospital_api.loader.create_rfh_patient_from_hospital_number')
 @patch('plugins.admissions.loader.ProdAPI')
@@ -252,6 +308,24 @@ class LoadEncountersSinceTestCase(OpalTestCase):
             encounter.patient, patient
         )
 
+    def test_advances_sync_cursor(self, prod_api, create_rfh_patient_from_hospital_number):
+        patient, _ = self.new_patient_and_episode_please()
+        patient.demographics_set.update(
+            hospital_number= "123"
+        )
+        self.encounter_row["PID_3_MRN"] = "123"
+        self.encounter_row["LAST_UPDATED"] = datetime.datetime(2022, 3, 1, 10)
+        prod_api.return_value.execute_hospital_query.return_value =[
+            self.encounter_row
+        ]
+        loader.load_excounters_since(timezone.now())
+        self.assertEqual(
+            SyncCursor.objects.get(
+                feed=constants.ENCOUNTERS_SYNC_CURSOR
+            ).last_synced,
+            timezone.make_aware(datetime.datetime(2022, 3, 1, 10))
+        )
+
     def test_ignores_invalid_mrns(self, prod_api, create_rfh_patient_from_hospital_number):
         self.encounter_row["PID_3_MRN"] = None
         self.assertFalse(models.Encounter.objects.exists())
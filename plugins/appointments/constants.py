@@ -2,3 +2,4 @@ APPOINTMENTS_LOAD_TIME_FACT = "APPOINTMENTS_LOAD_TIME_FACT"
 APPOINTMENTS_LOAD_CREATED_COUNT_FACT = "APPOINTMENTS_LOAD_CREATED_COUNT_FACT"
 APPOINTMENTS_LOAD_PATIENT_COUNT_FACT = "APPOINTMENTS_LOAD_PATIENT_COUNT_FACT"
 APPOINTMENTS_COUNT_FACT = "APPOINTMENTS_COUNT_FACT"
+APPOINTMENTS_SYNC_CURSOR = "appointments"
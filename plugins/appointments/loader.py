@@ -2,6 +2,7 @@
 Load Appointments from upstream
 """
 import time
+from django.conf import settings
 from django.db import transaction
 from collections import defaultdict
 from opal.core import serialization
@@ -10,16 +11,17 @@ from django.utils import timezone
 from elcid.models import Demographics
 from elcid import utils
 
-from intrahospital_api.apis.prod_api import ProdApi as ProdAPI
+from intrahospital_api.apis.prod_api import ProdApi as ProdAPI, IN_COHORT
+from intrahospital_api.models import SyncCursor
 
 from plugins.appointments.models import Appointment, PatientAppointmentStatus
-from plugins.appointments import logger
+from plugins.appointments import logger, constants
 
 
 Q_GET_ALL_PATIENT_APPOINTMENTS = """
 SELECT *
 FROM VIEW_ElCid_CRS_OUTPATIENTS
-WHERE vPatient_Number = @mrn
+WHERE vPatient_Number IN ({mrns})
 """
 
 Q_GET_APPOINTMENTS_SINCE = """
@@ -29,6 +31,13 @@ WHERE last_updated > @last_updated
 OR insert_date > @last_updated
 """
 
+Q_GET_APPOINTMENTS_SINCE_FOR_COHORT = """
+SELECT *
+FROM VIEW_ElCid_CRS_OUTPATIENTS
+WHERE (last_updated > @last_updated OR insert_date > @last_updated)
+AND {in_cohort}
+""".format(in_cohort=IN_COHORT.format(mrn="vPatient_Number"))
+
 
 def cast_to_instance(patient, upstream_dict):
     our_appointment = Appointment(patient=patient)
@@ -45,22 +54,52 @@ def cast_to_instance(patient, upstream_dict):
     return our_appointment
 
 
+def get_modified(upstream_row):
+    """
+    Returns the most recent of an upstream row's last_updated
+    and insert_date, either of which can be None.
+
+    Rows are queried if either is after the cursor so the
+    cursor is advanced to the later of them.
+    """
+    timestamps = [
+        i for i in (upstream_row.get("last_updated"), upstream_row.get("insert_date")) if i
+    ]
+    if not timestamps:
+        return None
+    return max(timestamps)
+
+
 def load_appointments_since(last_updated):
     """
     Loads appointments from the upstream table that have
     been reported since last_updated.
 
+    Advances the appointments SyncCursor to the most recent
+    upstream timestamp.
+
     Returns the created appointment models
     """
     api = ProdAPI()
     query_start = time.time()
-    upstream_rows = api.execute_hospital_query(
-        Q_GET_APPOINTMENTS_SINCE,
-        params={'last_updated': last_updated}
-    )
+    if settings.UPSTREAM_COHORT_FILTER:
+        upstream_rows = api.execute_hospital_query_for_cohort(
+            Q_GET_APPOINTMENTS_SINCE_FOR_COHORT,
+            params={'last_updated': last_updated}
+        )
+    else:
+        upstream_rows = api.execute_hospital_query(
+            Q_GET_APPOINTMENTS_SINCE,
+            params={'last_updated': last_updated}
+        )
     query_end = time.time()
     logger.info(f"Appointments: queries {len(upstream_rows)} rows in {query_end - query_start}s")
-    created = update_appointments_from_query_result(upstream_rows)
+    with transaction.atomic():
+        created = update_appointments_from_query_result(upstream_rows)
+        SyncCursor.advance(
+            constants.APPOINTMENTS_SYNC_CURSOR,
+            [get_modified(i) for i in upstream_rows]
+        )
     load_end = time.time()
     logger.info(f'Appointments: created {len(created)} in {load_end - query_end}')
     return created
@@ -111,12 +150,11 @@ def update_appointments_from_query_result(upstream_rows):
             upstream_row
         )
     appointment_id_to_upstream_row = {}
-    # get the appointment id with the most recent update date
-    # failing that use the insert date
+    # get the appointment id with the most recent update or insert date
     for appointent_id, rows in appointment_id_to_upstream_rows.items():
         rows = sorted(
             rows,
-            key=lambda x: x["last_updated"] or x["insert_date"],
+            key=get_modified,
             reverse=True
         )
         if len(rows) > 1:
@@ -200,20 +238,27 @@ def update_appointments_from_query_result(upstream_rows):
     return to_create
 
 
+def fetch_appointments(mrns):
+    """
+    Returns the upstream appointment rows for MRNS
+    """
+    api = ProdAPI()
+    appointments = []
+    mrn_to_rows = api.execute_hospital_query_for_mrns(
+        Q_GET_ALL_PATIENT_APPOINTMENTS, mrns, 'vPatient_Number'
+    )
+    for rows in mrn_to_rows.values():
+        appointments.extend(rows)
+    return appointments
+
+
 def load_appointments(patient):
     """
     Load any upstream appointment data we may not have for PATIENT
     """
-    api = ProdAPI()
     mrn = patient.demographics().hospital_number
     other_mrns = list(
         patient.mergedmrn_set.values_list('mrn', flat=True)
     )
     all_mrns = [mrn] + other_mrns
-    appointments = []
-    for mrn in all_mrns:
-        appointments.extend(api.execute_hospital_query(
-            Q_GET_ALL_PATIENT_APPOINTMENTS,
-            params={'mrn': mrn}
-        ))
-    update_appointments_from_query_result(appointments)
+    update_appointments_from_query_result(fetch_appointments(all_mrns))
@@ -7,6 +7,7 @@ import time
 from django.utils import timezone
 from django.core.management import BaseCommand
 from plugins.monitoring.models import Fact
+from intrahospital_api.models import SyncCursor
 from plugins.appointments import loader, logger, constants, models
 
 
@@ -15,7 +16,10 @@ class Command(BaseCommand):
         two_hours_ago = timezone.now() - datetime.timedelta(hours=2)
         time_start = time.time()
         try:
-            created = loader.load_appointments_since(two_hours_ago)
+            since = SyncCursor.get_since(
+                constants.APPOINTMENTS_SYNC_CURSOR, two_hours_ago
+            )
+            created = loader.load_appointments_since(since)
             time_end = time.time()
             Fact.objects.create(
                 when=timezone.now(),
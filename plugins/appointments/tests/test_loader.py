@@ -4,12 +4,14 @@ Unittests for the plugins.appointments.loader module
 from unittest import mock
 import datetime
 
+from django.test import override_settings
 from django.utils import timezone
 from opal.core.test import OpalTestCase
 
 from plugins.appointments.models import Appointment
 
-from plugins.appointments import loader
+from plugins.appointments import loader, constants
+from intrahospital_api.models import SyncCursor
 
 
 class LoadAppointmentTestCase(OpalTestCase):
@@ -33,13 +35,25 @@ class LoadAppointmentTestCase(OpalTestCase):
         }
 
         with mock.patch.object(loader, 'ProdAPI') as mock_api:
-            mock_api.return_value.execute_hospital_query.return_value = [appointment_data]
+            mock_api.return_value.execute_hospital_query_for_mrns.return_value = {
+                '2345': [appointment_data]
+            }
 
             loader.load_appointments(self.patient)
 
 
         self.assertEqual('CONFIRMED', self.patient.appointments.get().status_code)
 
+    def test_load_appointments_queries_merged_mrns(self):
+        self.patient.mergedmrn_set.create(mrn="1234")
+        with mock.patch.object(loader, 'ProdAPI') as mock_api:
+            mock_api.return_value.execute_hospital_query_for_mrns.return_value = {}
+            loader.load_appointments(self.patient)
+        mock_api.return_value.execute_hospital_query_for_mrns.assert_called_once_with(
+            loader.Q_GET_ALL_PATIENT_APPOINTMENTS,
+            ["2345", "1234"],
+            "vPatient_Number"
+        )
 
     @mock.patch('plugins.appointments.loader.get_changed_appointment_fields')
     def test_load_apppointment_some_exist(self, get_changed_appointment_fields):
@@ -69,9 +83,99 @@ class LoadAppointmentTestCase(OpalTestCase):
         }
 
         with mock.patch.object(loader, 'ProdAPI') as mock_api:
-            mock_api.return_value.execute_hospital_query.return_value = [appointment_data]
+            mock_api.return_value.execute_hospital_query_for_mrns.return_value = {
+                '2345': [appointment_data]
+            }
 
             loader.load_appointments(self.patient)
 
 
         self.assertEqual('CONFIRMED', self.patient.appointments.get().status_code)
+
+
+class LoadAppointmentsSinceTestCase(OpalTestCase):
+    def setUp(self):
+        p, e = self.new_patient_and_episode_please()
+        p.demographics_set.update(
+            hospital_number="2345"
+        )
+        self.patient = p
+        self.now = datetime.datetime.now()
+        self.appointment_data = {
+            'vPatient_Number'           : '2345',
+            'Appointment_ID'            : '1234',
+            'Appointment_Start_Datetime': self.now,
+            'Appointment_Status_Code'   : 'CONFIRMED',
+            'insert_date'               : self.now,
+            'last_updated'              : None,
+            'HL7_Message_ID'            : '4567',
+        }
+
+    def test_load_appointments_since(self):
+        since = timezone.now()
+        with mock.patch.object(loader, 'ProdAPI') as mock_api:
+            mock_api.return_value.execute_hospital_query.return_value = [
+                self.appointment_data
+            ]
+            created = loader.load_appointments_since(since)
+        self.assertEqual(len(created), 1)
+        mock_api.return_value.execute_hospital_query.assert_called_once_with(
+            loader.Q_GET_APPOINTMENTS_SINCE,
+            params={'last_updated': since}
+        )
+        self.assertEqual(
+            SyncCursor.objects.get(
+                feed=constants.APPOINTMENTS_SYNC_CURSOR
+            ).last_synced,
+            timezone.make_aware(self.now)
+        )
+
+    def test_load_appointments_since_inserted_after_updated(self):
+        since = timezone.now()
+        self.appointment_data['last_updated'] = self.now - datetime.timedelta(days=1)
+        with mock.patch.object(loader, 'ProdAPI') as mock_api:
+            mock_api.return_value.execute_hospital_query.return_value = [
+                self.appointment_data
+            ]
+            loader.load_appointments_since(since)
+        self.assertEqual(
+            SyncCursor.objects.get(
+                feed=constants.APPOINTMENTS_SYNC_CURSOR
+            ).last_synced,
+            timezone.make_aware(self.now)
+        )
+
+    def test_update_uses_the_most_recently_modified_row(self):
+        yesterday = self.now - datetime.timedelta(days=1)
+        older = dict(self.appointment_data)
+        older.update(
+            id=1,
+            last_updated=yesterday,
+            insert_date=yesterday - datetime.timedelta(days=1),
+            Appointment_Status_Code='CANCELLED'
+        )
+        newer = dict(self.appointment_data)
+        newer.update(
+            id=2,
+            last_updated=yesterday - datetime.timedelta(days=1),
+            insert_date=self.now
+        )
+        loader.update_appointments_from_query_result([older, newer])
+        self.assertEqual(
+            'CONFIRMED', self.patient.appointments.get().status_code
+        )
+
+    @override_settings(UPSTREAM_COHORT_FILTER=True)
+    def test_load_appointments_since_cohort_filter(self):
+        since = timezone.now()
+        with mock.patch.object(loader, 'ProdAPI') as mock_api:
+            mock_api.return_value.execute_hospital_query_for_cohort.return_value = [
+                self.appointment_data
+            ]
+            created = loader.load_appointments_since(since)
+        self.assertEqual(len(created), 1)
+        mock_api.return_value.execute_hospital_query_for_cohort.assert_called_once_with(
+            loader.Q_GET_APPOINTMENTS_SINCE_FOR_COHORT,
+            params={'last_updated': since}
+        )
+        self.assertFalse(mock_api.return_value.execute_hospital_query.called)
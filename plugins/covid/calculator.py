@@ -1,12 +1,23 @@
 """
 Calculates statistics for the Covid 19 Dashboard
+
+calculate() rebuilds the dashboard from every covid test we hold.
+
+calculate_incremental() only looks at the patients whose covid tests
+have been created or updated since shortly before the last run, and
+updates the reporting days and first positive records that they
+affect in place.
+Changes that do not save a covid test, for example deleting one, are
+only picked up by calculate().
 """
 import collections
 import datetime
 
+from django.db.models import Count, Min, Q
 from django.utils import timezone
 
 from elcid.models import Demographics
+from intrahospital_api.models import SyncCursor
 from plugins.labtests.models import LabTest
 
 from plugins.covid import constants, lab, models
@@ -21,36 +32,45 @@ class Day(object):
         self.deaths            = 0
 
 
+# The CovidReportingDay fields calculated from tests
+TEST_FIELDS = [
+    'tests_ordered',
+    'tests_resulted',
+    'patients_resulted',
+    'patients_positive',
+]
 
-def calculate_daily_reports():
+
+def get_junk_patient_ids():
+    return set(Demographics.objects.filter(
+        hospital_number__in=constants.KNOWN_JUNK_MRNS
+    ).values_list('patient_id', flat=True))
+
+
+def get_coronavirus_tests():
+    return LabTest.objects.filter(
+        test_name__in=lab.COVID_19_TEST_NAMES
+    )
+
+
+def calculate_test_figures(coronavirus_tests, junk_patient_ids):
     """
-    Calculate five numbers for each day:
+    Takes covid tests, ordered by datetime_ordered with their
+    observations prefetched.
+
+    Calculate four numbers for each day:
 
     - Tests ordered
     - Tests resulted
     - Patients first resulted
     - Patients first positive
-    - Deaths
+
+    Returns ({date: Day}, {patient id: date first positive})
     """
     days                   = collections.defaultdict(Day)
-    positive_patients_seen = set()
+    first_positive         = {}
     resulted_patients_seen = set()
 
-    junk_patient_ids = [
-        d.patient_id for d in Demographics.objects.filter(
-            hospital_number__in=constants.KNOWN_JUNK_MRNS
-        )
-    ]
-
-    coronavirus_tests = LabTest.objects.filter(
-        test_name__in=lab.COVID_19_TEST_NAMES
-    )
-    coronavirus_tests = coronavirus_tests.order_by('datetime_ordered').prefetch_related(
-        'observation_set'
-    )
-
-    first_test_date = coronavirus_tests[0].datetime_ordered.date()
-
     for test in coronavirus_tests:
         if test.patient_id in junk_patient_ids:
             continue # We are uninterested in tests performed on Scooby Doo etc
@@ -69,55 +89,239 @@ def calculate_daily_reports():
                 days[day].patients_resulted += 1
 
             if lab.positive(test):
-                if test.patient_id in positive_patients_seen:
+                if test.patient_id in first_positive:
                     continue # This is not the first positive test so ignore it
                 else:
-                    positive_patients_seen.add(test.patient_id)
+                    first_positive[test.patient_id] = day
                     days[day].patients_positive += 1
-                    covid_patient = models.CovidPatient(
-                        patient=test.patient, date_first_positive=day
-                    )
-                    covid_patient.save()
 
+    return days, first_positive
+
+
+def calculate_deaths(junk_patient_ids):
+    """
+    Returns {date of death: number of deaths} of the patients
+    in the covid cohort who died after the first covid test.
+    """
+    first_test_datetime = get_coronavirus_tests().aggregate(
+        Min('datetime_ordered')
+    )['datetime_ordered__min']
+    if first_test_datetime is None:
+        return {}
 
     deceased_patients = Demographics.objects.filter(
         death_indicator=True,
-        date_of_death__gte=first_test_date,
-        patient_id__in=positive_patients_seen
-    )
-    for demographic in deceased_patients:
-        if demographic.patient_id in junk_patient_ids:
-            continue # We are uninterested in the death of Scooby Doo etc
-
-        days[demographic.date_of_death].deaths += 1
-
-    for date, day in days.items():
-        covid_day = models.CovidReportingDay(
-            date=date,
-            tests_ordered=day.tests_ordered,
-            tests_resulted=day.tests_resulted,
-            patients_resulted=day.patients_resulted,
-            patients_positive=day.patients_positive,
-            deaths=day.deaths
-        )
-        covid_day.save()
+        date_of_death__gte=first_test_datetime.date(),
+        patient_id__in=models.CovidPatient.objects.values('patient_id')
+    ).exclude(
+        # We are uninterested in the death of Scooby Doo etc
+        patient_id__in=junk_patient_ids
+    ).values('date_of_death').annotate(deaths=Count('id'))
+    return {i['date_of_death']: i['deaths'] for i in deceased_patients}
+
+
+def update_covid_patients(patient_ids, first_positive):
+    """
+    Updates the CovidPatients of PATIENT_IDS in place to match
+    FIRST_POSITIVE, {patient id: date first positive}
+    """
+    existing = models.CovidPatient.objects.filter(patient_id__in=patient_ids)
+    to_update = []
+    to_delete = []
+    seen = set()
+
+    for covid_patient in existing:
+        if covid_patient.patient_id not in first_positive:
+            to_delete.append(covid_patient.id)
+            continue
+        seen.add(covid_patient.patient_id)
+        date_first_positive = first_positive[covid_patient.patient_id]
+        if covid_patient.date_first_positive != date_first_positive:
+            covid_patient.date_first_positive = date_first_positive
+            to_update.append(covid_patient)
 
+    models.CovidPatient.objects.filter(id__in=to_delete).delete()
+    models.CovidPatient.objects.bulk_update(to_update, ['date_first_positive'])
+    models.CovidPatient.objects.bulk_create([
+        models.CovidPatient(patient_id=patient_id, date_first_positive=date)
+        for patient_id, date in first_positive.items()
+        if patient_id not in seen
+    ])
+
+
+def update_reporting_days(days, deaths, since=None):
+    """
+    Updates the CovidReportingDays in place.
+
+    DAYS is {date: Day} of the figures calculated from tests,
+    for the days on or after SINCE, or for all days if SINCE is None.
+
+    DEATHS is {date: number of deaths} for all days.
+
+    Days with nothing to report are removed apart from yesterday,
+    which the dashboard always displays.
+    """
     yesterday = datetime.date.today() - datetime.timedelta(days=1)
-    if yesterday not in days:
-        models.CovidReportingDay.objects.create(
-            date=yesterday, tests_ordered=0, tests_resulted=0,
-            patients_resulted=0, patients_positive=0, deaths=0
+    existing = {i.date: i for i in models.CovidReportingDay.objects.all()}
+    to_create = []
+    to_update = []
+    to_delete = []
+
+    for date in set(existing) | set(days) | set(deaths) | {yesterday}:
+        reporting_day = existing.get(date)
+        if reporting_day is None:
+            reporting_day = models.CovidReportingDay(date=date)
+
+        values = {}
+        if since is None or date >= since:
+            day = days.get(date, Day())
+            for field in TEST_FIELDS:
+                values[field] = getattr(day, field)
+        else:
+            for field in TEST_FIELDS:
+                values[field] = getattr(reporting_day, field) or 0
+        values['deaths'] = deaths.get(date, 0)
+
+        if not any(values.values()) and date != yesterday:
+            if reporting_day.id:
+                to_delete.append(reporting_day.id)
+            continue
+
+        changed = False
+        for field, value in values.items():
+            if getattr(reporting_day, field) != value:
+                setattr(reporting_day, field, value)
+                changed = True
+
+        if reporting_day.id is None:
+            to_create.append(reporting_day)
+        elif changed:
+            to_update.append(reporting_day)
+
+    models.CovidReportingDay.objects.filter(id__in=to_delete).delete()
+    models.CovidReportingDay.objects.bulk_update(
+        to_update, TEST_FIELDS + ['deaths']
+    )
+    models.CovidReportingDay.objects.bulk_create(to_create)
+
+
+def calculate_daily_reports():
+    """
+    Calculate five numbers for each day from all covid tests:
+
+    - Tests ordered
+    - Tests resulted
+    - Patients first resulted
+    - Patients first positive
+    - Deaths
+    """
+    junk_patient_ids = get_junk_patient_ids()
+
+    coronavirus_tests = get_coronavirus_tests().order_by(
+        'datetime_ordered', 'id'
+    ).prefetch_related(
+        'observation_set'
+    )
+
+    days, first_positive = calculate_test_figures(
+        coronavirus_tests, junk_patient_ids
+    )
+    models.CovidPatient.objects.bulk_create([
+        models.CovidPatient(patient_id=patient_id, date_first_positive=date)
+        for patient_id, date in first_positive.items()
+    ])
+    update_reporting_days(days, calculate_deaths(junk_patient_ids))
+
+
+def calculate_changed_daily_reports(since):
+    """
+    Recalculates the daily reports for the covid tests that
+    have been created or updated since SINCE.
+
+    Figures are recalculated for every day on or after the date the
+    earliest changed test was ordered. Those days are calculated from
+    the whole history of each patient with a test ordered or resulted
+    in that time, so patients are still only counted on the day they
+    were first resulted or first positive.
+
+    Deaths are always recalculated for all days.
+    """
+    junk_patient_ids = get_junk_patient_ids()
+    coronavirus_tests = get_coronavirus_tests()
+
+    first_changed = coronavirus_tests.filter(
+        updated_at__gte=since
+    ).aggregate(Min('datetime_ordered'))['datetime_ordered__min']
+
+    days = {}
+    since_date = None
+
+    if first_changed is not None:
+        since_date = first_changed.date()
+        since_datetime = datetime.datetime.combine(
+            since_date, datetime.time.min, tzinfo=datetime.timezone.utc
+        )
+        patient_ids = coronavirus_tests.filter(
+            Q(datetime_ordered__gte=since_datetime) |
+            Q(observation__observation_datetime__gte=since_datetime)
+        ).values('patient_id')
+        tests = list(coronavirus_tests.filter(
+            patient_id__in=patient_ids
+        ).order_by(
+            'datetime_ordered', 'id'
+        ).prefetch_related(
+            'observation_set'
+        ))
+        all_days, first_positive = calculate_test_figures(
+            tests, junk_patient_ids
         )
+        days = {
+            date: day for date, day in all_days.items() if date >= since_date
+        }
+        update_covid_patients(patient_ids, first_positive)
+
+    update_reporting_days(
+        days,
+        calculate_deaths(junk_patient_ids),
+        since=since_date or datetime.date.max
+    )
 
 
 def calculate():
     """
     Main entrypoint for calculating figures related to Covid 19.
+
+    Rebuilds the dashboard from scratch.
     """
+    started = timezone.now()
     models.CovidDashboard.objects.all().delete()
     models.CovidReportingDay.objects.all().delete()
     models.CovidPatient.objects.all().delete()
 
     calculate_daily_reports()
-    dashboard = models.CovidDashboard(last_updated=timezone.now())
+    dashboard = models.CovidDashboard(last_updated=started)
+    dashboard.save()
+
+
+def calculate_incremental():
+    """
+    Updates the figures related to Covid 19 for the covid tests
+    that have changed since the dashboard was last calculated.
+
+    If the dashboard has never been calculated it is rebuilt.
+
+    Tests saved in a transaction that was still open when the
+    dashboard was last calculated have an updated_at before it,
+    so we include tests updated up to SyncCursor.OVERLAP before it.
+    """
+    dashboard = models.CovidDashboard.objects.first()
+    if dashboard is None:
+        calculate()
+        return
+
+    started = timezone.now()
+    calculate_changed_daily_reports(
+        dashboard.last_updated - SyncCursor.OVERLAP
+    )
+    dashboard.last_updated = started
     dashboard.save()
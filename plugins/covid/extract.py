@@ -1,22 +1,30 @@
 """
 Generates a standard extract of covid data
 """
+import bisect
 import csv
 import datetime
 import os
+from collections import defaultdict
 
 from django.conf import settings
+from django.db.models import Prefetch, Q, prefetch_related_objects
+from django.utils import timezone
 from opal import models as opal_models
 
 from elcid.utils import mkdir_p
 from plugins.icu.models import ICUHandover
 from plugins.labtests.models import Observation
 
-from plugins.covid import models
+from plugins.covid import logger, models
 
 EXTRACT_FILE_PATH = os.path.join(
     settings.COVID_EXTRACT_LOCATION, 'covid.extract.csv')
 
+# The number of patients whose observations and
+# subrecords are fetched together
+CHUNK_SIZE = 500
+
 HEADERS = [
     'elcid_id',
     'MRN',
@@ -269,119 +277,274 @@ Fibrinogen can be ordered as CLOTING SCREEN
 """
 
 
-def get_admission_labs(patient, admission_date):
+def to_datetime(some_date):
+    """
+    Observations are compared against dates as midnight
+    of that day, as they are when filtering a DateTimeField
+    """
+    if isinstance(some_date, datetime.datetime):
+        return some_date
+    return timezone.make_aware(
+        datetime.datetime.combine(some_date, datetime.time.min)
+    )
+
+
+def to_date(some_date):
+    if isinstance(some_date, datetime.datetime):
+        return some_date.date()
+    return some_date
+
+
+def get_observations(patient_ids):
+    """
+    Returns the TEST_CODES observations of PATIENT_IDS in a single query
+    as {patient id: {(test name, observation name): ([observation datetimes], [observation values])}}
+
+    The datetimes are sorted so the closest observations
+    to a date can be found with bisect.
+    """
+    observation_filter = Q()
+    for test_name, observation_names in TEST_CODES:
+        observation_filter |= Q(
+            test__test_name=test_name, observation_name__in=observation_names
+        )
+    observations = Observation.objects.filter(
+        test__patient_id__in=patient_ids
+    ).filter(
+        observation_filter
+    ).exclude(
+        observation_datetime=None
+    ).order_by('observation_datetime', 'id').values_list(
+        'test__patient_id',
+        'test__test_name',
+        'observation_name',
+        'observation_datetime',
+        'observation_value',
+    )
+    result = defaultdict(dict)
+    for patient_id, test_name, obs_code, obs_datetime, obs_value in observations.iterator():
+        key = (test_name, obs_code,)
+        if key not in result[patient_id]:
+            result[patient_id][key] = ([], [])
+        datetimes, values = result[patient_id][key]
+        datetimes.append(obs_datetime)
+        values.append(obs_value)
+    return result
+
+
+def get_lab_columns(observation):
+    """
+    Takes an (observation datetime, observation value) or None
+    and returns the value and datetime columns
+    """
+    if observation is None:
+        return ["", ""]
+    obs_datetime, obs_value = observation
+    return [obs_value.split('~')[0], obs_datetime]
+
+
+def get_first_observation(observations, admission_date):
+    """
+    Takes ([observation datetimes], [observation values]) and returns
+    the (observation datetime, observation value) of the first
+    observation on or after the admission date.
+    """
+    datetimes, values = observations
+    idx = bisect.bisect_left(datetimes, to_datetime(admission_date))
+    if idx < len(datetimes):
+        return datetimes[idx], values[idx]
+
 
+def get_admission_labs(observations, admission_date):
+    """
+    Takes a patient's observations as returned by get_observations
+    """
     if admission_date is None:
         return [''] * 48 # empty
 
     labs = []
 
-    for test_name, observations in TEST_CODES:
-        for obs_code in observations:
-
-            observation = Observation.objects.filter(
-                test__patient=patient,
-            ).filter(
-                test__test_name=test_name
-            ).filter(
-                observation_name=obs_code
-            ).filter(
-                observation_datetime__gte=admission_date
-            ).order_by('observation_datetime').first()
-
-            if observation:
-                labs.append(observation.observation_value.split('~')[0])
-                labs.append(observation.observation_datetime)
-            else:
-                labs += ["", ""]
+    for test_name, obs_codes in TEST_CODES:
+        for obs_code in obs_codes:
+            observation = None
+            if (test_name, obs_code,) in observations:
+                observation = get_first_observation(
+                    observations[(test_name, obs_code,)], admission_date
+                )
+            labs += get_lab_columns(observation)
 
     return labs
 
 
-def get_closest_observation(patient, test_name, obs_code, followup_date):
+def get_closest_observation(observations, followup_date):
     """
-    Look for the observation with the nearest observation date 90 days
-    either side of the follow up date.
+    Takes ([observation datetimes], [observation values]) and returns
+    the (observation datetime, observation value) of the observation
+    with the nearest observation date 90 days either side of the
+    follow up date.
     """
-    observation_qs = Observation.objects.filter(
-        test__patient=patient,
-    ).filter(
-        test__test_name=test_name
-    ).filter(
-        observation_name=obs_code
-    )
+    datetimes, values = observations
+    followup_datetime = to_datetime(followup_date)
+    earlier_obs = None
+    later_obs = None
+
     # the closest obs that happened before the follow up date
-    earlier_obs = observation_qs.filter(
-        observation_datetime__gte=followup_date-datetime.timedelta(days=90)
-    ).filter(
-        observation_datetime__lte=followup_date
-    ).order_by('-observation_datetime').first()
+    idx = bisect.bisect_right(datetimes, followup_datetime) - 1
+    if idx >= 0 and datetimes[idx] >= followup_datetime - datetime.timedelta(days=90):
+        earlier_obs = (datetimes[idx], values[idx],)
 
     # the closest obs that happened after the follow up date
-    later_obs = observation_qs.filter(
-        observation_datetime__gte=followup_date
-    ). filter(
-        observation_datetime__lte=followup_date+datetime.timedelta(days=90)
-    ).order_by('observation_datetime').first()
+    idx = bisect.bisect_left(datetimes, followup_datetime)
+    if idx < len(datetimes) and datetimes[idx] <= followup_datetime + datetime.timedelta(days=90):
+        later_obs = (datetimes[idx], values[idx],)
 
     # If there is no max obs, or there is no min obs
     # return the one there is.
     # If there is neither, return None
     if not earlier_obs or not later_obs:
         return earlier_obs or later_obs
-    earlier_diff = abs((followup_date - earlier_obs.observation_datetime.date()).days)
-    later_diff = abs((followup_date - later_obs.observation_datetime.date()).days)
+    followup_day = to_date(followup_date)
+    earlier_diff = abs((followup_day - earlier_obs[0].date()).days)
+    later_diff = abs((followup_day - later_obs[0].date()).days)
     if later_diff < earlier_diff:
         return later_obs
     return earlier_obs
 
 
-def get_followup_labs(patient, followup_date):
+def get_followup_labs(observations, followup_date):
+    """
+    Takes a patient's observations as returned by get_observations
+    """
     if followup_date is None:
         return [''] * 48 # empty
 
     labs = []
 
-    for test_name, observations in TEST_CODES:
-        for obs_code in observations:
-            observation = get_closest_observation(patient, test_name, obs_code, followup_date)
-            if observation:
-                labs.append(observation.observation_value.split('~')[0])
-                labs.append(observation.observation_datetime)
-            else:
-                labs += ["", ""]
+    for test_name, obs_codes in TEST_CODES:
+        for obs_code in obs_codes:
+            observation = None
+            if (test_name, obs_code,) in observations:
+                observation = get_closest_observation(
+                    observations[(test_name, obs_code,)], followup_date
+                )
+            labs += get_lab_columns(observation)
 
     return labs
 
 
+def get_only(instances, model):
+    """
+    The equivalent of QuerySet.get() for prefetched INSTANCES of MODEL
+    """
+    if not instances:
+        raise model.DoesNotExist(
+            '{} matching query does not exist.'.format(model.__name__)
+        )
+    if len(instances) > 1:
+        raise model.MultipleObjectsReturned(
+            'get() returned more than one {}'.format(model.__name__)
+        )
+    return instances[0]
+
+
+def prefetch_cohort(covid_patients):
+    """
+    Fetches the subrecords used by get_covid_extract_row
+    for all of COVID_PATIENTS
+    """
+    prefetch_related_objects(
+        [i.patient for i in covid_patients],
+        'demographics_set',
+        'contactinformation_set',
+        Prefetch(
+            'icuhandover_set',
+            queryset=ICUHandover.objects.order_by('id'),
+            to_attr='icu_handovers'
+        ),
+        Prefetch(
+            'episode_set',
+            queryset=opal_models.Episode.objects.filter(
+                category_name='COVID-19'
+            ).prefetch_related(
+                'covidcomorbidities_set',
+                Prefetch(
+                    'covidadmission_set',
+                    queryset=models.CovidAdmission.objects.order_by(
+                        'date_of_admission'
+                    ),
+                    to_attr='admissions'
+                ),
+                Prefetch(
+                    'covidfollowupcall_set',
+                    queryset=models.CovidFollowUpCall.objects.exclude(
+                        follow_up_outcome__in=[
+                            models.CovidFollowUpCall.UNREACHABLE,
+                            models.CovidFollowUpCall.UNABLE_TO_COMPLETE
+                        ]
+                    ).order_by('-when'),
+                    to_attr='followups'
+                ),
+            ),
+            to_attr='covid_episodes'
+        ),
+    )
+
+
+def clear_prefetched(covid_patients):
+    """
+    Removes what prefetch_cohort fetched for COVID_PATIENTS
+    so that a chunk's subrecords can be garbage collected
+    once its rows have been built
+    """
+    for covid_patient in covid_patients:
+        patient = covid_patient.patient
+        patient.__dict__.pop('_prefetched_objects_cache', None)
+        patient.__dict__.pop('icu_handovers', None)
+        patient.__dict__.pop('covid_episodes', None)
 
 
-def get_covid_extract_row(covid_patient):
+def get_covid_codes(patient_ids):
+    """
+    Returns {patient id: [the covid codes of their imaging reports]}
+    """
+    result = defaultdict(list)
+    coded_reports = models.CovidReportCode.objects.filter(
+        report__patient_id__in=patient_ids
+    ).order_by('id').values_list('report__patient_id', 'covid_code')
+    for patient_id, covid_code in coded_reports:
+        result[patient_id].append(covid_code)
+    return result
 
+
+def get_covid_extract_row(covid_patient, observations, covid_codes):
+    """
+    Takes a COVID_PATIENT that has been through prefetch_cohort,
+    their OBSERVATIONS as returned by get_observations and
+    their imaging report COVID_CODES.
+    """
     patient       = covid_patient.patient
-    covid_episode = patient.episode_set.get(category_name='COVID-19')
-    demographics  = patient.demographics()
-    contact       = patient.contactinformation_set.get()
-    comorbidities = covid_episode.covidcomorbidities_set.get()
-
-    if covid_episode.covidadmission_set.count() > 0:
-        admission = covid_episode.covidadmission_set.order_by('date_of_admission').last()
-    elif covid_episode.covidadmission_set.count() == 0:
-        admission = models.CovidAdmission()
+    covid_episode = get_only(patient.covid_episodes, opal_models.Episode)
+    demographics  = get_only(
+        patient.demographics_set.all(), patient.demographics_set.model
+    )
+    contact       = get_only(
+        patient.contactinformation_set.all(),
+        patient.contactinformation_set.model
+    )
+    comorbidities = get_only(
+        covid_episode.covidcomorbidities_set.all(), models.CovidComorbidities
+    )
 
-    followups = models.CovidFollowUpCall.objects.filter(
-        episode=covid_episode
-    ).exclude(follow_up_outcome__in=[
-        models.CovidFollowUpCall.UNREACHABLE,
-        models.CovidFollowUpCall.UNABLE_TO_COMPLETE
-    ]).order_by('-when')
+    if covid_episode.admissions:
+        admission = covid_episode.admissions[-1]
+    else:
+        admission = models.CovidAdmission()
 
-    if followups.count() == 0:
+    if covid_episode.followups:
+        call = covid_episode.followups[0]
+    else:
         call = models.CovidFollowUpCall()
 
-    if followups.count() > 0:
-        call = followups[0]
-
     row = [
         patient.id,
         demographics.hospital_number,
@@ -453,12 +616,9 @@ def get_covid_extract_row(covid_patient):
         str(covid_patient.date_first_positive)
     ]
 
-    row += get_admission_labs(patient, admission.date_of_admission)
+    row += get_admission_labs(observations, admission.date_of_admission)
 
-    coded_reports = models.CovidReportCode.objects.filter(
-        report__patient_id=patient.id
-    )
-    row.append(';'.join([report.covid_code for report in coded_reports]))
+    row.append(';'.join(covid_codes))
 
     row += [
         admission.systolic_bp,
@@ -482,13 +642,12 @@ def get_covid_extract_row(covid_patient):
         admission.other_drugs
         ]
 
-    icu = ICUHandover.objects.filter(patient=patient).last()
-    if icu:
-        row.append(str(icu.date_itu_admission))
+    if patient.icu_handovers:
+        row.append(str(patient.icu_handovers[-1].date_itu_admission))
     else:
         row.append("")
 
-    row += get_followup_labs(patient, call.when)
+    row += get_followup_labs(observations, call.when)
 
     row += [
         call.when,
@@ -537,28 +696,68 @@ def get_covid_extract_row(covid_patient):
 
 
 
+def get_cohort():
+    """
+    Returns the CovidPatients in the extract, including unsaved
+    CovidPatients for patients with a COVID-19 episode who
+    are not in the cohort.
+    """
+    cohort = list(
+        models.CovidPatient.objects.select_related('patient').order_by('id')
+    )
+    syndromic = opal_models.Patient.objects.filter(
+        episode__category_name='COVID-19', covid_patient__isnull=True
+    ).distinct().order_by('id')
+    cohort += [models.CovidPatient(patient=patient) for patient in syndromic]
+    return cohort
+
+
+def get_extract_rows(covid_patients):
+    """
+    Yields the extract rows of COVID_PATIENTS.
+
+    Observations and subrecords are queried for CHUNK_SIZE
+    patients at a time and released once the chunk's rows
+    have been yielded.
+    """
+    for idx in range(0, len(covid_patients), CHUNK_SIZE):
+        chunk = covid_patients[idx:idx + CHUNK_SIZE]
+        patient_ids = [i.patient_id for i in chunk]
+        prefetch_cohort(chunk)
+        observations = get_observations(patient_ids)
+        covid_codes = get_covid_codes(patient_ids)
+        for covid_patient in chunk:
+            patient_id = covid_patient.patient_id
+            try:
+                row = get_covid_extract_row(
+                    covid_patient,
+                    observations.get(patient_id, {}),
+                    covid_codes.get(patient_id, [])
+                )
+            except Exception:
+                logger.exception(
+                    f"Unable to build the covid extract row for patient {patient_id}"
+                )
+                raise
+            yield row
+        clear_prefetched(chunk)
+
+
 def generate_extract_file():
     """
     Creates a weekly Covid extract and places it on disk so the
     user experiences an instant download.
+
+    Rows are written as they are built to a temporary file which
+    replaces the extract when it is complete.
     """
     mkdir_p(settings.COVID_EXTRACT_LOCATION)
+    tmp_file_path = '{}.tmp'.format(EXTRACT_FILE_PATH)
 
-    fh = open(EXTRACT_FILE_PATH, 'w')
-
-    writer = csv.writer(fh)
-    writer.writerow(HEADERS)
-
-    for patient in models.CovidPatient.objects.all():
-        print(patient)
-        try:
-            writer.writerow(get_covid_extract_row(patient))
-        except:
-            print(f"Error: Patient {patient.patient.id} {patient.patient.demographics().name}")
-            raise
-
-    syndromic = set([e.patient for e in opal_models.Episode.objects.filter(
-            category_name='COVID-19', patient__covid_patient__isnull=True)])
+    with open(tmp_file_path, 'w') as fh:
+        writer = csv.writer(fh)
+        writer.writerow(HEADERS)
+        for row in get_extract_rows(get_cohort()):
+            writer.writerow(row)
 
-    for patient in syndromic:
-        writer.writerow(get_covid_extract_row(models.CovidPatient(patient=patient)))
+    os.replace(tmp_file_path, EXTRACT_FILE_PATH)
@@ -1,7 +1,12 @@
 """
 Helpers for working with Covid 19 testing
 """
+from collections import defaultdict
+
+from django.db.models import F, Q, prefetch_related_objects
+
 from plugins.labtests import models as lab_test_models
+from plugins.labtests import recent_results
 
 
 class CovidTest(object):
@@ -246,49 +251,107 @@ def positive(test):
     return result in covid_test.POSITIVE_RESULTS
 
 
-def get_covid_result_ticker(patient):
+def get_ticker_data(tests):
     """
-    Given a PATIENT, return a list of dictionaries representing the last
-    3 results for each test type, with a timestamp, result string, and test name.
+    Given the COVID 19 plugins.labtests.models.LabTest instances TESTS,
+    most recent first, return the ticker entries of the first 3
+    that have been resulted.
     """
-    ticker = []
+    data = []
 
-    for test in COVID_19_TESTS:
-        data = []
+    for test in tests:
+        if len(data) > 2:
+            break
 
-        tests = lab_test_models.LabTest.objects.filter(
-            test_name=test.TEST_NAME, patient=patient
-        ).order_by('-datetime_ordered').prefetch_related(
-            'observation_set'
-        )
+        if not resulted(test):
+            continue
 
-        for test in tests:
-            if len(data) > 2:
-                continue
+        timestamp = get_resulted_datetime(test)
+        value     = get_result(test)
+        specimen  = get_specimen_type(test)
 
-            if not resulted(test):
-                continue
+        result_string = "{}".format(value)
 
-            timestamp = get_resulted_datetime(test)
-            value     = get_result(test)
-            specimen  = get_specimen_type(test)
+        if specimen:
+            result_string += " ({})".format(specimen)
 
-            result_string = "{}".format(value)
+        data.append(
+            {
+                'date_str' : timestamp.strftime('%d/%m/%Y %H:%M'),
+                'timestamp': timestamp,
+                'name'     : _get_covid_test(test).OBSERVATION_NAME,
+                'value'    : result_string
+            }
+        )
+    return data
 
-            if specimen:
-                result_string += " ({})".format(specimen)
 
-            data.append(
-                {
-                    'date_str' : timestamp.strftime('%d/%m/%Y %H:%M'),
-                    'timestamp': timestamp,
-                    'name'     : _get_covid_test(test).OBSERVATION_NAME,
-                    'value'    : result_string
-                }
-            )
+def get_covid_result_ticker(patient):
+    """
+    Given a PATIENT, return a list of dictionaries representing the last
+    3 results for each test type, with a timestamp, result string, and test name.
+    """
+    return get_covid_result_tickers([patient])[patient.id]
 
-        ticker += data
 
-    ticker = list(reversed(sorted(ticker, key=lambda i: i['timestamp'])))
+def get_covid_result_tickers(patients):
+    """
+    Given PATIENTS, return {patient id: ticker} where ticker is as
+    returned by get_covid_result_ticker.
+
+    The last 3 tests of each type with a resulted observation are
+    fetched for all the patients in a single query. If some of those
+    turn out not to be resulted, e.g. a lateral flow test with a blank
+    first line, we fall back to looking through all the tests of
+    that type for that patient.
+    """
+    patient_ids = [patient.id for patient in patients]
+    resulted_filter = Q()
+    for covid_test in COVID_19_TESTS:
+        resulted_filter |= Q(
+            test_name=covid_test.TEST_NAME,
+            id__in=lab_test_models.Observation.objects.filter(
+                test__patient_id__in=patient_ids,
+                observation_name=covid_test.OBSERVATION_NAME,
+                observation_value__in=covid_test.resulted_values()
+            ).values('test_id')
+        )
+    candidates = recent_results.get_ranked(
+        lab_test_models.LabTest.objects.filter(
+            patient_id__in=patient_ids
+        ).filter(resulted_filter),
+        partition_by=[F('patient_id'), F('test_name')],
+        order_by=[F('datetime_ordered').desc(), F('id').asc()],
+        limit=3
+    )
+    prefetch_related_objects(candidates, 'observation_set')
+    key_to_candidates = defaultdict(list)
+    for candidate in sorted(candidates, key=lambda x: x.row_number):
+        key_to_candidates[
+            (candidate.patient_id, candidate.test_name,)
+        ].append(candidate)
+
+    result = {}
+
+    for patient_id in patient_ids:
+        ticker = []
+
+        for covid_test in COVID_19_TESTS:
+            tests = key_to_candidates[(patient_id, covid_test.TEST_NAME,)]
+            data = get_ticker_data(tests)
+
+            if len(data) < len(tests) and len(tests) == 3:
+                tests = lab_test_models.LabTest.objects.filter(
+                    test_name=covid_test.TEST_NAME, patient_id=patient_id
+                ).order_by('-datetime_ordered').prefetch_related(
+                    'observation_set'
+                )
+                data = get_ticker_data(tests)
+
+            ticker += data
+
+        result[patient_id] = list(
+            reversed(sorted(ticker, key=lambda i: i['timestamp']))
+        )
 
-    return ticker
+    return result
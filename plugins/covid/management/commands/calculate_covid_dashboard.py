@@ -10,7 +10,16 @@ from plugins.covid import calculator
 
 class Command(BaseCommand):
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help="Rebuild the dashboard from all covid tests rather than those that have changed since the last run"
+        )
+
     @transaction.atomic
     def handle(self, *args, **options):
-
-        calculator.calculate()
+        if options['full']:
+            calculator.calculate()
+        else:
+            calculator.calculate_incremental()
@@ -1,9 +1,16 @@
 """
 Unittests for plugins.covid.calculator
 """
+import datetime
+from unittest import mock
+
+from django.core.management import call_command
+from django.utils import timezone
 from opal.core.test import OpalTestCase
 
-from plugins.covid import calculator
+from plugins.covid import calculator, constants, models
+from plugins.labtests.models import LabTest
+from plugins.covid.management.commands import calculate_covid_dashboard
 
 
 class DayTestCase(OpalTestCase):
@@ -16,3 +23,210 @@ class DayTestCase(OpalTestCase):
         self.assertEqual(0, day.patients_positive)
         self.assertEqual(0, day.patients_resulted)
         self.assertEqual(0, day.deaths)
+
+
+class CalculatorTestCase(OpalTestCase):
+    def setUp(self):
+        self.patient, _ = self.new_patient_and_episode_please()
+        self.other_patient, _ = self.new_patient_and_episode_please()
+
+    def create_test(self, patient, ordered, resulted, value):
+        """
+        Takes the day of the month the test was ORDERED and RESULTED
+        """
+        test = patient.lab_tests.create(
+            test_name="2019 NOVEL CORONAVIRUS",
+            datetime_ordered=timezone.make_aware(
+                datetime.datetime(2020, 4, ordered, 10)
+            )
+        )
+        test.observation_set.create(
+            observation_name="2019 nCoV",
+            observation_value=value,
+            observation_datetime=timezone.make_aware(
+                datetime.datetime(2020, 4, resulted, 10)
+            )
+        )
+        return test
+
+    def get_days(self):
+        return {
+            i.date.day: (
+                i.tests_ordered,
+                i.tests_resulted,
+                i.patients_resulted,
+                i.patients_positive,
+                i.deaths,
+            ) for i in models.CovidReportingDay.objects.exclude(
+                date=datetime.date.today() - datetime.timedelta(days=1)
+            )
+        }
+
+    def get_covid_patients(self):
+        return set(models.CovidPatient.objects.values_list(
+            "patient_id", "date_first_positive"
+        ))
+
+    def create_history(self):
+        self.create_test(self.patient, 1, 2, "NOT detected")
+        self.create_test(self.patient, 3, 4, "POSITIVE")
+        self.create_test(self.patient, 5, 6, "POSITIVE")
+        self.create_test(self.other_patient, 3, 4, "Pending")
+
+    def test_calculate(self):
+        self.create_history()
+        calculator.calculate()
+        self.assertEqual(self.get_days(), {
+            1: (1, 0, 0, 0, 0),
+            2: (0, 1, 1, 0, 0),
+            3: (2, 0, 0, 0, 0),
+            4: (0, 1, 0, 1, 0),
+            5: (1, 0, 0, 0, 0),
+            6: (0, 1, 0, 0, 0),
+        })
+        self.assertEqual(
+            self.get_covid_patients(), {(self.patient.id, datetime.date(2020, 4, 4),)}
+        )
+        self.assertTrue(models.CovidReportingDay.objects.filter(
+            date=datetime.date.today() - datetime.timedelta(days=1)
+        ).exists())
+        self.assertEqual(models.CovidDashboard.objects.count(), 1)
+
+    def test_calculate_deaths(self):
+        self.create_history()
+        self.patient.demographics_set.update(
+            death_indicator=True, date_of_death=datetime.date(2020, 4, 10)
+        )
+        self.other_patient.demographics_set.update(
+            death_indicator=True, date_of_death=datetime.date(2020, 4, 10)
+        )
+        calculator.calculate()
+        self.assertEqual(self.get_days()[10], (0, 0, 0, 0, 1))
+
+    def test_calculate_ignores_junk(self):
+        self.create_history()
+        self.patient.demographics_set.update(
+            hospital_number=constants.KNOWN_JUNK_MRNS[0]
+        )
+        calculator.calculate()
+        self.assertEqual(self.get_days(), {3: (1, 0, 0, 0, 0)})
+        self.assertEqual(self.get_covid_patients(), set())
+
+    def test_calculate_incremental_without_a_dashboard(self):
+        self.create_history()
+        calculator.calculate_incremental()
+        days = self.get_days()
+        self.assertEqual(len(days), 6)
+        self.assertEqual(models.CovidDashboard.objects.count(), 1)
+        calculator.calculate()
+        self.assertEqual(self.get_days(), days)
+
+    def test_calculate_incremental(self):
+        self.create_history()
+        calculator.calculate()
+        first_positive_id = models.CovidPatient.objects.get().id
+
+        self.create_test(self.other_patient, 7, 8, "POSITIVE")
+        self.create_test(self.patient, 7, 8, "POSITIVE")
+        calculator.calculate_incremental()
+        days = self.get_days()
+        covid_patients = self.get_covid_patients()
+
+        self.assertEqual(days[7], (2, 0, 0, 0, 0))
+        self.assertEqual(days[8], (0, 2, 1, 1, 0))
+        self.assertTrue(
+            models.CovidPatient.objects.filter(id=first_positive_id).exists()
+        )
+
+        calculator.calculate()
+        self.assertEqual(self.get_days(), days)
+        self.assertEqual(self.get_covid_patients(), covid_patients)
+
+    def test_calculate_incremental_earlier_test(self):
+        self.create_history()
+        calculator.calculate()
+
+        # a positive result for a test ordered before the
+        # patient's first positive
+        self.create_test(self.patient, 2, 3, "POSITIVE")
+        calculator.calculate_incremental()
+        days = self.get_days()
+        covid_patients = self.get_covid_patients()
+        self.assertEqual(
+            covid_patients, {(self.patient.id, datetime.date(2020, 4, 3),)}
+        )
+
+        calculator.calculate()
+        self.assertEqual(self.get_days(), days)
+        self.assertEqual(self.get_covid_patients(), covid_patients)
+
+    def test_calculate_incremental_deaths(self):
+        self.create_history()
+        calculator.calculate()
+        self.patient.demographics_set.update(
+            death_indicator=True, date_of_death=datetime.date(2020, 4, 10)
+        )
+        calculator.calculate_incremental()
+        self.assertEqual(self.get_days()[10], (0, 0, 0, 0, 1))
+
+    def test_calculate_incremental_nothing_changed(self):
+        self.create_history()
+        calculator.calculate()
+        days = self.get_days()
+        last_updated = models.CovidDashboard.objects.get().last_updated
+        calculator.calculate_incremental()
+        self.assertEqual(self.get_days(), days)
+        self.assertGreater(
+            models.CovidDashboard.objects.get().last_updated, last_updated
+        )
+
+    def test_calculate_incremental_test_committed_during_last_run(self):
+        self.create_history()
+        calculator.calculate()
+        test = self.create_test(self.other_patient, 7, 8, "POSITIVE")
+        # the test was saved in a transaction that committed
+        # after the dashboard was calculated
+        LabTest.objects.filter(id=test.id).update(
+            updated_at=models.CovidDashboard.objects.get().last_updated - (
+                datetime.timedelta(minutes=1)
+            )
+        )
+        calculator.calculate_incremental()
+        self.assertEqual(self.get_days()[8], (0, 1, 1, 1, 0))
+
+    def test_calculate_incremental_only_loads_changed_patients(self):
+        self.create_history()
+        LabTest.objects.update(
+            updated_at=timezone.now() - datetime.timedelta(hours=1)
+        )
+        calculator.calculate()
+        self.create_test(self.other_patient, 7, 8, "POSITIVE")
+        with mock.patch.object(
+            calculator,
+            "calculate_test_figures",
+            wraps=calculator.calculate_test_figures
+        ) as calculate_test_figures:
+            calculator.calculate_incremental()
+        tests = calculate_test_figures.call_args[0][0]
+        self.assertEqual(
+            set(i.patient_id for i in tests), {self.other_patient.id}
+        )
+
+
+class CalculateCovidDashboardCommandTestCase(OpalTestCase):
+    def setUp(self):
+        self.cmd = calculate_covid_dashboard.Command()
+
+    @mock.patch.object(calculator, "calculate_incremental")
+    @mock.patch.object(calculator, "calculate")
+    def test_incremental(self, calculate, calculate_incremental):
+        call_command(self.cmd)
+        self.assertTrue(calculate_incremental.called)
+        self.assertFalse(calculate.called)
+
+    @mock.patch.object(calculator, "calculate_incremental")
+    @mock.patch.object(calculator, "calculate")
+    def test_full(self, calculate, calculate_incremental):
+        call_command(self.cmd, "--full")
+        self.assertTrue(calculate.called)
+        self.assertFalse(calculate_incremental.called)
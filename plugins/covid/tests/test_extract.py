@@ -1,77 +1,221 @@
+import csv
 import datetime
+import os
+import tempfile
+from unittest import mock
+
 from django.utils import timezone
 from opal.core.test import OpalTestCase
-from plugins.covid import extract
 
+from plugins.covid import extract, models
 
-class GetClosestObservationTestCase(OpalTestCase):
+
+class GetObservationsTestCase(OpalTestCase):
     def setUp(self):
         self.patient, _ = self.new_patient_and_episode_please()
-        lt_1 = self.patient.lab_tests.create(test_name='test_name')
-        self.obs_1 = lt_1.observation_set.create(
-            observation_name='obs_name'
+
+    def create_observation(self, some_dt, test_name, obs_name, patient=None):
+        if patient is None:
+            patient = self.patient
+        lab_test = patient.lab_tests.create(test_name=test_name)
+        return lab_test.observation_set.create(
+            observation_name=obs_name,
+            observation_datetime=some_dt,
+            observation_value="1"
         )
-        lt_2 = self.patient.lab_tests.create(test_name='test_name')
-        self.obs_2 = lt_2.observation_set.create(
-            observation_name='obs_name'
+
+    def test_get_observations(self):
+        dt_1 = timezone.make_aware(datetime.datetime(2021, 11, 16))
+        dt_2 = timezone.make_aware(datetime.datetime(2021, 11, 15))
+        self.create_observation(dt_1, "C REACTIVE PROTEIN", "C Reactive Protein")
+        self.create_observation(dt_2, "C REACTIVE PROTEIN", "C Reactive Protein")
+        self.create_observation(dt_1, "FULL BLOOD COUNT", "WBC")
+        self.create_observation(None, "FULL BLOOD COUNT", "Hb")
+        self.create_observation(dt_1, "FULL BLOOD COUNT", "Other")
+        self.create_observation(dt_1, "OTHER", "WBC")
+        other_patient, _ = self.new_patient_and_episode_please()
+        self.create_observation(
+            dt_1, "FULL BLOOD COUNT", "WBC", patient=other_patient
         )
-        self.followup_date = datetime.date(2021, 11, 15)
+        with self.assertNumQueries(1):
+            result = extract.get_observations([self.patient.id])
+        self.assertEqual(result, {
+            self.patient.id: {
+                ("C REACTIVE PROTEIN", "C Reactive Protein",): (
+                    [dt_2, dt_1], ["1", "1"]
+                ),
+                ("FULL BLOOD COUNT", "WBC",): ([dt_1], ["1"]),
+            }
+        })
 
-    def test_no_obs(self):
-        self.assertIsNone(
-            extract.get_closest_observation(
-                self.patient, 'test_name', 'obs_name', self.followup_date
+
+class GetAdmissionLabsTestCase(OpalTestCase):
+    def test_first_on_or_after_admission(self):
+        observations = {
+            ("C REACTIVE PROTEIN", "C Reactive Protein",): (
+                [
+                    timezone.make_aware(datetime.datetime(2021, 11, 14, 23)),
+                    timezone.make_aware(datetime.datetime(2021, 11, 15)),
+                    timezone.make_aware(datetime.datetime(2021, 11, 16)),
+                ],
+                ["1", "2~Please note", "3"]
             )
+        }
+        result = extract.get_admission_labs(
+            observations, datetime.date(2021, 11, 15)
         )
+        self.assertEqual(len(result), 48)
+        self.assertEqual(result[12:14], [
+            "2", timezone.make_aware(datetime.datetime(2021, 11, 15))
+        ])
+        self.assertEqual(result[:12], [""] * 12)
 
-    def test_multiple_later_dates(self):
-        self.obs_1.observation_datetime = timezone.make_aware(
-            datetime.datetime(2021, 11, 16)
-        )
-        self.obs_1.save()
-        self.obs_2.observation_datetime = timezone.make_aware(
-            datetime.datetime(2021, 11, 17)
-        )
-        self.obs_2.save()
-        found_obs = extract.get_closest_observation(
-            self.patient, 'test_name', 'obs_name', self.followup_date
+    def test_no_admission_date(self):
+        self.assertEqual(extract.get_admission_labs({}, None), [""] * 48)
+
+
+class GetClosestObservationTestCase(OpalTestCase):
+    def setUp(self):
+        self.followup_date = datetime.date(2021, 11, 15)
+
+    def get_closest_observation(self, *days):
+        datetimes = [
+            timezone.make_aware(datetime.datetime(2021, 11, day)) for day in days
+        ]
+        values = [str(day) for day in days]
+        result = extract.get_closest_observation(
+            (datetimes, values,), self.followup_date
         )
-        self.assertEqual(found_obs.id, self.obs_1.id)
+        if result:
+            return result[1]
+
+    def test_no_obs(self):
+        self.assertIsNone(self.get_closest_observation())
+
+    def test_multiple_later_dates(self):
+        self.assertEqual(self.get_closest_observation(16, 17), "16")
 
     def test_multiple_ealier_dates(self):
-        self.obs_1.observation_datetime = timezone.make_aware(
-            datetime.datetime(2021, 11, 13)
-        )
-        self.obs_1.save()
-        self.obs_2.observation_datetime = timezone.make_aware(
-            datetime.datetime(2021, 11, 14)
-        )
-        self.obs_2.save()
-        found_obs = extract.get_closest_observation(
-            self.patient, 'test_name', 'obs_name', self.followup_date
-        )
-        self.assertEqual(found_obs.id, self.obs_2.id)
+        self.assertEqual(self.get_closest_observation(13, 14), "14")
 
     def test_later_date_vs_earlier_date(self):
-        self.obs_1.observation_datetime = timezone.make_aware(
-            datetime.datetime(2021, 11, 13)
+        self.assertEqual(self.get_closest_observation(13, 16), "16")
+
+    def test_same_distance(self):
+        self.assertEqual(self.get_closest_observation(14, 16), "14")
+
+    def test_on_the_follow_up_date(self):
+        self.assertEqual(self.get_closest_observation(15), "15")
+
+    def test_outside_90_days(self):
+        datetimes = [
+            timezone.make_aware(datetime.datetime(2021, 8, 16)),
+            timezone.make_aware(datetime.datetime(2022, 2, 14)),
+        ]
+        self.assertIsNone(extract.get_closest_observation(
+            (datetimes, ["1", "2"],), self.followup_date
+        ))
+
+    def test_follow_up_datetime(self):
+        self.followup_date = timezone.make_aware(
+            datetime.datetime(2021, 11, 15, 12)
         )
-        self.obs_1.save()
-        self.obs_2.observation_datetime = timezone.make_aware(
-            datetime.datetime(2021, 11, 16)
+        # observations are compared by day
+        self.assertEqual(self.get_closest_observation(14, 16), "14")
+
+
+class GenerateExtractFileTestCase(OpalTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp_dir.name, "covid.extract.csv")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def create_patient(self, hospital_number):
+        patient, episode = self.new_patient_and_episode_please()
+        episode.category_name = "COVID-19"
+        episode.save()
+        patient.demographics_set.update(hospital_number=hospital_number)
+        admission_date = datetime.date(2021, 11, 1)
+        episode.covidadmission_set.create(date_of_admission=admission_date)
+        episode.covidfollowupcall_set.create(
+            when=timezone.make_aware(datetime.datetime(2021, 12, 1))
         )
-        self.obs_2.save()
-        found_obs = extract.get_closest_observation(
-            self.patient, 'test_name', 'obs_name', self.followup_date
+        lab_test = patient.lab_tests.create(test_name="C REACTIVE PROTEIN")
+        lab_test.observation_set.create(
+            observation_name="C Reactive Protein",
+            observation_datetime=timezone.make_aware(
+                datetime.datetime(2021, 11, 2)
+            ),
+            observation_value="5"
         )
-        self.assertEqual(found_obs.id, self.obs_2.id)
+        return patient
 
-    def test_on_the_follow_up_date(self):
-        self.obs_1.observation_datetime = timezone.make_aware(
-            datetime.datetime(2021, 11, 15)
+    def generate_extract_file(self):
+        with mock.patch.object(extract, "EXTRACT_FILE_PATH", self.file_path):
+            with mock.patch.object(extract, "mkdir_p"):
+                extract.generate_extract_file()
+        with open(self.file_path) as fh:
+            return list(csv.DictReader(fh))
+
+    def test_generate_extract_file(self):
+        patient = self.create_patient("111")
+        models.CovidPatient.objects.create(
+            patient=patient, date_first_positive=datetime.date(2021, 10, 30)
         )
-        self.obs_1.save()
-        found_obs = extract.get_closest_observation(
-            self.patient, 'test_name', 'obs_name', self.followup_date
+        syndromic = self.create_patient("222")
+        rows = self.generate_extract_file()
+        self.assertEqual(
+            [(i["elcid_id"], i["MRN"],) for i in rows],
+            [(str(patient.id), "111",), (str(syndromic.id), "222",)]
+        )
+        self.assertEqual(rows[0]["admission_crp"], "5")
+        self.assertEqual(rows[0]["followup_crp"], "5")
+        self.assertEqual(rows[0]["admission_wbc"], "")
+        self.assertEqual(len(rows[0]), len(extract.HEADERS))
+        self.assertFalse(os.path.exists("{}.tmp".format(self.file_path)))
+
+    def test_query_count(self):
+        for idx in range(10):
+            patient = self.create_patient(str(idx))
+            models.CovidPatient.objects.create(
+                patient=patient,
+                date_first_positive=datetime.date(2021, 10, 30)
+            )
+        with self.assertNumQueries(11):
+            rows = self.generate_extract_file()
+        self.assertEqual(len(rows), 10)
+
+    def test_releases_each_chunk(self):
+        for idx in range(3):
+            patient = self.create_patient(str(idx))
+            models.CovidPatient.objects.create(
+                patient=patient,
+                date_first_positive=datetime.date(2021, 10, 30)
+            )
+        cohort = extract.get_cohort()
+        with mock.patch.object(extract, "CHUNK_SIZE", 2):
+            rows = extract.get_extract_rows(cohort)
+            next(rows)
+            next(rows)
+            next(rows)
+            self.assertFalse(
+                hasattr(cohort[0].patient, "_prefetched_objects_cache")
+            )
+            self.assertFalse(hasattr(cohort[0].patient, "covid_episodes"))
+            self.assertFalse(hasattr(cohort[0].patient, "icu_handovers"))
+            self.assertTrue(hasattr(cohort[2].patient, "covid_episodes"))
+            self.assertEqual(len(list(rows)), 0)
+        self.assertFalse(hasattr(cohort[2].patient, "covid_episodes"))
+
+    @mock.patch.object(extract, "logger")
+    @mock.patch.object(extract, "get_covid_extract_row")
+    def test_logs_the_patient_on_error(self, get_covid_extract_row, logger):
+        patient = self.create_patient("111")
+        get_covid_extract_row.side_effect = ValueError("Boom")
+        with self.assertRaises(ValueError):
+            self.generate_extract_file()
+        logger.exception.assert_called_once_with(
+            f"Unable to build the covid extract row for patient {patient.id}"
         )
-        self.assertEqual(found_obs.id, self.obs_1.id)
@@ -1,6 +1,8 @@
 """
 Unittests for the plugins.covid.lab module
 """
+import datetime
+
 from django.utils import timezone
 from opal.core.test import OpalTestCase
 
@@ -80,3 +82,96 @@ class PositiveTestCase(OpalTestCase):
             observation_value='Pending'
         )
         self.assertFalse(lab.positive(test))
+
+
+class GetCovidResultTickerTestCase(OpalTestCase):
+    def setUp(self):
+        self.patient, _ = self.new_patient_and_episode_please()
+
+    def create_test(self, day, *values, test_name="2019 NOVEL CORONAVIRUS"):
+        dt = timezone.make_aware(datetime.datetime(2020, 4, day))
+        test = self.patient.lab_tests.create(
+            test_name=test_name,
+            datetime_ordered=dt,
+        )
+        covid_test = lab._get_covid_test(test)
+        for value in values:
+            test.observation_set.create(
+                observation_name=covid_test.OBSERVATION_NAME,
+                observation_value=value,
+                observation_datetime=dt
+            )
+        return test
+
+    def get_values(self):
+        return [
+            (i["name"], i["value"],)
+            for i in lab.get_covid_result_ticker(self.patient)
+        ]
+
+    def test_last_three_of_each_test(self):
+        for day, value in enumerate(["POSITIVE", "NOT detected", "POSITIVE", "Undetected"], 1):
+            self.create_test(day, value)
+        self.create_test(5, "Pending")
+        self.create_test(6, "Detected", test_name="CORONAVIRUS REF LAB")
+        self.assertEqual(self.get_values(), [
+            ("SARS CoV-2 RNA", "Detected",),
+            ("2019 nCoV", "Undetected",),
+            ("2019 nCoV", "POSITIVE",),
+            ("2019 nCoV", "NOT detected",),
+        ])
+
+    def test_none(self):
+        self.create_test(1, "Pending")
+        self.assertEqual(self.get_values(), [])
+
+    def test_not_resulted_candidates(self):
+        self.create_test(1, "POSITIVE")
+        for day in range(2, 5):
+            # the result is the first observation
+            self.create_test(day, "Pending", "POSITIVE")
+        self.assertEqual(self.get_values(), [("2019 nCoV", "POSITIVE",)])
+        self.assertEqual(
+            lab.get_covid_result_ticker(self.patient)[0]["timestamp"].day, 1
+        )
+
+    def test_query_count(self):
+        for day in range(1, 10):
+            self.create_test(day, "POSITIVE")
+            self.create_test(day, "Detected", test_name="CORONAVIRUS REF LAB")
+        with self.assertNumQueries(2):
+            ticker = lab.get_covid_result_ticker(self.patient)
+        self.assertEqual(len(ticker), 6)
+
+
+class GetCovidResultTickersTestCase(OpalTestCase):
+    def test_get_covid_result_tickers(self):
+        patient, _ = self.new_patient_and_episode_please()
+        other_patient, _ = self.new_patient_and_episode_please()
+        no_tests, _ = self.new_patient_and_episode_please()
+        for idx, some_patient in enumerate([patient, other_patient]):
+            for day in range(1, 5):
+                dt = timezone.make_aware(datetime.datetime(2020, 4, day + idx))
+                test = some_patient.lab_tests.create(
+                    test_name="2019 NOVEL CORONAVIRUS", datetime_ordered=dt
+                )
+                test.observation_set.create(
+                    observation_name="2019 nCoV",
+                    observation_value="POSITIVE",
+                    observation_datetime=dt
+                )
+        with self.assertNumQueries(2):
+            result = lab.get_covid_result_tickers(
+                [patient, other_patient, no_tests]
+            )
+        self.assertEqual(
+            [i["timestamp"].day for i in result[patient.id]], [4, 3, 2]
+        )
+        self.assertEqual(
+            [i["timestamp"].day for i in result[other_patient.id]], [5, 4, 3]
+        )
+        self.assertEqual(result[no_tests.id], [])
+
+    def test_no_patients(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(lab.get_covid_result_tickers([]), {})
@@ -2,11 +2,15 @@
 Tests for plugins.covid.views
 """
 import datetime
+import os
+import tempfile
+from unittest import mock
 from django.urls import reverse
+from django.utils import timezone
 
 from opal.core.test import OpalTestCase
 
-from plugins.covid import views, models
+from plugins.covid import constants, views, models
 
 
 class RollingAverageTestCase(OpalTestCase):
@@ -114,3 +118,175 @@ class CovidDashboardViewTestCase(OpalTestCase):
             self.client.get(self.url).status_code,
             200
         )
+
+
+class CovidRecentPositivesViewTestCase(OpalTestCase):
+    def setUp(self):
+        self.url = reverse("covid_recent_positives")
+        # initialise the property
+        self.user
+        self.assertTrue(
+            self.client.login(
+                username=self.USERNAME,
+                password=self.PASSWORD
+            )
+        )
+        self.today = datetime.date.today()
+
+    def create_covid_patient(self, hospital_number, encounters=None):
+        """
+        Takes ENCOUNTERS, a list of (days ago admitted, patient class)
+        """
+        patient, _ = self.new_patient_and_episode_please()
+        patient.demographics_set.update(hospital_number=hospital_number)
+        models.CovidPatient.objects.create(
+            patient=patient, date_first_positive=self.today
+        )
+        patient.encounters.create(
+            pv1_3_building='RFH',
+            pv1_2_patient_class='OUTPATIENT',
+        )
+        for days_ago, patient_class in encounters or []:
+            patient.encounters.create(
+                pv1_3_building='RFH',
+                pv1_2_patient_class=patient_class,
+                pv1_44_admit_date_time=timezone.now() - datetime.timedelta(
+                    days=days_ago
+                )
+            )
+        test = patient.lab_tests.create(
+            test_name="2019 NOVEL CORONAVIRUS",
+            datetime_ordered=timezone.now()
+        )
+        test.observation_set.create(
+            observation_name='2019 nCoV',
+            observation_value='POSITIVE',
+            observation_datetime=timezone.now()
+        )
+        return patient
+
+    def test_get(self):
+        inpatient = self.create_covid_patient(
+            "111", [(3, "EMERGENCY",), (1, "INPATIENT",), (2, "INPATIENT",)]
+        )
+        other = self.create_covid_patient("222")
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        patients = response.context["patients"]
+        self.assertEqual(
+            [i["covid_patient"].patient_id for i in patients], [inpatient.id]
+        )
+        self.assertEqual(patients[0]["encounter"]["patient_class"], "INPATIENT")
+        self.assertEqual(
+            patients[0]["encounter"]["admit_datetime"].date(),
+            (timezone.now() - datetime.timedelta(days=1)).date()
+        )
+        self.assertEqual(patients[0]["demographics"].hospital_number, "111")
+        self.assertEqual(len(patients[0]["ticker"]), 1)
+        other_patients = response.context["other_patients"]
+        self.assertEqual(
+            [i["covid_patient"].patient_id for i in other_patients], [other.id]
+        )
+        self.assertIsNone(other_patients[0]["encounter"])
+
+    def test_get_empty(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["patients"], [])
+
+    def test_query_count(self):
+        for idx in range(5):
+            self.create_covid_patient(str(idx), [(1, "INPATIENT",)])
+        view = views.CovidRecentPositivesView()
+        view.request = None
+        view.kwargs = {}
+        with self.assertNumQueries(5):
+            context = view.get_context_data()
+        self.assertEqual(len(context["patients"]), 5)
+
+
+class CovidCohortDownloadViewTestCase(OpalTestCase):
+    def setUp(self):
+        self.url = reverse("covid_download")
+        self.user.username = constants.DOWNLOAD_USERS[0]
+        self.user.save()
+        self.assertTrue(
+            self.client.login(
+                username=self.user.username,
+                password=self.PASSWORD
+            )
+        )
+
+    def create_covid_patient(self, hospital_number):
+        patient, _ = self.new_patient_and_episode_please()
+        patient.demographics_set.update(
+            hospital_number=hospital_number, first_name="Wilma", surname="Flintstone"
+        )
+        models.CovidPatient.objects.create(
+            patient=patient, date_first_positive=datetime.date(2020, 4, 1)
+        )
+        return patient
+
+    def get_content(self, response):
+        return b"".join(response.streaming_content).decode("utf8")
+
+    def test_get(self):
+        patient = self.create_covid_patient("111")
+        response = self.client.get(self.url)
+        self.assertEqual(
+            response["Content-Disposition"],
+            'attachment; filename="covid.cohort.csv"'
+        )
+        self.assertEqual(self.get_content(response), "\r\n".join([
+            "elcid_id,MRN,Name,date_first_positive",
+            "{},111,Wilma Flintstone,2020-04-01".format(patient.id),
+            ""
+        ]))
+
+    def test_query_count(self):
+        for idx in range(5):
+            self.create_covid_patient(str(idx))
+        view = views.CovidCohortDownloadView()
+        view.request = self.rf.get(self.url)
+        view.request.user = self.user
+        with self.assertNumQueries(2):
+            rows = list(view.get_rows())
+        self.assertEqual(len(rows), 5)
+
+    def test_not_a_download_user(self):
+        self.create_covid_patient("111")
+        self.user.username = "someone"
+        self.user.save()
+        response = self.client.get(self.url)
+        self.assertEqual(
+            self.get_content(response),
+            "elcid_id,MRN,Name,date_first_positive\r\n"
+        )
+
+
+class CovidExtractDownloadViewTestCase(OpalTestCase):
+    def setUp(self):
+        self.url = reverse("covid_extract_download")
+        self.user.username = constants.DOWNLOAD_USERS[0]
+        self.user.save()
+        self.assertTrue(
+            self.client.login(
+                username=self.user.username,
+                password=self.PASSWORD
+            )
+        )
+
+    def test_get(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "covid.extract.csv")
+            with open(file_path, "w") as fh:
+                fh.write("elcid_id\n1\n")
+            with mock.patch.object(views.extract, "EXTRACT_FILE_PATH", file_path):
+                response = self.client.get(self.url)
+                content = b"".join(response.streaming_content)
+                response.close()
+        self.assertEqual(content, b"elcid_id\n1\n")
+        self.assertEqual(
+            response["Content-Disposition"],
+            'attachment; filename="covid.extract.csv"'
+        )
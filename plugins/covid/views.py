@@ -1,20 +1,20 @@
 """
 Views for our covid plugin
 """
-import csv
 import datetime
 
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.db.models import Sum
-from django.http import HttpResponse
+from django.db.models import F, Sum
 from django.utils import timezone
 from django.views.generic import TemplateView, View, DetailView
 
+from elcid import streaming
 from plugins.admissions.models import Encounter
 from plugins.appointments.models import Appointment
 
 from plugins.covid import models, constants, lab, extract
 from plugins.covid.episode_categories import CovidEpisode
+from plugins.labtests import recent_results
 
 
 def rolling_average(series):
@@ -153,45 +153,60 @@ class CovidRecentPositivesView(LoginRequiredMixin, TemplateView):
             patient__encounters__pv1_3_building='RFH'
         ).order_by('-date_first_positive').distinct()
 
+    def get_encounters(self, covid_patients):
+        """
+        Returns {patient id: the patient's most recent RFH admission}
+        for the COVID_PATIENTS in a single query
+        """
+        encounters = Encounter.objects.filter(
+            patient_id__in=[i.patient_id for i in covid_patients],
+            pv1_3_building='RFH',
+            pv1_44_admit_date_time__gt=datetime.date.today() - datetime.timedelta(days=self.days_back+28)
+        ).exclude(
+            msh_9_msg_type__startswith='S', # Appointment scheduling noise
+        ).exclude(
+            pv1_2_patient_class='OUTPATIENT'
+        ).exclude(
+            pv1_2_patient_class='RECURRING'
+        )
+        encounters = recent_results.get_ranked(
+            encounters,
+            partition_by=[F('patient_id')],
+            order_by=[F('pv1_44_admit_date_time').desc(), F('id').desc()],
+            limit=1
+        )
+        return {encounter.patient_id: encounter for encounter in encounters}
+
     def get_context_data(self, *a, **k):
         context = super().get_context_data(*a, **k)
 
-        covid_patients = self.get_queryset()
+        covid_patients = list(
+            self.get_queryset().select_related('patient').prefetch_related(
+                'patient__demographics_set'
+            )
+        )
         patients = []
         other_patients = []
 
-        for covid_patient in covid_patients:
+        encounters = self.get_encounters(covid_patients)
+        tickers = lab.get_covid_result_tickers(
+            [i.patient for i in covid_patients]
+        )
 
-            encounter = Encounter.objects.filter(
-                patient=covid_patient.patient,
-                pv1_3_building='RFH',
-                pv1_44_admit_date_time__gt=datetime.date.today() - datetime.timedelta(days=self.days_back+28)
-            ).exclude(
-                msh_9_msg_type__startswith='S', # Appointment scheduling noise
-            ).exclude(
-                pv1_2_patient_class='OUTPATIENT'
-            ).exclude(
-                pv1_2_patient_class='RECURRING'
-            ).order_by('-pv1_44_admit_date_time').first()
+        for covid_patient in covid_patients:
+            encounter = encounters.get(covid_patient.patient_id)
+            row = {
+                'covid_patient' : covid_patient,
+                'ticker'        : tickers[covid_patient.patient_id],
+                'demographics'  : covid_patient.patient.demographics_set.all()[0],
+                'encounter'     : None
+            }
 
             if encounter:
-                patients.append(
-                    {
-                        'covid_patient' : covid_patient,
-                        'ticker'        : lab.get_covid_result_ticker(covid_patient.patient),
-                        'demographics'  : covid_patient.patient.demographics,
-                        'encounter'     : encounter.to_dict()
-                    }
-                )
+                row['encounter'] = encounter.to_dict()
+                patients.append(row)
             else:
-                other_patients.append(
-                     {
-                        'covid_patient' : covid_patient,
-                        'ticker'        : lab.get_covid_result_ticker(covid_patient.patient),
-                        'demographics'  : covid_patient.patient.demographics,
-                        'encounter'     : None
-                    }
-                )
+                other_patients.append(row)
 
         context['patients'] = patients
         context['other_patients'] = other_patients
@@ -202,38 +217,40 @@ class CovidRecentPositivesView(LoginRequiredMixin, TemplateView):
 
 class CovidCohortDownloadView(LoginRequiredMixin, View):
 
-    def get(self, *args, **kwargs):
-        # Create the HttpResponse object with the appropriate CSV header.
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="covid.cohort.csv"'
-
-        writer = csv.writer(response)
-        writer.writerow(['elcid_id', 'MRN', 'Name', 'date_first_positive'])
-
-        if self.request.user.username in constants.DOWNLOAD_USERS:
-            for patient in models.CovidPatient.objects.all():
-                demographics = patient.patient.demographics()
-                writer.writerow([
-                    patient.patient_id,
-                    demographics.hospital_number,
-                    demographics.name,
-                    str(patient.date_first_positive)
-                ])
+    def get_rows(self):
+        if self.request.user.username not in constants.DOWNLOAD_USERS:
+            return
+
+        covid_patients = models.CovidPatient.objects.select_related(
+            'patient'
+        ).order_by('id')
+
+        for patient in streaming.iterator(
+            covid_patients, 'patient__demographics_set'
+        ):
+            demographics = patient.patient.demographics_set.all()[0]
+            yield [
+                patient.patient_id,
+                demographics.hospital_number,
+                demographics.name,
+                str(patient.date_first_positive)
+            ]
 
-        return response
+    def get(self, *args, **kwargs):
+        return streaming.csv_response(
+            'covid.cohort.csv',
+            self.get_rows(),
+            headers=['elcid_id', 'MRN', 'Name', 'date_first_positive']
+        )
 
 
 class CovidExtractDownloadView(LoginRequiredMixin, View):
 
     def get(self, *args, **kwargs):
         if self.request.user.username in constants.DOWNLOAD_USERS:
-
-            with open(extract.EXTRACT_FILE_PATH, 'r') as fh:
-
-                response = HttpResponse(fh, content_type='text/csv')
-                response['Content-Disposition'] = 'attachment; filename="covid.extract.csv"'
-
-                return response
+            return streaming.file_response(
+                extract.EXTRACT_FILE_PATH, 'covid.extract.csv'
+            )
 
 
 class CovidLetter(LoginRequiredMixin, DetailView):
@@ -1,28 +1,56 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models import Max, Q
 from opal.core.search.queries import DatabaseQuery
+from opal.managers import DEFAULT_SEARCH_FIELDS
 from opal.models import Patient
 from elcid.models import Demographics
-from opal.core.search.queries import DatabaseQuery, PatientSummary
 from elcid import models
 
+SUMMARY_DEMOGRAPHICS_FIELDS = [
+    "first_name", "surname", "hospital_number", "date_of_birth"
+]
 
-class ElcidPatientSummary(PatientSummary):
-    def to_dict(self):
-        """
-        Adds the previous mrns that have been associated with the
-        patient to the patient summary.
-        """
-        result = super().to_dict()
-        previous_merges = models.MergedMRN.objects.filter(
-            patient_id=self.patient_id
-        ).order_by(
-            '-id'
-        )
-        result["previous_mrns"] = list(previous_merges.values_list('mrn', flat=True))
-        return result
 
-class ElcidSearchQuery(DatabaseQuery):
-    patient_summary_class = ElcidPatientSummary
+def get_search_fields():
+    """
+    Returns {related model: [lookups]} of the fields in
+    OPAL_DEFAULT_SEARCH_FIELDS, e.g.
+
+    {Demographics: ["hospital_number", "surname"], MergedMRN: ["mrn"]}
+
+    The setting is a list of lookups from the patient, as used by
+    opal's PatientQueryset.search. The fields searched by default
+    have trigram indexes, see elcid/migrations/0073_search_indexes.py
+    """
+    fields = getattr(
+        settings,
+        'OPAL_DEFAULT_SEARCH_FIELDS',
+        DEFAULT_SEARCH_FIELDS
+    )
+    result = defaultdict(list)
+    for field in fields:
+        relation, lookup = field.split("__", 1)
+        related_model = Patient._meta.get_field(relation).related_model
+        result[related_model].append(lookup)
+    return result
+
+
+def get_previous_mrns(patient_ids):
+    """
+    Returns {patient_id: [merged mrns, most recent first]}
+    """
+    result = defaultdict(list)
+    merged_mrns = models.MergedMRN.objects.filter(
+        patient_id__in=patient_ids
+    ).order_by('-id').values_list('patient_id', 'mrn')
+    for patient_id, mrn in merged_mrns:
+        result[patient_id].append(mrn)
+    return result
+
 
+class ElcidSearchQuery(DatabaseQuery):
     def fuzzy_query(self):
         """
         Strips the zeros off the beginning of every item in the query.
@@ -30,12 +58,81 @@ class ElcidSearchQuery(DatabaseQuery):
         This is because some upstream systems prefix hospital numbers
         with zeros, so this means we will find them even if the
         user has taken the hn from another system.
+
+        Each word in the query must match one of the
+        OPAL_DEFAULT_SEARCH_FIELDS. Each table is searched in a subquery
+        so that the database can use the trigram indexes on the columns
+        rather than joining demographics and merged MRNs for every patient.
         """
         query_parts = self.query.split(" ")
         self.query = " ".join(i.lstrip('0') for i in query_parts)
         self.query = self.query.strip()
 
-        if Demographics.objects.filter(hospital_number=self.query).exists():
-            return [Patient.objects.get(demographics__hospital_number=self.query)]
+        exact_match = list(Patient.objects.filter(
+            demographics__hospital_number=self.query
+        )[:1])
+        if exact_match:
+            return exact_match
+
+        search_fields = get_search_fields()
+        patients = Patient.objects.all()
+        for query_part in self.query.split(" "):
+            if not query_part:
+                continue
+            patient_filter = Q()
+            for model, lookups in search_fields.items():
+                model_filter = Q()
+                for lookup in lookups:
+                    model_filter |= Q(
+                        **{"{}__icontains".format(lookup): query_part}
+                    )
+                patient_filter |= Q(id__in=model.objects.filter(
+                    model_filter
+                ).values('patient_id'))
+            patients = patients.filter(patient_filter)
+        patients = patients.annotate(
+            max_episode_id=Max('episode__id')
+        )
+        return patients.order_by("-max_episode_id")
+
+    def get_aggregate_patients_from_episodes(self, episodes):
+        """
+        Returns a summary of each patient of the EPISODES with
+        their demographics and the MRNs that have been merged
+        into the patient.
+
+        Demographics and merged MRNs are read with one query
+        each regardless of the number of patients.
+        """
+        patient_episodes = defaultdict(list)
+        for episode in episodes:
+            patient_episodes[episode.patient_id].append(episode)
+
+        patient_ids = list(patient_episodes.keys())
+        demographics = {
+            i["patient_id"]: i for i in Demographics.objects.filter(
+                patient_id__in=patient_ids
+            ).values("patient_id", *SUMMARY_DEMOGRAPHICS_FIELDS)
+        }
+        previous_mrns = get_previous_mrns(patient_ids)
 
-        return super().fuzzy_query()
+        results = []
+        for patient_id, episodes_of_patient in patient_episodes.items():
+            result = {
+                k: demographics.get(patient_id, {}).get(k)
+                for k in SUMMARY_DEMOGRAPHICS_FIELDS
+            }
+            starts = [i.start for i in episodes_of_patient if i.start]
+            ends = [i.end for i in episodes_of_patient if i.end]
+            result.update({
+                "patient_id": patient_id,
+                "start": min(starts) if starts else None,
+                "end": max(ends) if ends else None,
+                "categories": sorted(set(
+                    i.category_name for i in episodes_of_patient
+                )),
+                "count": len(episodes_of_patient),
+                "previous_mrns": previous_mrns[patient_id],
+            })
+            results.append(result)
+        return results
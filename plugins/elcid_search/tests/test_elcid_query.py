@@ -1,3 +1,4 @@
+import datetime
 import json
 from django.urls import reverse
 from opal.core.test import OpalTestCase
@@ -36,18 +37,103 @@ class FuzzySearchIncludesMergedPatientsTestCase(OpalTestCase):
         self.assertEqual(list(patients), [patient])
 
 
-class PatientSummaryTestCase(OpalTestCase):
-    def test_to_dict(self):
-        patient, episode = self.new_patient_and_episode_please()
-        patient.mergedmrn_set.create(
-            mrn="234"
+class FuzzyQueryTestCase(OpalTestCase):
+    def setUp(self):
+        self.patient, _ = self.new_patient_and_episode_please()
+        self.patient.demographics_set.update(
+            hospital_number="123",
+            nhs_number="9999999999",
+            first_name="Wilma",
+            surname="Flintstone"
         )
-        result = elcid_query.ElcidPatientSummary(
-            patient, [episode]
-        ).to_dict()
+        self.other_patient, _ = self.new_patient_and_episode_please()
+        self.other_patient.demographics_set.update(
+            hospital_number="456",
+            first_name="Betty",
+            surname="Rubble"
+        )
+
+    def fuzzy_query(self, query):
+        return list(elcid_query.ElcidSearchQuery(self.user, query).fuzzy_query())
+
+    def test_nhs_number_is_not_searched_by_default(self):
+        self.assertEqual(self.fuzzy_query("9999999999"), [])
+
+    def test_search_fields_setting(self):
+        with self.settings(OPAL_DEFAULT_SEARCH_FIELDS=[
+            "demographics__nhs_number", "mergedmrn__mrn"
+        ]):
+            self.assertEqual(self.fuzzy_query("9999999999"), [self.patient])
+            self.assertEqual(self.fuzzy_query("wilma"), [])
+
+    def test_names(self):
+        self.assertEqual(self.fuzzy_query("wilma flint"), [self.patient])
+
+    def test_all_words_must_match(self):
+        self.assertEqual(self.fuzzy_query("wilma rubble"), [])
+
+    def test_words_can_match_merged_mrns(self):
+        self.other_patient.mergedmrn_set.create(mrn="789")
+        self.assertEqual(self.fuzzy_query("Betty 789"), [self.other_patient])
+
+    def test_partial_hospital_number(self):
+        self.assertEqual(self.fuzzy_query("45"), [self.other_patient])
+
+    def test_ordered_by_most_recent_episode(self):
+        self.patient.create_episode()
+        self.patient.demographics_set.update(surname="Rubble")
         self.assertEqual(
-            result['previous_mrns'], ["234"]
+            self.fuzzy_query("rubble"), [self.patient, self.other_patient]
+        )
+
+    def test_distinct(self):
+        self.patient.mergedmrn_set.create(mrn="1234")
+        self.patient.mergedmrn_set.create(mrn="12345")
+        self.assertEqual(self.fuzzy_query("12"), [self.patient])
+
+
+class GetAggregatePatientsFromEpisodesTestCase(OpalTestCase):
+    def test_get_aggregate_patients_from_episodes(self):
+        patient, episode = self.new_patient_and_episode_please()
+        episode.start = datetime.date(2020, 1, 1)
+        episode.save()
+        other_episode = patient.create_episode(
+            start=datetime.date(2020, 2, 1), end=datetime.date(2020, 3, 1)
+        )
+        patient.demographics_set.update(
+            hospital_number="123", first_name="Wilma"
         )
+        patient.mergedmrn_set.create(mrn="234")
+        patient.mergedmrn_set.create(mrn="345")
+        query = elcid_query.ElcidSearchQuery(self.user, "123")
+        with self.assertNumQueries(2):
+            result = query.get_aggregate_patients_from_episodes(
+                [episode, other_episode]
+            )
+        self.assertEqual(result, [{
+            "patient_id": patient.id,
+            "first_name": "Wilma",
+            "surname": "",
+            "hospital_number": "123",
+            "date_of_birth": None,
+            "start": datetime.date(2020, 1, 1),
+            "end": datetime.date(2020, 3, 1),
+            "categories": ["Infection Service"],
+            "count": 2,
+            "previous_mrns": ["345", "234"],
+        }])
+
+    def test_query_count_for_many_patients(self):
+        episodes = []
+        for i in range(5):
+            patient, episode = self.new_patient_and_episode_please()
+            patient.mergedmrn_set.create(mrn=str(i))
+            episodes.append(episode)
+        query = elcid_query.ElcidSearchQuery(self.user, "1")
+        with self.assertNumQueries(2):
+            result = query.get_aggregate_patients_from_episodes(episodes)
+        self.assertEqual(len(result), 5)
+
 
 class IntegerationTestCase(OpalTestCase):
     def test_integration(self):
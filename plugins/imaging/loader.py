@@ -4,6 +4,7 @@ Load imaging data from upstream
 import time
 from opal.core import serialization
 from collections import defaultdict
+from django.conf import settings
 from django.db import transaction
 from elcid.models import Demographics, MergedMRN
 from elcid import utils
@@ -11,15 +12,16 @@ from elcid import utils
 from django.db.models import DateTimeField
 from django.utils import timezone
 
-from intrahospital_api.apis.prod_api import ProdApi as ProdAPI
+from intrahospital_api.apis.prod_api import ProdApi as ProdAPI, IN_COHORT
+from intrahospital_api.models import SyncCursor
 from plugins.imaging.models import Imaging, PatientImagingStatus
-from plugins.imaging import logger
+from plugins.imaging import logger, constants
 
 
 Q_GET_IMAGING = """
 SELECT *
 FROM VIEW_ElCid_Radiology_Results
-WHERE patient_number = @mrn
+WHERE patient_number IN ({mrns})
 """
 
 Q_GET_IMAGING_SINCE = """
@@ -29,22 +31,42 @@ WHERE
 date_reported > @last_updated
 """
 
+Q_GET_IMAGING_SINCE_FOR_COHORT = """
+SELECT *
+FROM VIEW_ElCid_Radiology_Results
+WHERE
+date_reported > @last_updated
+AND {in_cohort}
+""".format(in_cohort=IN_COHORT.format(mrn="patient_number"))
+
+
+def fetch_imaging(mrns):
+    """
+    Returns the upstream imaging rows for MRNS
+    """
+    api = ProdAPI()
+    imaging_rows = []
+    mrn_to_rows = api.execute_hospital_query_for_mrns(
+        Q_GET_IMAGING, mrns, 'patient_number'
+    )
+    for rows in mrn_to_rows.values():
+        imaging_rows.extend(rows)
+    return imaging_rows
+
 
 def load_imaging(patient):
     """
     Given a PATIENT, load any upstream imaging reports we do not have
     """
-    api = ProdAPI()
     mrn = patient.demographics().hospital_number
     other_mrns = list(
         patient.mergedmrn_set.values_list('mrn', flat=True)
     )
     mrns = [mrn] + other_mrns
-    imaging_rows = []
-    for mrn in mrns:
-        imaging_rows.extend(api.execute_hospital_query(
-            Q_GET_IMAGING, params={'mrn': mrn}
-        ))
+    update_patient_imaging(patient, fetch_imaging(mrns))
+
+
+def update_patient_imaging(patient, imaging_rows):
     created = update_imaging_from_query_result(imaging_rows)
     logger.info(
         f'Imaging patient load:Saved {len(created)} for Patient {patient.id}'
@@ -95,17 +117,31 @@ def load_imaging_since(last_updated):
     Loads imaging from the upstream table that have
     been reported since last_updated.
 
+    Advances the imaging SyncCursor to the most recent
+    date reported.
+
     Returns the created imaging models
     """
     api = ProdAPI()
     query_start = time.time()
-    imaging_rows = api.execute_hospital_query(
-        Q_GET_IMAGING_SINCE,
-        params={'last_updated': last_updated}
-    )
+    if settings.UPSTREAM_COHORT_FILTER:
+        imaging_rows = api.execute_hospital_query_for_cohort(
+            Q_GET_IMAGING_SINCE_FOR_COHORT,
+            params={'last_updated': last_updated}
+        )
+    else:
+        imaging_rows = api.execute_hospital_query(
+            Q_GET_IMAGING_SINCE,
+            params={'last_updated': last_updated}
+        )
     query_end = time.time()
     logger.info(f"Imaging: queries {len(imaging_rows)} rows in {query_end - query_start}s")
-    created = update_imaging_from_query_result(imaging_rows)
+    with transaction.atomic():
+        created = update_imaging_from_query_result(imaging_rows)
+        SyncCursor.advance(
+            constants.IMAGING_SYNC_CURSOR,
+            [i.get("date_reported") for i in imaging_rows]
+        )
     load_end = time.time()
     logger.info(f'Imaging: created {len(created)} in {load_end - query_end}')
     return created
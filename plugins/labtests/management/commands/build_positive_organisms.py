@@ -0,0 +1,37 @@
+"""
+Builds the PositiveOrganism index used by the organism patient
+lists from the blood cultures loaded before we maintained it.
+
+Lab tests are processed in chunks ordered by id so the command
+can be stopped and rerun.
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from plugins.labtests.models import LabTest, PositiveOrganism
+from plugins.labtests import logger
+
+
+class Command(BaseCommand):
+    help = "Backfills the positive organisms of blood cultures"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        blood_cultures = LabTest.objects.filter(
+            test_name__iexact=PositiveOrganism.BLOOD_CULTURE
+        ).only(
+            "id", "patient_id", "test_name", "lab_number", "datetime_ordered"
+        ).order_by("id")
+        last_id = 0
+        total = 0
+        while True:
+            chunk = list(blood_cultures.filter(id__gt=last_id)[:chunk_size])
+            if not chunk:
+                break
+            with transaction.atomic():
+                PositiveOrganism.update_for_lab_tests(chunk)
+            last_id = chunk[-1].id
+            total += len(chunk)
+            logger.info("Processed {} blood cultures".format(total))
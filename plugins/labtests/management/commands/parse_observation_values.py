@@ -0,0 +1,41 @@
+"""
+Stores the parsed numeric value and reference range of
+observations created before we parsed them on creation.
+
+Observations are processed in chunks ordered by id so the
+command can be stopped and rerun.
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from plugins.labtests.models import Observation
+from plugins.labtests import logger
+
+PARSED_FIELDS = [
+    "numeric_value", "range_min", "range_max", "is_abnormal", "parsed"
+]
+
+
+class Command(BaseCommand):
+    help = "Backfills the parsed values of observations"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        unparsed = Observation.objects.filter(parsed=False).only(
+            "id", "observation_value", "reference_range"
+        ).order_by("id")
+        last_id = 0
+        total = 0
+        while True:
+            chunk = list(unparsed.filter(id__gt=last_id)[:chunk_size])
+            if not chunk:
+                break
+            for observation in chunk:
+                observation.set_parsed_values()
+            with transaction.atomic():
+                Observation.objects.bulk_update(chunk, PARSED_FIELDS)
+            last_id = chunk[-1].id
+            total += len(chunk)
+            logger.info("Parsed {} observations".format(total))
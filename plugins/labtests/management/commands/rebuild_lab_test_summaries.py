@@ -0,0 +1,39 @@
+"""
+Rebuilds the lab test summaries served by the test results view
+on the patient detail page.
+
+By default only patients who have lab tests but no summaries
+are rebuilt, use --all to rebuild every patient.
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from opal.models import Patient
+from plugins.labtests import summaries
+from plugins.labtests import logger
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the lab test summaries for the test results view"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help="Rebuild patients who already have summaries"
+        )
+
+    def handle(self, *args, **options):
+        patients = Patient.objects.filter(
+            lab_tests__isnull=False
+        ).distinct()
+        if not options["all"]:
+            patients = patients.filter(lab_test_summaries__isnull=True)
+        patient_ids = list(patients.values_list('id', flat=True))
+        logger.info(
+            "Rebuilding lab test summaries for {} patients".format(
+                len(patient_ids)
+            )
+        )
+        for patient in Patient.objects.filter(id__in=patient_ids).iterator():
+            with transaction.atomic():
+                summaries.rebuild_patient_summaries(patient)
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.16 on 2026-10-18 09:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('labtests', '0010_labtest_department_int'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='labtest',
+            name='fingerprint',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
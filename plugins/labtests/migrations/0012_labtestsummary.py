@@ -0,0 +1,29 @@
+# Generated by Django 2.2.16 on 2026-10-18 09:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opal', '0040_auto_20201007_1346'),
+        ('labtests', '0011_labtest_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LabTestSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('test_name', models.CharField(max_length=256)),
+                ('last_ordered', models.DateTimeField()),
+                ('data', models.TextField()),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lab_test_summaries', to='opal.Patient')),
+            ],
+            options={
+                'unique_together': {('patient', 'test_name')},
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.16 on 2026-10-18 09:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('labtests', '0012_labtestsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='observation',
+            name='is_abnormal',
+            field=models.NullBooleanField(db_index=True),
+        ),
+        migrations.AddField(
+            model_name='observation',
+            name='numeric_value',
+            field=models.FloatField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='observation',
+            name='parsed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='observation',
+            name='range_max',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='observation',
+            name='range_min',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
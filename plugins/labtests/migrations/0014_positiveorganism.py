@@ -0,0 +1,29 @@
+# Generated by Django 2.2.16 on 2026-10-18 09:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opal', '0040_auto_20201007_1346'),
+        ('labtests', '0013_observation_parsed_values'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PositiveOrganism',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('organism', models.CharField(max_length=256)),
+                ('lab_number', models.CharField(blank=True, max_length=256, null=True)),
+                ('datetime_ordered', models.DateTimeField(blank=True, null=True)),
+                ('lab_test', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='labtests.LabTest')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='positive_organisms', to='opal.Patient')),
+            ],
+            options={
+                'index_together': {('organism', 'datetime_ordered')},
+            },
+        ),
+    ]
@@ -1,4 +1,6 @@
 import datetime
+import hashlib
+import json
 import re
 from plugins.labtests import constants
 from django.utils.dateformat import format as dt_format
@@ -40,6 +42,10 @@ class LabTest(models.Model):
     encounter_location_name = models.CharField(max_length=256, blank=True, null=True)
     encounter_location_code = models.CharField(max_length=256, blank=True, null=True)
 
+    # A hash of the api dict the test was created from, used to
+    # skip rewriting tests that have not changed upstream
+    fingerprint = models.CharField(max_length=64, blank=True, null=True)
+
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -70,6 +76,68 @@ class LabTest(models.Model):
                 }]
             }
         """
+        self.set_from_api_dict(patient, data)
+        self.save()
+        observations = []
+        for obs_dict in data["observations"]:
+            observation =  Observation.translate_to_object(obs_dict)
+            observation.test = self
+            observations.append(observation)
+        Observation.objects.bulk_create(observations)
+        PositiveOrganism.update_for_lab_tests([self])
+
+    FINGERPRINT_FIELDS = [
+        "accession_number",
+        "clinical_info",
+        "datetime_ordered",
+        "department_int",
+        "encounter_consultant_name",
+        "encounter_location_code",
+        "encounter_location_name",
+        "external_identifier",
+        "site",
+        "status",
+        "test_code",
+        "test_name",
+    ]
+
+    FINGERPRINT_OBSERVATION_FIELDS = [
+        "last_updated",
+        "observation_datetime",
+        "observation_name",
+        "observation_number",
+        "observation_value",
+        "reference_range",
+        "reported_datetime",
+        "units",
+    ]
+
+    @classmethod
+    def get_fingerprint(cls, data):
+        """
+        Returns a sha256 of the fields of the api dict that we
+        save, the observations are sorted so the order
+        they come from upstream does not matter.
+        """
+        observations = sorted(
+            json.dumps(
+                [obs.get(i) for i in cls.FINGERPRINT_OBSERVATION_FIELDS],
+                default=str
+            ) for obs in data["observations"]
+        )
+        normalized = [
+            [data.get(i) for i in cls.FINGERPRINT_FIELDS], observations
+        ]
+        return hashlib.sha256(
+            json.dumps(normalized, default=str).encode('utf8')
+        ).hexdigest()
+
+    def set_from_api_dict(self, patient, data):
+        """
+        Sets the fields of the lab test from the api dict
+        described in create_from_api_dict without saving
+        the lab test or its observations.
+        """
         self.patient = patient
         self.clinical_info = data["clinical_info"]
         if data["datetime_ordered"]:
@@ -86,13 +154,7 @@ class LabTest(models.Model):
         self.encounter_consultant_name = data["encounter_consultant_name"]
         self.encounter_location_name = data["encounter_location_name"]
         self.encounter_location_code = data["encounter_location_code"]
-        self.save()
-        observations = []
-        for obs_dict in data["observations"]:
-            observation =  Observation.translate_to_object(obs_dict)
-            observation.test = self
-            observations.append(observation)
-        Observation.objects.bulk_create(observations)
+        self.fingerprint = self.get_fingerprint(data)
 
     @classmethod
     def get_relevant_tests(self, patient):
@@ -166,13 +228,29 @@ class AbstractObserveration(models.Model):
 class Observation(AbstractObserveration):
     test = models.ForeignKey(LabTest, on_delete=models.CASCADE)
 
+    # The observation value and reference range parsed by
+    # set_parsed_values when the observation is created so
+    # that we do not parse them each time they are read and
+    # can query them in the database
+    numeric_value = models.FloatField(blank=True, null=True, db_index=True)
+    range_min = models.FloatField(blank=True, null=True)
+    range_max = models.FloatField(blank=True, null=True)
+    is_abnormal = models.NullBooleanField(db_index=True)
+    # False for observations created before we stored the parsed
+    # values, they are parsed on read until they are backfilled
+    # by the parse_observation_values command
+    parsed = models.BooleanField(default=False)
+
+    def save(self, *args, **kwargs):
+        self.set_parsed_values()
+        return super().save(*args, **kwargs)
+
     def to_float(self, some_val):
         regex = r'^[-+]?[0-9]+(\.[0-9]+)?$'
         if re.match(regex, some_val):
             return round(float(some_val), 3)
 
-    @property
-    def value_numeric(self):
+    def parse_value_numeric(self):
         """
         if an observation is    , return it as a float
         some of the inputted values are messy, but essentially
@@ -181,16 +259,21 @@ class Observation(AbstractObserveration):
         If possible we clean this up and return a number
         otherwise return None
         """
-        obs_result = self.observation_value.strip()
+        obs_result = str(self.observation_value).strip()
         obs_result = obs_result.split("~")[0].strip("<").strip(">").strip()
         return self.to_float(obs_result)
 
+    @property
+    def value_numeric(self):
+        if self.parsed:
+            return self.numeric_value
+        return self.parse_value_numeric()
+
     @property
     def is_pending(self):
         return self.observation_value.lower() == "pending"
 
-    @property
-    def cleaned_reference_range(self):
+    def parse_reference_range(self):
         """
         reference ranges appear of the form
         1.5 - 4
@@ -201,7 +284,7 @@ class Observation(AbstractObserveration):
         Clean these and handle them appropriately
         For the moment we will now pass < 17
         """
-        reference_range = self.reference_range.replace("]", "").replace("[", "")
+        reference_range = str(self.reference_range).replace("]", "").replace("[", "")
         regex = r"\s*([-+]?[0-9]+(\.[0-9]+)?)\s*-\s*([-+]?[0-9]+(\.[0-9]+)?)\s*?"
         matches = re.search(regex, reference_range)
         if not matches:
@@ -220,6 +303,25 @@ class Observation(AbstractObserveration):
             "max": self.to_float(max_val)
         }
 
+    @property
+    def cleaned_reference_range(self):
+        if self.parsed:
+            if self.range_min is None or self.range_max is None:
+                return
+            return {"min": self.range_min, "max": self.range_max}
+        return self.parse_reference_range()
+
+    def parse_is_outside_reference_range(self):
+        rr = self.cleaned_reference_range
+        value = self.value_numeric
+        if rr is None or value is None:
+            return
+        if value < rr["min"]:
+            return True
+        if value > rr["max"]:
+            return True
+        return False
+
     def is_outside_reference_range(self):
         """
         Returns True if the value is outside of the
@@ -231,15 +333,28 @@ class Observation(AbstractObserveration):
         Returns None if we can't calculate the reference
         range or convert the value to a float.
         """
-        rr = self.cleaned_reference_range
-        value = self.value_numeric
-        if rr is None or value is None:
-            return
-        if value < rr["min"]:
-            return True
-        if value > rr["max"]:
-            return True
-        return False
+        if self.parsed:
+            return self.is_abnormal
+        return self.parse_is_outside_reference_range()
+
+    def set_parsed_values(self):
+        """
+        Parses the observation value and reference range
+        and stores the results on the observation.
+        """
+        self.parsed = False
+        self.numeric_value = None
+        self.range_min = None
+        self.range_max = None
+        if self.observation_value is not None:
+            self.numeric_value = self.parse_value_numeric()
+        if self.reference_range is not None:
+            reference_range = self.parse_reference_range()
+            if reference_range:
+                self.range_min = reference_range["min"]
+                self.range_max = reference_range["max"]
+        self.parsed = True
+        self.is_abnormal = self.parse_is_outside_reference_range()
 
     @classmethod
     def translate_to_object(cls, observation_dict):
@@ -268,6 +383,7 @@ class Observation(AbstractObserveration):
         ]
         for f in fields:
             setattr(obs, f, observation_dict.get(f))
+        obs.set_parsed_values()
         return obs
 
 
@@ -286,3 +402,116 @@ class ObservationHistory(AbstractObserveration):
         on_delete=models.CASCADE,
         related_name="observation_history"
     )
+
+
+class LabTestSummary(models.Model):
+    """
+    The serialised results of all of a patient's lab tests
+    of a test type, as shown in the test results view on the
+    patient detail page.
+
+    Rebuilt by plugins.labtests.summaries when the patient's
+    lab tests of that type change.
+    """
+    patient = models.ForeignKey(
+        omodels.Patient,
+        on_delete=models.CASCADE,
+        related_name="lab_test_summaries"
+    )
+    test_name = models.CharField(max_length=256)
+    # the most recent datetime_ordered of the tests, used
+    # to order the test types on the page
+    last_ordered = models.DateTimeField()
+    # the OpalSerializer JSON of the test type
+    data = models.TextField()
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (("patient", "test_name",),)
+
+    def get_data(self):
+        return json.loads(self.data)
+
+
+class PositiveOrganism(models.Model):
+    """
+    A blood culture that has grown an organism that we have a
+    patient list for.
+
+    Stored so that the organism patient lists do not need to
+    search the observations. They are only kept up to date by
+    code that calls update_for_lab_tests once for each lab test
+    after its observations are saved, saving an Observation by
+    itself (e.g. in the admin) does not update them.
+    """
+    CANDIDA = "candida"
+    STAPH_AUREUS = "staph_aureus"
+    E_COLI = "e_coli"
+
+    BLOOD_CULTURE = "blood culture"
+
+    CANDIDA_TO_IGNORE = [
+        "candida auris not isolated",
+        "candida not isolated",
+    ]
+
+    patient = models.ForeignKey(
+        omodels.Patient,
+        on_delete=models.CASCADE,
+        related_name="positive_organisms"
+    )
+    lab_test = models.ForeignKey(LabTest, on_delete=models.CASCADE)
+    organism = models.CharField(max_length=256)
+    lab_number = models.CharField(max_length=256, blank=True, null=True)
+    datetime_ordered = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        index_together = (("organism", "datetime_ordered",),)
+
+    @classmethod
+    def get_organisms(cls, observation_value):
+        """
+        Returns the organisms in the value of a blood culture observation
+        """
+        result = []
+        value = (observation_value or "").lower()
+        if "candida" in value:
+            if not any(i in value for i in cls.CANDIDA_TO_IGNORE):
+                result.append(cls.CANDIDA)
+        if "aureus" in value:
+            result.append(cls.STAPH_AUREUS)
+        # match the word as there are a bunch of
+        # false positives e.g. Colistin
+        if re.search(r"\bcoli\b", value):
+            result.append(cls.E_COLI)
+        return result
+
+    @classmethod
+    def update_for_lab_tests(cls, lab_tests):
+        """
+        Replaces the positive organisms of LAB_TESTS
+        """
+        blood_cultures = {
+            i.id: i for i in lab_tests
+            if i.test_name and i.test_name.lower() == cls.BLOOD_CULTURE
+        }
+        if not blood_cultures:
+            return
+        cls.objects.filter(lab_test_id__in=blood_cultures.keys()).delete()
+        observations = Observation.objects.filter(
+            test_id__in=blood_cultures.keys(),
+            observation_name__iexact=cls.BLOOD_CULTURE
+        ).values_list("test_id", "observation_value")
+        found = set()
+        for test_id, observation_value in observations:
+            for organism in cls.get_organisms(observation_value):
+                found.add((test_id, organism,))
+        cls.objects.bulk_create([
+            cls(
+                patient_id=blood_cultures[test_id].patient_id,
+                lab_test_id=test_id,
+                organism=organism,
+                lab_number=blood_cultures[test_id].lab_number,
+                datetime_ordered=blood_cultures[test_id].datetime_ordered,
+            ) for test_id, organism in found
+        ])
@@ -0,0 +1,192 @@
+"""
+Queries for a patient's most recent results of a declared set of
+tests and observations.
+
+Rather than loading a patient's whole history for each test and
+filtering it in python, rows are ranked in the database with window
+functions, e.g. ROW_NUMBER() OVER (PARTITION BY ... ORDER BY ...),
+and only the rows that are needed are returned, for all of the tests
+in a single query.
+"""
+from collections import defaultdict
+
+from django.core.exceptions import EmptyResultSet
+from django.db import connection
+from django.db.models import DateTimeField, F, Q, Window
+from django.db.models.functions import DenseRank, RowNumber, Trunc
+from django.utils import timezone
+
+from plugins.labtests import models as lab_test_models
+
+
+def filter_window(queryset, **max_values):
+    """
+    Takes a QUERYSET annotated with window functions and returns
+    a list of the instances where each annotation in MAX_VALUES is
+    less than or equal to its value.
+
+    Window functions cannot be filtered on in the query that
+    computes them so the query is wrapped in a subquery.
+    """
+    try:
+        sql, params = queryset.order_by().query.sql_with_params()
+    except EmptyResultSet:
+        # e.g. the queryset filters on an empty __in
+        return []
+    conditions = " AND ".join(
+        "ranked.{} <= %s".format(connection.ops.quote_name(name))
+        for name in max_values
+    )
+    return list(queryset.model.objects.raw(
+        "SELECT * FROM ({}) ranked WHERE {}".format(sql, conditions),
+        tuple(params) + tuple(max_values.values())
+    ))
+
+
+def get_ranked(queryset, partition_by, order_by, limit):
+    """
+    Returns the first LIMIT instances of QUERYSET for each
+    PARTITION_BY when ordered by ORDER_BY.
+
+    Each instance has a row_number, its position within
+    its partition starting at 1.
+    """
+    queryset = queryset.annotate(
+        row_number=Window(
+            RowNumber(), partition_by=partition_by, order_by=order_by
+        )
+    )
+    return filter_window(queryset, row_number=limit)
+
+
+def get_observations(patient, test_observations):
+    """
+    Takes {test name: [observation names]} and returns
+    a queryset of the patient's observations for them.
+    """
+    observation_filter = Q()
+    for test_name, observation_names in test_observations.items():
+        observation_filter |= Q(
+            test__test_name=test_name, observation_name__in=observation_names
+        )
+    return lab_test_models.Observation.objects.filter(
+        test__patient=patient
+    ).filter(observation_filter)
+
+
+def group_by_test_and_observation(observations):
+    """
+    Returns {(test name, observation name): [observations]}
+    ordered by row_number.
+
+    Sets the test of each observation with a single query.
+    """
+    tests = lab_test_models.LabTest.objects.in_bulk(
+        set(i.test_id for i in observations)
+    )
+    result = defaultdict(list)
+    for observation in sorted(observations, key=lambda x: x.row_number):
+        observation.test = tests[observation.test_id]
+        result[
+            (observation.test.test_name, observation.observation_name,)
+        ].append(observation)
+    return result
+
+
+def get_latest_observations(patient, test_observations, order_by, limit=1):
+    """
+    Takes {test name: [observation names]} and returns
+    {(test name, observation name): [observations]} of the first
+    LIMIT observations of each when ordered by ORDER_BY.
+    """
+    observations = get_ranked(
+        get_observations(patient, test_observations),
+        partition_by=[F('test__test_name'), F('observation_name')],
+        order_by=order_by,
+        limit=limit
+    )
+    return group_by_test_and_observation(observations)
+
+
+def get_most_recent_of_each_day(observations, num_days):
+    """
+    Returns the most recent of OBSERVATIONS on each of the last
+    NUM_DAYS days that they were observed, most recent first.
+
+    The python equivalent of the ranking in
+    get_recent_numeric_observations.
+    """
+    result = []
+    days = set()
+    for observation in sorted(
+        observations,
+        key=lambda x: (-x.observation_datetime.timestamp(), x.id)
+    ):
+        day = observation.observation_datetime.astimezone(timezone.utc).date()
+        if day in days:
+            continue
+        if len(days) == num_days:
+            break
+        days.add(day)
+        result.append(observation)
+    return result
+
+
+def get_recent_numeric_observations(patient, test_observations, num_days):
+    """
+    Takes {test name: [observation names]} and returns
+    {(test name, observation name): [observations]} with the most
+    recent observation on each of the last NUM_DAYS days that the
+    observation had a numeric result, most recent first.
+
+    Days are UTC days of the observation datetime.
+
+    Observations that have not had their values parsed are
+    parsed in python and merged with those ranked in the database.
+    """
+    day = Trunc(
+        'observation_datetime',
+        'day',
+        output_field=DateTimeField(),
+        tzinfo=timezone.utc
+    )
+    partition_by = [F('test__test_name'), F('observation_name')]
+    observations = get_observations(
+        patient, test_observations
+    ).exclude(
+        observation_datetime=None
+    ).exclude(
+        parsed=True, numeric_value=None
+    )
+    ranked = observations.filter(parsed=True).annotate(
+        day_rank=Window(
+            DenseRank(), partition_by=partition_by, order_by=day.desc()
+        ),
+        row_number=Window(
+            RowNumber(),
+            partition_by=partition_by,
+            order_by=[F('observation_datetime').desc(), F('id').asc()]
+        ),
+        row_number_in_day=Window(
+            RowNumber(),
+            partition_by=partition_by + [day],
+            order_by=[F('observation_datetime').desc(), F('id').asc()]
+        ),
+    )
+    result = group_by_test_and_observation(filter_window(
+        ranked, day_rank=num_days, row_number_in_day=1
+    ))
+
+    unparsed = [
+        i for i in observations.filter(parsed=False).select_related('test')
+        if i.value_numeric is not None
+    ]
+    for key in set((i.test.test_name, i.observation_name,) for i in unparsed):
+        result[key] = get_most_recent_of_each_day(
+            result[key] + [
+                i for i in unparsed
+                if (i.test.test_name, i.observation_name,) == key
+            ],
+            num_days
+        )
+    return result
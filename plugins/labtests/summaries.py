@@ -0,0 +1,320 @@
+"""
+Serialises a patient's lab tests for the test results view on the
+patient detail page.
+
+Long stay patients have thousands of lab tests, so rather than
+serialising all of them on every request we store the serialised
+results of each test type in a LabTestSummary and rebuild only the
+test types that change when we load lab tests.
+"""
+from collections import defaultdict
+import json
+
+from django.db.models import Q
+from opal.core import serialization
+
+from plugins.labtests import models as lab_test_models
+
+
+_ALWAYS_SHOW_AS_TABULAR = [
+    "UREA AND ELECTROLYTES",
+    "LIVER PROFILE",
+    "IMMUNOGLOBULINS",
+    "C REACTIVE PROTEIN",
+    "RENAL",
+    "RENAL PROFILE",
+    "BONE PROFILE",
+    "FULL BLOOD COUNT",
+    "HAEMATINICS",
+    "HBA1C",
+    "THYROID FUNCTION TESTS",
+    "ARTERIAL BLOOD GASES",
+    "B12 AND FOLATE SCREEN",
+    "CLOTTING SCREEN",
+    "BICARBONATE",
+    "CARDIAC PROFILE",
+    "CHLORIDE",
+    "CHOLESTEROL/TRIGLYCERIDES",
+    "AFP",
+    "25-OH VITAMIN D",
+    "AMMONIA",
+    "FLUID CA-125",
+    "CARDIAC TROPONIN T",
+    "BODYFLUID CALCIUM",
+    "BODYFLUID GLUCOSE",
+    "BODYFLUID POTASSIUM",
+    "PDF PROTEIN",
+    "TACROLIMUS",
+    "FULL BLOOD COUNT"
+]
+
+# Test types that are not shown in the test results view
+COMMENT_TEST_NAMES = ['UNPROCESSED SAMPLE COMT', 'COMMENT', 'SAMPLE COMMENT']
+
+
+class LabTestResultsSerialiser(object):
+    def get_non_comments_for_patient(self, patient):
+        """
+        Returns all non comments for a patient, ensuring they are
+        ordered by date and prefetching observations.
+        """
+        lab_tests = patient.lab_tests.all().order_by('-datetime_ordered')
+
+        lab_tests = lab_tests.exclude(
+            test_name__in=COMMENT_TEST_NAMES
+        )
+
+        # we have some lab tests with no datetime ordered
+        # they also have no lab test name or observation
+        # value so skipping them
+        lab_tests = lab_tests.exclude(
+            datetime_ordered=None
+        )
+        return lab_tests.prefetch_related('observation_set')
+
+    def group_tests(self, lab_tests):
+        """
+        Return dictionary that groups a queryset of lab tests by test name.
+        """
+        by_test = defaultdict(list)
+
+        for lab_test in lab_tests:
+            by_test[lab_test.test_name].append(lab_test)
+        return by_test
+
+    def is_long_form(self, test_type, instances):
+        """
+        Predicate function that indicates whether results should
+        be displayed in a table form or long form
+        """
+        if test_type in _ALWAYS_SHOW_AS_TABULAR:
+            return False
+
+        for instance in instances:
+            for observation in instance.observation_set.all():
+                if not observation.value_numeric:
+                    if not observation.is_pending:
+                        return True
+        return False
+
+    def is_empty_value(self, observation_value):
+        """
+        Predocate function that indicates whether there is a meaningful value
+        in this string.
+
+        For these purposes don't care about empty strings, ' - ', or ' # '
+        """
+        if isinstance(observation_value, str):
+            return not observation_value.strip().strip("-").strip("#").strip()
+        else:
+            return observation_value is None
+
+    def display_class_for_observation(self, observation):
+        """
+        Returns too-high too-low or '' for a numeric observation
+        """
+        display_class = ''
+        numeric       = observation.value_numeric
+        refrange      = observation.cleaned_reference_range
+
+        if refrange is None or numeric is None:
+            return display_class
+
+        if numeric < refrange['min']:
+            display_class = 'too-low'
+
+        if numeric > refrange['max']:
+            display_class = 'too-high'
+
+        return display_class
+
+    def serialise_tabular_instances(self, instances):
+        """
+        Serialise all instances of a tabular test type (e.g. Full Blood Count)
+        """
+        test_datetimes     = set()
+        observation_names  = set()
+        observation_ranges = {}
+        observation_units  = {}
+        lab_numbers        = {}
+        data               = defaultdict(lambda: defaultdict(lambda: None))
+        departments         = set()
+
+        for instance in instances:
+            test_datetimes.add(instance.datetime_ordered)
+            lab_numbers[serialization.serialize_datetime(instance.datetime_ordered)] = instance.lab_number
+            departments.add(instance.department)
+
+            for observation in instance.observation_set.all():
+                name = observation.observation_name.rstrip('.')
+                if not self.is_empty_value(observation.observation_value):
+
+                    if name not in observation_ranges:
+                        if observation.reference_range != " -":
+                            observation_ranges[name] = observation.reference_range
+
+                    if name not in observation_units:
+                        observation_units[name] = observation.units
+
+                    observation_names.add(name)
+                    data[name][serialization.serialize_datetime(instance.datetime_ordered)] = {
+                        'value'        : observation.observation_value,
+                        'range'        : observation.reference_range,
+                        'display_class': self.display_class_for_observation(observation)
+                    }
+
+
+        date_series = list(sorted(test_datetimes))
+        date_series = [serialization.serialize_datetime(d) for d in date_series]
+
+        return {
+            'test_datetimes'    : date_series[-8:],
+            'observation_names' : list(sorted(observation_names)),
+            'lab_numbers'       : lab_numbers,
+            'observation_ranges': observation_ranges,
+            'observation_units' : observation_units,
+            'observation_series': data,
+            'departments'       : list(departments),
+        }
+
+    def serialise_long_form_instance(self, instance):
+        """
+        Serialise a single long form test instance.
+        """
+        serialised_observations = []
+        for o in instance.observation_set.all():
+            if not self.is_empty_value(o.observation_value):
+                serialised_observations.append(
+                    {
+                        'name' : o.observation_name.rstrip('.'),
+                        'value': o.observation_value,
+                        'units': o.units
+                    }
+                )
+        return {
+            'lab_number'        : instance.lab_number,
+            'date'              : instance.datetime_ordered,
+            'observations'      : serialised_observations,
+            'site'              : instance.cleaned_site,
+            'department'        : instance.department
+        }
+
+    def serialise_test_type(self, test_type, instances):
+        """
+        Serialise all instances of a test type, ordered by
+        datetime_ordered descending.
+        """
+        if self.is_long_form(test_type, instances):
+            return {
+                'long_form'    : True,
+                'lab_test_type': test_type,
+                'count'        : len(instances),
+                'instances'    : [
+                    self.serialise_long_form_instance(i) for i in instances
+                ]
+            }
+        return {
+            'long_form'    : False,
+            'lab_test_type': test_type,
+            'count'        : len(instances),
+            'instances'    : self.serialise_tabular_instances(instances)
+        }
+
+
+def rebuild_summaries(patient_ids_to_test_names):
+    """
+    Takes {patient id: test names} and rebuilds the LabTestSummary
+    for each of those test types, deleting summaries of test
+    types the patient no longer has.
+    """
+    serialiser = LabTestResultsSerialiser()
+    for patient_id, test_names in patient_ids_to_test_names.items():
+        # tests without a test name are always serialised live
+        test_names = set(test_names) - set(COMMENT_TEST_NAMES) - {None}
+        if not test_names:
+            continue
+        lab_tests = lab_test_models.LabTest.objects.filter(
+            patient_id=patient_id, test_name__in=test_names
+        ).exclude(
+            datetime_ordered=None
+        ).order_by(
+            '-datetime_ordered'
+        ).prefetch_related('observation_set')
+        by_test = serialiser.group_tests(lab_tests)
+        lab_test_models.LabTestSummary.objects.filter(
+            patient_id=patient_id, test_name__in=test_names
+        ).delete()
+        lab_test_models.LabTestSummary.objects.bulk_create([
+            lab_test_models.LabTestSummary(
+                patient_id=patient_id,
+                test_name=test_name,
+                last_ordered=instances[0].datetime_ordered,
+                data=json.dumps(
+                    serialiser.serialise_test_type(test_name, instances),
+                    cls=serialization.OpalSerializer
+                )
+            ) for test_name, instances in by_test.items()
+        ])
+
+
+def rebuild_patient_summaries(patient):
+    """
+    Rebuilds the LabTestSummary of every test type the patient has
+    """
+    lab_test_models.LabTestSummary.objects.filter(patient=patient).delete()
+    test_names = patient.lab_tests.order_by().values_list(
+        'test_name', flat=True
+    ).distinct()
+    rebuild_summaries({patient.id: test_names})
+
+
+def get_test_order(test_dates):
+    """
+    Takes {test name: last datetime ordered} and returns the test
+    names, most recently ordered first.
+    """
+    return [
+        d[0] for d in
+        sorted(test_dates.items(),
+               key=lambda x: -x[1].timestamp())
+    ]
+
+
+def get_serialised_tests(patient):
+    """
+    Returns {test name: serialised test type}, {test name: last ordered}
+    for a patient.
+
+    Test types are read from the patient's LabTestSummary,
+    falling back to serialising the lab tests of any test
+    types that do not have one.
+    """
+    serialised_tests = {}
+    test_dates = {}
+    summaries = lab_test_models.LabTestSummary.objects.filter(
+        patient=patient
+    )
+    for summary in summaries:
+        serialised_tests[summary.test_name] = summary.get_data()
+        test_dates[summary.test_name] = summary.last_ordered
+
+    test_names = patient.lab_tests.exclude(
+        test_name__in=COMMENT_TEST_NAMES
+    ).exclude(
+        datetime_ordered=None
+    ).order_by().values_list('test_name', flat=True).distinct()
+    missing = set(test_names) - set(serialised_tests.keys())
+
+    if missing:
+        serialiser = LabTestResultsSerialiser()
+        lab_tests = serialiser.get_non_comments_for_patient(patient)
+        missing_filter = Q(test_name__in=missing - {None})
+        if None in missing:
+            missing_filter = missing_filter | Q(test_name=None)
+        by_test = serialiser.group_tests(lab_tests.filter(missing_filter))
+        for test_type, instances in by_test.items():
+            serialised_tests[test_type] = serialiser.serialise_test_type(
+                test_type, instances
+            )
+            test_dates[test_type] = instances[0].datetime_ordered
+    return serialised_tests, test_dates
@@ -0,0 +1,36 @@
+from django.utils import timezone
+from opal.core.test import OpalTestCase
+from plugins.labtests import models
+from plugins.labtests.management.commands import build_positive_organisms
+
+
+class BuildPositiveOrganismsTestCase(OpalTestCase):
+    def setUp(self):
+        self.cmd = build_positive_organisms.Command()
+        self.patient, _ = self.new_patient_and_episode_please()
+        for value in ["Candida albicans", "Staphylococcus aureus", "No growth"]:
+            lab_test = self.patient.lab_tests.create(
+                test_name="BLOOD CULTURE", datetime_ordered=timezone.now()
+            )
+            lab_test.observation_set.create(
+                observation_name="Blood Culture", observation_value=value
+            )
+        # blood cultures from before we stored positive organisms
+        models.PositiveOrganism.objects.all().delete()
+
+    def test_handle(self):
+        self.cmd.handle(chunk_size=2)
+        self.assertEqual(
+            set(self.patient.positive_organisms.values_list(
+                "organism", flat=True
+            )),
+            {
+                models.PositiveOrganism.CANDIDA,
+                models.PositiveOrganism.STAPH_AUREUS
+            }
+        )
+
+    def test_handle_is_idempotent(self):
+        self.cmd.handle(chunk_size=2)
+        self.cmd.handle(chunk_size=2)
+        self.assertEqual(self.patient.positive_organisms.count(), 2)
@@ -198,6 +198,30 @@ class LabTestTestCase(OpalTestCase):
             'Blood'
         )
 
+    def test_get_fingerprint(self):
+        fingerprint = models.LabTest.get_fingerprint(self.api_dict)
+        other = copy.deepcopy(self.api_dict)
+        self.assertEqual(models.LabTest.get_fingerprint(other), fingerprint)
+        other["observations"][0]["observation_value"] = "124"
+        self.assertNotEqual(models.LabTest.get_fingerprint(other), fingerprint)
+
+    def test_get_fingerprint_ignores_observation_order(self):
+        self.api_dict["observations"].append(
+            dict(self.api_dict["observations"][0], observation_number="2")
+        )
+        fingerprint = models.LabTest.get_fingerprint(self.api_dict)
+        self.api_dict["observations"].reverse()
+        self.assertEqual(
+            models.LabTest.get_fingerprint(self.api_dict), fingerprint
+        )
+
+    def test_create_from_api_dict_sets_fingerprint(self):
+        lt = models.LabTest()
+        lt.create_from_api_dict(self.patient, self.api_dict)
+        self.assertEqual(
+            lt.fingerprint, models.LabTest.get_fingerprint(self.api_dict)
+        )
+
 
 class ObservationTestCase(OpalTestCase):
     def test_value_numeric(self):
@@ -279,3 +303,158 @@ class ObservationTestCase(OpalTestCase):
         observation.reference_range = "1.5 - 4"
         observation.observation_value = "3"
         self.assertFalse(observation.is_outside_reference_range())
+
+    def test_set_parsed_values(self):
+        observation = models.Observation()
+        observation.reference_range = "[1.5 - 4]"
+        observation.observation_value = "<5 ~ some comment"
+        observation.set_parsed_values()
+        self.assertTrue(observation.parsed)
+        self.assertEqual(observation.numeric_value, 5)
+        self.assertEqual(observation.range_min, 1.5)
+        self.assertEqual(observation.range_max, 4)
+        self.assertTrue(observation.is_abnormal)
+
+    def test_set_parsed_values_none(self):
+        observation = models.Observation()
+        observation.set_parsed_values()
+        self.assertTrue(observation.parsed)
+        self.assertIsNone(observation.numeric_value)
+        self.assertIsNone(observation.range_min)
+        self.assertIsNone(observation.range_max)
+        self.assertIsNone(observation.is_abnormal)
+
+    def test_parsed_values_are_used(self):
+        observation = models.Observation(
+            observation_value="5",
+            reference_range="1.5 - 4",
+            numeric_value=3,
+            range_min=1,
+            range_max=2,
+            is_abnormal=False,
+            parsed=True
+        )
+        self.assertEqual(observation.value_numeric, 3)
+        self.assertEqual(
+            observation.cleaned_reference_range, {"min": 1, "max": 2}
+        )
+        self.assertFalse(observation.is_outside_reference_range())
+
+    def test_save_sets_parsed_values(self):
+        patient, _ = self.new_patient_and_episode_please()
+        lab_test = patient.lab_tests.create()
+        lab_test.observation_set.create(
+            observation_value="5", reference_range="1.5 - 4"
+        )
+        observation = models.Observation.objects.get(is_abnormal=True)
+        self.assertEqual(observation.numeric_value, 5)
+
+    def test_translate_to_object_sets_parsed_values(self):
+        observation = models.Observation.translate_to_object({
+            "last_updated": "18/07/2015 04:15:10",
+            "observation_datetime": None,
+            "reported_datetime": None,
+            "observation_value": "3",
+            "reference_range": "1.5 - 4",
+        })
+        self.assertTrue(observation.parsed)
+        self.assertEqual(observation.numeric_value, 3)
+        self.assertFalse(observation.is_abnormal)
+
+
+class PositiveOrganismTestCase(OpalTestCase):
+    def setUp(self):
+        self.patient, _ = self.new_patient_and_episode_please()
+        self.datetime_ordered = timezone.now()
+        self.lab_test = self.patient.lab_tests.create(
+            test_name="BLOOD CULTURE",
+            lab_number="123",
+            datetime_ordered=self.datetime_ordered
+        )
+
+    def test_get_organisms(self):
+        get_organisms = models.PositiveOrganism.get_organisms
+        self.assertEqual(
+            get_organisms("1) Candida albicans"),
+            [models.PositiveOrganism.CANDIDA]
+        )
+        self.assertEqual(get_organisms("Candida NOT isolated"), [])
+        self.assertEqual(get_organisms("Candida auris NOT isolated"), [])
+        self.assertEqual(
+            get_organisms("Staphylococcus aureus"),
+            [models.PositiveOrganism.STAPH_AUREUS]
+        )
+        self.assertEqual(
+            get_organisms("Escherichia coli"),
+            [models.PositiveOrganism.E_COLI]
+        )
+        self.assertEqual(get_organisms("Colistin"), [])
+        self.assertEqual(get_organisms(None), [])
+        self.assertEqual(
+            get_organisms("1) E. COLI 2) Staphylococcus aureus"),
+            [
+                models.PositiveOrganism.STAPH_AUREUS,
+                models.PositiveOrganism.E_COLI
+            ]
+        )
+
+    def test_update_for_lab_tests(self):
+        self.lab_test.observation_set.create(
+            observation_name="Blood Culture",
+            observation_value="Staphylococcus aureus"
+        )
+        models.PositiveOrganism.update_for_lab_tests([self.lab_test])
+        positive_organism = self.patient.positive_organisms.get()
+        self.assertEqual(positive_organism.lab_test, self.lab_test)
+        self.assertEqual(
+            positive_organism.organism, models.PositiveOrganism.STAPH_AUREUS
+        )
+        self.assertEqual(positive_organism.lab_number, "123")
+        self.assertEqual(
+            positive_organism.datetime_ordered, self.datetime_ordered
+        )
+
+    def test_update_for_lab_tests_replaces(self):
+        observation = self.lab_test.observation_set.create(
+            observation_name="Blood Culture",
+            observation_value="Staphylococcus aureus"
+        )
+        models.PositiveOrganism.update_for_lab_tests([self.lab_test])
+        observation.observation_value = "No growth"
+        observation.save()
+        models.PositiveOrganism.update_for_lab_tests([self.lab_test])
+        self.assertFalse(self.patient.positive_organisms.exists())
+
+    def test_observation_save_does_not_update(self):
+        with self.assertNumQueries(1):
+            self.lab_test.observation_set.create(
+                observation_name="Blood Culture",
+                observation_value="Staphylococcus aureus"
+            )
+        self.assertFalse(self.patient.positive_organisms.exists())
+
+    def test_only_blood_culture_observations(self):
+        self.lab_test.observation_set.create(
+            observation_name="Comment",
+            observation_value="Staphylococcus aureus"
+        )
+        models.PositiveOrganism.update_for_lab_tests([self.lab_test])
+        self.assertFalse(self.patient.positive_organisms.exists())
+
+    def test_only_blood_cultures(self):
+        lab_test = self.patient.lab_tests.create(test_name="WOUND SWAB")
+        lab_test.observation_set.create(
+            observation_name="Blood Culture",
+            observation_value="Staphylococcus aureus"
+        )
+        models.PositiveOrganism.update_for_lab_tests([lab_test])
+        self.assertFalse(self.patient.positive_organisms.exists())
+
+    def test_one_per_organism(self):
+        for _ in range(2):
+            self.lab_test.observation_set.create(
+                observation_name="Blood Culture",
+                observation_value="Staphylococcus aureus"
+            )
+        models.PositiveOrganism.update_for_lab_tests([self.lab_test])
+        self.assertEqual(self.patient.positive_organisms.count(), 1)
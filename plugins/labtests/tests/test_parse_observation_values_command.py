@@ -0,0 +1,35 @@
+from opal.core.test import OpalTestCase
+from plugins.labtests import models
+from plugins.labtests.management.commands import parse_observation_values
+
+
+class ParseObservationValuesTestCase(OpalTestCase):
+    def setUp(self):
+        self.cmd = parse_observation_values.Command()
+        patient, _ = self.new_patient_and_episode_please()
+        lab_test = patient.lab_tests.create()
+        for value in ["1", "5", "Pending"]:
+            lab_test.observation_set.create(
+                observation_value=value, reference_range="1.5 - 4"
+            )
+        # observations from before we stored the parsed values
+        models.Observation.objects.update(
+            parsed=False, numeric_value=None, is_abnormal=None
+        )
+
+    def test_handle(self):
+        self.cmd.handle(chunk_size=2)
+        self.assertFalse(
+            models.Observation.objects.filter(parsed=False).exists()
+        )
+        self.assertEqual(
+            list(models.Observation.objects.filter(
+                is_abnormal=True
+            ).values_list("numeric_value", flat=True).order_by("id")),
+            [1, 5]
+        )
+        self.assertIsNone(
+            models.Observation.objects.get(
+                observation_value="Pending"
+            ).is_abnormal
+        )
@@ -0,0 +1,135 @@
+import datetime
+
+from django.db.models import F
+from django.utils import timezone
+from opal.core.test import OpalTestCase
+
+from plugins.labtests import models
+from plugins.labtests import recent_results
+
+
+class RecentResultsTestCase(OpalTestCase):
+    def setUp(self):
+        self.patient, _ = self.new_patient_and_episode_please()
+        self.other_patient, _ = self.new_patient_and_episode_please()
+
+    def create_observation(
+        self,
+        dt,
+        value,
+        test_name="FULL BLOOD COUNT",
+        obs_name="WBC",
+        patient=None
+    ):
+        if patient is None:
+            patient = self.patient
+        lab_test = patient.lab_tests.create(
+            test_name=test_name, datetime_ordered=dt
+        )
+        return lab_test.observation_set.create(
+            observation_name=obs_name,
+            observation_value=value,
+            observation_datetime=dt
+        )
+
+    def dt(self, day, hour=12):
+        return timezone.make_aware(datetime.datetime(2020, 3, day, hour))
+
+
+class GetRankedTestCase(RecentResultsTestCase):
+    def test_get_ranked(self):
+        for day in range(1, 5):
+            self.create_observation(self.dt(day), str(day))
+            self.create_observation(self.dt(day), str(day), test_name="OTHER")
+        result = recent_results.get_ranked(
+            models.LabTest.objects.filter(patient=self.patient),
+            partition_by=[F("test_name")],
+            order_by=[F("datetime_ordered").desc()],
+            limit=2
+        )
+        self.assertEqual(
+            sorted((i.test_name, i.datetime_ordered.day, i.row_number) for i in result),
+            [
+                ("FULL BLOOD COUNT", 3, 2), ("FULL BLOOD COUNT", 4, 1),
+                ("OTHER", 3, 2), ("OTHER", 4, 1),
+            ]
+        )
+
+
+class GetLatestObservationsTestCase(RecentResultsTestCase):
+    def test_get_latest_observations(self):
+        self.create_observation(self.dt(1), "1")
+        self.create_observation(self.dt(3), "3")
+        self.create_observation(self.dt(2), "2")
+        self.create_observation(self.dt(4), "4", obs_name="Hb")
+        self.create_observation(self.dt(5), "5", obs_name="Other")
+        self.create_observation(self.dt(6), "6", patient=self.other_patient)
+        with self.assertNumQueries(2):
+            result = recent_results.get_latest_observations(
+                self.patient,
+                {"FULL BLOOD COUNT": ["WBC", "Hb"]},
+                order_by=[F("observation_datetime").desc()],
+                limit=2
+            )
+            values = {
+                k: [(i.observation_value, i.test.test_name,) for i in v]
+                for k, v in result.items()
+            }
+        self.assertEqual(values, {
+            ("FULL BLOOD COUNT", "WBC",): [
+                ("3", "FULL BLOOD COUNT",), ("2", "FULL BLOOD COUNT",)
+            ],
+            ("FULL BLOOD COUNT", "Hb",): [("4", "FULL BLOOD COUNT",)],
+        })
+
+    def test_none(self):
+        result = recent_results.get_latest_observations(
+            self.patient,
+            {"FULL BLOOD COUNT": ["WBC"]},
+            order_by=[F("observation_datetime").desc()],
+        )
+        self.assertEqual(result, {})
+
+
+class GetRecentNumericObservationsTestCase(RecentResultsTestCase):
+    def get_values(self, num_days=3):
+        result = recent_results.get_recent_numeric_observations(
+            self.patient, {"FULL BLOOD COUNT": ["WBC"]}, num_days
+        )
+        return [
+            i.observation_value for i in result[("FULL BLOOD COUNT", "WBC",)]
+        ]
+
+    def test_most_recent_of_each_day(self):
+        self.create_observation(self.dt(1, 10), "1")
+        self.create_observation(self.dt(2, 10), "2")
+        self.create_observation(self.dt(2, 14), "2.5")
+        self.create_observation(self.dt(4, 14), "4")
+        self.create_observation(self.dt(5, 9), "5")
+        self.create_observation(self.dt(5, 8), "4.5")
+        self.assertEqual(self.get_values(), ["5", "4", "2.5"])
+
+    def test_ignores_non_numeric(self):
+        self.create_observation(self.dt(1), "1")
+        self.create_observation(self.dt(2), "Pending")
+        self.create_observation(self.dt(3), "3")
+        self.assertEqual(self.get_values(), ["3", "1"])
+
+    def test_ignores_other_patients(self):
+        self.create_observation(self.dt(1), "1")
+        self.create_observation(self.dt(2), "2", patient=self.other_patient)
+        self.assertEqual(self.get_values(), ["1"])
+
+    def test_unparsed(self):
+        self.create_observation(self.dt(1), "1")
+        self.create_observation(self.dt(2, 10), "2")
+        self.create_observation(self.dt(4), "4")
+        unparsed = [
+            self.create_observation(self.dt(2, 14), "2.5"),
+            self.create_observation(self.dt(3), "Pending"),
+            self.create_observation(self.dt(5), "5"),
+        ]
+        models.Observation.objects.filter(
+            id__in=[i.id for i in unparsed]
+        ).update(parsed=False, numeric_value=None)
+        self.assertEqual(self.get_values(), ["5", "4", "2.5"])
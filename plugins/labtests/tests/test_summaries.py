@@ -0,0 +1,196 @@
+import datetime
+from unittest import mock
+from django.utils import timezone
+from opal.core.test import OpalTestCase
+from plugins.labtests import models, summaries
+from plugins.labtests.management.commands import rebuild_lab_test_summaries
+
+
+class SummariesTestCase(OpalTestCase):
+    def setUp(self):
+        self.patient, _ = self.new_patient_and_episode_please()
+
+    def create_test(self, test_name, dt, value, **kwargs):
+        test = self.patient.lab_tests.create(
+            test_name=test_name,
+            datetime_ordered=timezone.make_aware(dt),
+            **kwargs
+        )
+        test.observation_set.create(
+            observation_name=test_name.title(),
+            observation_value=value,
+            reference_range="1 - 10"
+        )
+        return test
+
+
+class RebuildSummariesTestCase(SummariesTestCase):
+    def test_rebuild_summaries(self):
+        self.create_test(
+            "FULL BLOOD COUNT", datetime.datetime(2019, 6, 10), "20"
+        )
+        self.create_test(
+            "FULL BLOOD COUNT", datetime.datetime(2019, 6, 17), "3"
+        )
+        self.create_test(
+            "BLOOD CULTURE", datetime.datetime(2019, 6, 17), "Staph. Aureus"
+        )
+        summaries.rebuild_summaries({self.patient.id: ["FULL BLOOD COUNT"]})
+        summary = self.patient.lab_test_summaries.get()
+        self.assertEqual(summary.test_name, "FULL BLOOD COUNT")
+        self.assertEqual(
+            summary.last_ordered,
+            timezone.make_aware(datetime.datetime(2019, 6, 17))
+        )
+        data = summary.get_data()
+        self.assertFalse(data["long_form"])
+        self.assertEqual(data["count"], 2)
+        self.assertEqual(
+            data["instances"]["observation_series"]["Full Blood Count"], {
+                "10/06/2019 00:00:00": {
+                    "value": "20", "range": "1 - 10", "display_class": "too-high"
+                },
+                "17/06/2019 00:00:00": {
+                    "value": "3", "range": "1 - 10", "display_class": ""
+                },
+            }
+        )
+
+    def test_replaces_existing_summaries(self):
+        self.create_test("BLOOD CULTURE", datetime.datetime(2019, 6, 17), "1")
+        summaries.rebuild_summaries({self.patient.id: ["BLOOD CULTURE"]})
+        self.create_test("BLOOD CULTURE", datetime.datetime(2019, 6, 18), "2")
+        summaries.rebuild_summaries({self.patient.id: ["BLOOD CULTURE"]})
+        summary = self.patient.lab_test_summaries.get()
+        self.assertEqual(summary.get_data()["count"], 2)
+
+    def test_deletes_summaries_of_removed_test_types(self):
+        test = self.create_test(
+            "BLOOD CULTURE", datetime.datetime(2019, 6, 17), "1"
+        )
+        summaries.rebuild_summaries({self.patient.id: ["BLOOD CULTURE"]})
+        test.delete()
+        summaries.rebuild_summaries({self.patient.id: ["BLOOD CULTURE"]})
+        self.assertFalse(self.patient.lab_test_summaries.exists())
+
+    def test_ignores_comments(self):
+        self.create_test("COMMENT", datetime.datetime(2019, 6, 17), "1")
+        summaries.rebuild_summaries({self.patient.id: ["COMMENT"]})
+        self.assertFalse(self.patient.lab_test_summaries.exists())
+
+    def test_rebuild_patient_summaries(self):
+        self.create_test("BLOOD CULTURE", datetime.datetime(2019, 6, 17), "1")
+        self.create_test(
+            "FULL BLOOD COUNT", datetime.datetime(2019, 6, 10), "20"
+        )
+        models.LabTestSummary.objects.create(
+            patient=self.patient,
+            test_name="OLD TEST",
+            last_ordered=timezone.now(),
+            data="{}"
+        )
+        summaries.rebuild_patient_summaries(self.patient)
+        self.assertEqual(
+            set(self.patient.lab_test_summaries.values_list(
+                "test_name", flat=True
+            )),
+            {"BLOOD CULTURE", "FULL BLOOD COUNT"}
+        )
+
+
+class GetSerialisedTestsTestCase(SummariesTestCase):
+    def test_uses_summaries(self):
+        self.create_test(
+            "BLOOD CULTURE", datetime.datetime(2019, 6, 17), "Staph. Aureus"
+        )
+        summaries.rebuild_patient_summaries(self.patient)
+        with mock.patch.object(
+            summaries.LabTestResultsSerialiser, "serialise_test_type"
+        ) as serialise_test_type:
+            serialised, test_dates = summaries.get_serialised_tests(
+                self.patient
+            )
+        self.assertFalse(serialise_test_type.called)
+        self.assertEqual(
+            serialised["BLOOD CULTURE"]["instances"][0]["observations"],
+            [{
+                "name": "Blood Culture",
+                "value": "Staph. Aureus",
+                "units": None
+            }]
+        )
+        self.assertEqual(
+            test_dates["BLOOD CULTURE"],
+            timezone.make_aware(datetime.datetime(2019, 6, 17))
+        )
+
+    def test_falls_back_to_the_lab_tests(self):
+        self.create_test("BLOOD CULTURE", datetime.datetime(2019, 6, 17), "1")
+        summaries.rebuild_patient_summaries(self.patient)
+        self.create_test(
+            "FULL BLOOD COUNT", datetime.datetime(2019, 6, 10), "20"
+        )
+        serialised, test_dates = summaries.get_serialised_tests(self.patient)
+        self.assertEqual(
+            set(serialised.keys()), {"BLOOD CULTURE", "FULL BLOOD COUNT"}
+        )
+        self.assertEqual(serialised["FULL BLOOD COUNT"]["count"], 1)
+        self.assertEqual(
+            test_dates["FULL BLOOD COUNT"],
+            timezone.make_aware(datetime.datetime(2019, 6, 10))
+        )
+
+    def test_matches_live_serialisation(self):
+        self.create_test(
+            "BLOOD CULTURE", datetime.datetime(2019, 6, 17), "Staph. Aureus"
+        )
+        self.create_test(
+            "FULL BLOOD COUNT", datetime.datetime(2019, 6, 10), "20"
+        )
+        live, _ = summaries.get_serialised_tests(self.patient)
+        summaries.rebuild_patient_summaries(self.patient)
+        stored, _ = summaries.get_serialised_tests(self.patient)
+        self.assertEqual(
+            stored["FULL BLOOD COUNT"]["instances"]["observation_series"],
+            live["FULL BLOOD COUNT"]["instances"]["observation_series"],
+        )
+        self.assertEqual(
+            stored["BLOOD CULTURE"]["instances"][0]["date"],
+            "17/06/2019 00:00:00"
+        )
+
+
+class GetTestOrderTestCase(OpalTestCase):
+    def test_get_test_order(self):
+        test_dates = {
+            "BLOOD CULTURE": timezone.make_aware(datetime.datetime(2019, 6, 1)),
+            "FULL BLOOD COUNT": timezone.make_aware(
+                datetime.datetime(2019, 6, 10)
+            ),
+        }
+        self.assertEqual(
+            summaries.get_test_order(test_dates),
+            ["FULL BLOOD COUNT", "BLOOD CULTURE"]
+        )
+
+
+class RebuildLabTestSummariesCommandTestCase(SummariesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cmd = rebuild_lab_test_summaries.Command()
+
+    def test_rebuilds_patients_without_summaries(self):
+        self.create_test("BLOOD CULTURE", datetime.datetime(2019, 6, 17), "1")
+        other, _ = self.new_patient_and_episode_please()
+        self.cmd.handle(all=False)
+        self.assertTrue(self.patient.lab_test_summaries.exists())
+        self.assertFalse(other.lab_test_summaries.exists())
+
+    @mock.patch.object(summaries, "rebuild_patient_summaries")
+    def test_skips_patients_with_summaries(self, rebuild_patient_summaries):
+        self.create_test("BLOOD CULTURE", datetime.datetime(2019, 6, 17), "1")
+        summaries.rebuild_summaries({self.patient.id: ["BLOOD CULTURE"]})
+        self.cmd.handle(all=False)
+        self.assertFalse(rebuild_patient_summaries.called)
+        self.cmd.handle(all=True)
+        rebuild_patient_summaries.assert_called_once_with(self.patient)
@@ -1,4 +1,8 @@
+import datetime
+
+from django.utils import timezone
 from opal.core.test import OpalTestCase
+
 from plugins.tb import utils
 
 
@@ -28,3 +32,80 @@ class TestCleanObsValueTestCase(OpalTestCase):
         value = None
         r = utils.clean_observation_value(value)
         self.assertIsNone(r)
+
+
+class GetTBSummaryInformationTestCase(OpalTestCase):
+    def setUp(self):
+        self.patient, _ = self.new_patient_and_episode_please()
+
+    def create_observation(self, day, value, test_name="C REACTIVE PROTEIN", obs_name="C Reactive Protein"):
+        dt = timezone.make_aware(datetime.datetime(2019, 1, day))
+        lab_test = self.patient.lab_tests.create(
+            test_name=test_name, datetime_ordered=dt
+        )
+        return lab_test.observation_set.create(
+            observation_name=obs_name,
+            observation_value=value,
+            observation_datetime=dt
+        )
+
+    def get_value(self, obs_name="C Reactive Protein"):
+        result = utils.get_tb_summary_information(self.patient)
+        return result[obs_name]["observation_value"]
+
+    def test_most_recent(self):
+        self.create_observation(1, "3")
+        self.create_observation(3, "5")
+        self.create_observation(2, "4")
+        self.assertEqual(self.get_value(), "5")
+
+    def test_ignores_pending(self):
+        self.create_observation(1, "3")
+        self.create_observation(2, "4")
+        self.create_observation(3, "Pending")
+        self.assertEqual(self.get_value(), "4")
+
+    def test_all_pending(self):
+        first = self.create_observation(1, "Pending")
+        self.create_observation(2, "Pending")
+        result = utils.get_tb_summary_information(self.patient)
+        self.assertEqual(
+            result["C Reactive Protein"]["observation_datetime"],
+            first.observation_datetime
+        )
+
+    def test_cleans_values(self):
+        self.create_observation(
+            1, "Not detected~please note", "HIV 1 + 2 ANTIBODIES", "HIV 1 + 2 Antibodies.........."
+        )
+        self.create_observation(
+            1,
+            "20~Note method change and as a result a change in~reference range.",
+            "LIVER PROFILE",
+            "AST"
+        )
+        result = utils.get_tb_summary_information(self.patient)
+        self.assertEqual(
+            result["HIV 1 + 2 Antibodies"]["observation_value"], "Not detected"
+        )
+        self.assertEqual(result["AST"]["observation_value"], "20")
+
+    def test_ignores_other_observations(self):
+        self.create_observation(1, "3", obs_name="Other")
+        self.create_observation(1, "3", test_name="OTHER")
+        self.assertEqual(utils.get_tb_summary_information(self.patient), {})
+
+    def test_order(self):
+        self.create_observation(1, "3", "LIVER PROFILE", "ALT")
+        self.create_observation(1, "4")
+        self.assertEqual(
+            list(utils.get_tb_summary_information(self.patient).keys()),
+            ["C Reactive Protein", "ALT"]
+        )
+
+    def test_single_query(self):
+        for day in range(1, 5):
+            self.create_observation(day, "3")
+            self.create_observation(day, "3", "LIVER PROFILE", "ALT")
+        with self.assertNumQueries(2):
+            utils.get_tb_summary_information(self.patient)
@@ -3,6 +3,10 @@ Utilities for the TB module
 """
 from collections import OrderedDict, defaultdict
 
+from django.db.models import Case, F, IntegerField, Value, When
+
+from plugins.labtests import recent_results
+
 
 RELEVANT_TESTS = OrderedDict((
     ("C REACTIVE PROTEIN", ["C Reactive Protein"]),
@@ -36,35 +40,48 @@ def clean_observation_value(value):
 def get_tb_summary_information(patient):
     """
     Returns an ordered dict of observations in the order declared above.
+
+    For each observation we use the most recent that is not pending,
+    or if they are all pending the oldest.
     """
-    tests = patient.lab_tests.filter(
-        test_name__in=RELEVANT_TESTS.keys()
-    ).order_by("-datetime_ordered").prefetch_related(
-        "observation_set"
+    is_pending = Case(
+        When(observation_value="Pending", then=Value(1)),
+        default=Value(0),
+        output_field=IntegerField()
+    )
+    latest_observations = recent_results.get_latest_observations(
+        patient,
+        RELEVANT_TESTS,
+        order_by=[
+            is_pending.asc(),
+            Case(
+                When(observation_value="Pending", then=None),
+                default=F("test__datetime_ordered"),
+            ).desc(),
+            Case(
+                When(observation_value="Pending", then=F("test__datetime_ordered")),
+                default=None,
+            ).asc(),
+            F("id").asc(),
+        ]
     )
     by_observation = defaultdict(dict)
     not_detected_vals = ["not detected~", "not detected ~", "not detected.~"]
     reference_range_str =  "~Note method change and as a result a change in~reference range."
-    for t in tests:
-        tn = t.test_name
-        for obs in t.observation_set.all():
-            obs_name = obs.observation_name
-            if obs_name in RELEVANT_TESTS[tn]:
-                if obs_name not in by_observation or by_observation[obs_name][
-                    "observation_value"
-                ] == "Pending":
-                    by_observation[obs_name][
-                        "observation_datetime"
-                    ] = obs.observation_datetime
-                    obs_value = obs.observation_value
-                    if obs_name == "AST":
-                        obs_value = obs_value.replace(reference_range_str, "").strip()
-                    lower_obs = obs_value.lower()
-                    for not_detected_val in not_detected_vals:
-                        if lower_obs.startswith(not_detected_val):
-                            obs_value = "Not detected"
-                    obs_value = clean_observation_value(obs_value)
-                    by_observation[obs_name]["observation_value"] = obs_value
+    for (_, obs_name), observations in latest_observations.items():
+        obs = observations[0]
+        by_observation[obs_name][
+            "observation_datetime"
+        ] = obs.observation_datetime
+        obs_value = obs.observation_value
+        if obs_name == "AST":
+            obs_value = obs_value.replace(reference_range_str, "").strip()
+        lower_obs = obs_value.lower()
+        for not_detected_val in not_detected_vals:
+            if lower_obs.startswith(not_detected_val):
+                obs_value = "Not detected"
+        obs_value = clean_observation_value(obs_value)
+        by_observation[obs_name]["observation_value"] = obs_value
 
     results_order = []
     for observation_names in RELEVANT_TESTS.values():
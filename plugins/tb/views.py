@@ -1,13 +1,9 @@
 """
 Views for the TB Opal Plugin
 """
-import csv
 import json
 import datetime
-import io
-import zipfile
 from collections import defaultdict
-from django.http.response import StreamingHttpResponse
 from django.views.generic import DetailView, ListView
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.utils import timezone
@@ -24,6 +20,7 @@ from elcid.models import (
     Demographics,
     SymptomComplex, ReferralRoute
 )
+from elcid import streaming
 from elcid.utils import timing
 from plugins.appointments.models import Appointment
 from plugins.tb import episode_categories, constants, models
@@ -825,36 +822,6 @@ class OutstandingActionsMDT(LoginRequiredMixin, TemplateView):
         return ctx
 
 
-def zip_file_response(file_stem, csv_data):
-    """
-    Takes in a file_stem and a list of dicts
-    returns an http response with a file called
-    {file_stem}.zip, which unzips to {file_stem}.csv
-    """
-    csv_buffer = io.StringIO()
-    wr = None
-    if csv_data:
-        headers = csv_data[0].keys()
-        wr = csv.DictWriter(
-            csv_buffer, fieldnames=headers
-        )
-        wr.writeheader()
-        wr.writerows(csv_data)
-    csv_buffer.seek(0)
-
-    temp = io.BytesIO()
-    with zipfile.ZipFile(temp, 'w') as archive:
-        archive.writestr(f'{file_stem}.csv', csv_buffer.getvalue())
-
-    response = StreamingHttpResponse(temp, content_type='application/zip')
-    response['Content-Disposition'] = f'attachment; filename="{file_stem}.zip"'
-    response['Content-Length'] = temp.tell()
-
-    temp.seek(0)
-
-    return response
-
-
 class AbstractClinicActivity(LoginRequiredMixin, TemplateView):
     @property
     def menu_years(self):
@@ -1302,7 +1269,9 @@ class ClinicActivityMDTData(AbstractClinicActivity):
 
     def post(self, *args, **kwargs):
         table_data = self.get_mdt_info()
-        return zip_file_response(f"mdt_data_{self.kwargs['year']}", table_data)
+        return streaming.zip_csv_response(
+            f"mdt_data_{self.kwargs['year']}", table_data
+        )
 
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)